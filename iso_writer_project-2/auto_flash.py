@@ -0,0 +1,315 @@
+"""
+插入即写入（制作工位模式）
+长期运行，监听新插入的USB设备，符合白名单规则（容量范围、厂商、型号、序列号）的设备
+自动排队写入并验证，由按USB拓扑限制并发的调度器执行，每个设备的结果追加到JSON行日志
+"""
+
+import os
+import json
+import time
+import fnmatch
+import threading
+
+from device_inventory import format_size, get_inventory
+from job_control import OperationCancelled
+from job_scheduler import CONTROLLER_JOBS, USB2_HUB_JOBS, USB3_HUB_JOBS, JobScheduler
+from pipeline import EventBus
+from usb_writer import USBWriter
+
+DEFAULT_WORKERS = 2
+# 设备出现后等待udev处理完成（分区节点、自动挂载）再开始写入
+SETTLE_DELAY = 2.0
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_size(text):
+    """解析容量，如"512M"、"8G"、"16GB"，不带单位时为字节"""
+    value = str(text).strip().upper()
+    if value.endswith("IB"):
+        value = value[:-2]
+    elif value.endswith("B"):
+        value = value[:-1]
+    unit = value[-1:] if value[-1:].isalpha() else ""
+    number = value[:-len(unit)] if unit else value
+    try:
+        return int(float(number) * SIZE_UNITS[unit])
+    except (KeyError, ValueError):
+        raise Exception(f"无效的容量: {text}")
+
+
+class DeviceRule:
+    """设备白名单规则；厂商、型号和序列号使用不区分大小写的通配符（如"SanDisk*"），为None时不限制"""
+
+    def __init__(self, min_size=0, max_size=None, vendor=None, model=None, serial=None, removable_only=True):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.vendor = vendor
+        self.model = model
+        self.serial = serial
+        # 只接受内核标记为可移动的设备；部分USB移动硬盘不带可移动标记
+        self.removable_only = removable_only
+
+    @staticmethod
+    def _match(pattern, value):
+        return pattern is None or fnmatch.fnmatchcase(value.strip().casefold(), pattern.casefold())
+
+    def reject_reason(self, device):
+        """符合规则时返回None，否则返回不符合的原因"""
+        if not device.is_usb:
+            return "不是USB设备"
+        if self.removable_only and not device.removable:
+            return "不是可移动设备"
+        if device.read_only:
+            return "设备只读"
+        if device.size <= 0:
+            return "未插入介质"
+        if device.size < self.min_size:
+            return f"容量 {format_size(device.size)} 小于 {format_size(self.min_size)}"
+        if self.max_size is not None and device.size > self.max_size:
+            return f"容量 {format_size(device.size)} 大于 {format_size(self.max_size)}"
+        if not self._match(self.vendor, device.vendor):
+            return f"厂商不符: {device.vendor}"
+        if not self._match(self.model, device.model):
+            return f"型号不符: {device.model}"
+        if not self._match(self.serial, device.serial):
+            return f"序列号不符: {device.serial}"
+        return None
+
+    def matches(self, device):
+        return self.reject_reason(device) is None
+
+    def describe(self):
+        parts = [f"容量 {format_size(self.min_size)}~{format_size(self.max_size) if self.max_size else '不限'}"]
+        for title, pattern in (("厂商", self.vendor), ("型号", self.model), ("序列号", self.serial)):
+            if pattern is not None:
+                parts.append(f"{title} {pattern}")
+        if self.removable_only:
+            parts.append("仅可移动设备")
+        return "，".join(parts)
+
+
+class FlashJob:
+    """一个设备的自动写入任务"""
+
+    def __init__(self, device):
+        self.device = device
+        # queued、running、succeeded、failed、cancelled
+        self.status = "queued"
+        self.error = None
+        self.digest = None
+        self.percent = 0.0
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.writer = None
+
+    @property
+    def finished(self):
+        return self.status in ("succeeded", "failed", "cancelled")
+
+    def to_dict(self):
+        return {
+            "device": self.device.path,
+            "name": self.device.display_name(),
+            "serial": self.device.serial,
+            "bytes": self.device.size,
+            "status": self.status,
+            "error": self.error,
+            "digest": self.digest,
+            "percent": round(self.percent, 1),
+            "queued_at": round(self.queued_at, 3),
+            "started_at": round(self.started_at, 3) if self.started_at else None,
+            "seconds": round(self.finished_at - self.started_at, 3)
+            if self.started_at and self.finished_at else None,
+        }
+
+
+class AutoFlasher:
+    """监听设备插入并自动写入；只处理启动后新插入的设备，已在位的设备不会被写入。
+    在bus上发布device_ignored、job_queued、job_started、job_status、job_progress、job_finished事件，
+    调度队列变化时转发queue_changed事件"""
+
+    def __init__(self, iso_file, rule, workers=DEFAULT_WORKERS, log_path=None, writer_options=None,
+                 inventory=None, settle_delay=SETTLE_DELAY, usb2_hub_jobs=USB2_HUB_JOBS,
+                 usb3_hub_jobs=USB3_HUB_JOBS, controller_jobs=CONTROLLER_JOBS):
+        if not os.path.exists(iso_file):
+            raise Exception(f"ISO文件不存在: {iso_file}")
+        self.iso_file = iso_file
+        self.rule = rule
+        self.iso_size = os.path.getsize(iso_file)
+        # 总并发数，另按集线器和控制器分别限制
+        self.workers = max(1, workers)
+        self.scheduler_options = {"usb2_hub_jobs": usb2_hub_jobs, "usb3_hub_jobs": usb3_hub_jobs,
+                                  "controller_jobs": controller_jobs}
+        self.log_path = log_path
+        # 传给USBWriter的选项，默认写入后验证
+        self.writer_options = dict(writer_options or {})
+        self.writer_options.setdefault("verify", True)
+        self.inventory = inventory or get_inventory()
+        self.settle_delay = settle_delay
+        self.bus = EventBus()
+        # 设备名 -> FlashJob；设备拔出前不会再次写入
+        self.jobs = {}
+        self.history = []
+        self._ignored = set()
+        # 不符合规则的设备 -> 原因，原因不变时不重复报告
+        self._rejected = {}
+        self._lock = threading.Lock()
+        self._log_lock = threading.Lock()
+        self._stop = threading.Event()
+        self.scheduler = None
+        self._subscription = None
+
+    def start(self):
+        """开始监听，返回监听方式（netlink或poll）"""
+        self._stop.clear()
+        self.scheduler = JobScheduler(max_jobs=self.workers, **self.scheduler_options)
+        self.scheduler.bus.subscribe(lambda event, state: self.bus.publish(event, state=state), "queue_changed")
+        mode = self.inventory.start_monitor()
+        # 启动时已在位的设备不写入，避免误擦除工位上的其他磁盘
+        with self._lock:
+            self._ignored = {device.name for device in self.inventory.devices(usb_only=False, rescan=False)}
+        self._subscription = self.inventory.bus.subscribe(self._on_device, "device_added", "device_removed",
+                                                          "device_changed")
+        return mode
+
+    def stop(self, cancel=True):
+        """停止监听；cancel为True时取消正在进行的写入，否则等待其完成"""
+        with self._lock:
+            self._stop.set()
+            if cancel:
+                for job in self.jobs.values():
+                    if job.writer is not None:
+                        job.writer.cancel()
+        if self._subscription is not None:
+            self.inventory.bus.unsubscribe(self._subscription)
+            self._subscription = None
+        if self.scheduler is not None:
+            # 排队中的任务启动后发现已停止，直接记为取消
+            self.scheduler.shutdown(wait=True)
+        self.inventory.stop_monitor()
+
+    def queue_state(self):
+        """调度队列状态，见JobScheduler.state"""
+        if self.scheduler is None:
+            return {"running": [], "queued": [], "hubs": {}, "controllers": {}, "max_jobs": self.workers}
+        return self.scheduler.state()
+
+    def summary(self):
+        """已完成任务的统计"""
+        with self._lock:
+            history = list(self.history)
+        counts = {"succeeded": 0, "failed": 0, "cancelled": 0}
+        for job in history:
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return counts
+
+    # ------------------------------------------------------------------
+    # 设备事件
+
+    def _on_device(self, event, device):
+        if event == "device_removed":
+            self._on_removed(device)
+            return
+        # 读卡器插卡或udev稍后补全信息时只产生device_changed，同样检查
+        with self._lock:
+            if device.name in self._ignored or device.name in self.jobs or self._stop.is_set():
+                return
+            reason = self.rule.reject_reason(device)
+            if reason is None:
+                job = FlashJob(device)
+                self.jobs[device.name] = job
+            elif device.is_usb and self._rejected.get(device.name) != reason:
+                self._rejected[device.name] = reason
+                job = None
+            else:
+                return
+        if job is None:
+            self.bus.publish("device_ignored", device=device.path, reason=reason,
+                             message=f"{device.path} {device.display_name()} 不符合规则: {reason}")
+            return
+        self.bus.publish("job_queued", **job.to_dict(),
+                         message=f"{device.path} {device.display_name()} 已加入写入队列")
+        try:
+            self.scheduler.submit(device.path, lambda scheduled: self._run_job(job, scheduled), self.iso_size,
+                                  sys_path=device.sys_path)
+        except Exception as e:
+            # 提交前服务已停止，调度器不再接受任务
+            self._finish(job, "cancelled", str(e))
+
+    def _on_removed(self, device):
+        with self._lock:
+            self._ignored.discard(device.name)
+            self._rejected.pop(device.name, None)
+            job = self.jobs.pop(device.name, None)
+        if job is not None and not job.finished and job.writer is not None:
+            # 写入中途拔出，取消该任务而不是等I/O错误
+            job.writer.cancel()
+
+    # ------------------------------------------------------------------
+    # 写入任务
+
+    def _run_job(self, job, scheduled):
+        with self._lock:
+            removed = self.jobs.get(job.device.name) is not job
+        if not removed:
+            self._stop.wait(self.settle_delay)
+        # 与stop()持有同一把锁：任务要么在停止前创建写入器并可被取消，要么不再开始
+        with self._lock:
+            removed = removed or self.jobs.get(job.device.name) is not job
+            writer = None
+            if not removed and not self._stop.is_set():
+                writer = USBWriter(**self.writer_options)
+                job.writer = writer
+        if writer is None:
+            # 已停止，或等待期间设备被拔出/重新枚举
+            self._finish(job, "cancelled", "设备已移除或服务已停止")
+            return
+        path = job.device.path
+
+        def forward(event, **fields):
+            if event == "progress":
+                job.percent = fields["percent"]
+                scheduled.update(int(self.iso_size * fields["percent"] / 100))
+                self.bus.publish("job_progress", device=path, percent=fields["percent"], rate=fields.get("rate"))
+            elif event in ("status", "stage_failed"):
+                self.bus.publish("job_status", device=path, message=f"{path}: {fields.get('message', '')}",
+                                 level=fields.get("level", "normal"))
+
+        writer.bus.subscribe(forward, "progress", "status", "stage_failed")
+        job.status = "running"
+        job.started_at = time.time()
+        self.bus.publish("job_started", **job.to_dict(), message=f"{path} 开始写入")
+        try:
+            writer.run(self.iso_file, path)
+            job.digest = writer.image_digest
+            job.percent = 100.0
+            self._finish(job, "succeeded")
+        except OperationCancelled:
+            self._finish(job, "cancelled", "操作已取消")
+        except Exception as e:
+            self._finish(job, "failed", str(e))
+
+    def _finish(self, job, status, error=None):
+        job.status = status
+        job.error = error
+        job.finished_at = time.time()
+        job.writer = None
+        with self._lock:
+            self.history.append(job)
+        record = job.to_dict()
+        self._append_log(record)
+        names = {"succeeded": "写入完成", "failed": "写入失败", "cancelled": "已取消"}
+        message = f"{job.device.path} {names[status]}" + (f": {error}" if error else "")
+        self.bus.publish("job_finished", **record, message=message)
+
+    def _append_log(self, record):
+        if not self.log_path:
+            return
+        line = json.dumps(dict(record, iso=self.iso_file, time=round(time.time(), 3)), ensure_ascii=False)
+        with self._log_lock:
+            try:
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+            except OSError as e:
+                print(f"写入结果日志失败: {e}")
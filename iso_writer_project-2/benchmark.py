@@ -0,0 +1,443 @@
+"""
+写入、校验和复制路径的基准测试
+生成指定大小和稀疏度的测试ISO，写入普通文件或loop设备，不需要真实的USB设备；
+每个用例在独立的子进程中运行，分别统计吞吐量、CPU时间、峰值内存和系统调用次数，
+以JSON输出时可保存下来在版本之间比较
+
+用法:
+    python benchmark.py --size 1024 --sparsity 0.3 --json --output result.json
+    python benchmark.py --target /dev/loop0 --case write-direct --case verify
+    python benchmark.py --list
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import stat
+import shutil
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+MB = 1024 * 1024
+DEFAULT_SIZE_MB = 256
+DEFAULT_TREE_FILES = 200
+# 生成测试ISO时决定稀疏与否的粒度
+GENERATE_BLOCK_SIZE = 1024 * 1024
+
+# 用例名: (说明, 运行前目标需要的状态)；"empty"为空目标，"image"为已写入测试ISO
+CASES = {
+    "write-kernel": ("写入引擎：经页缓存，copy_file_range/sendfile内核拷贝", "empty"),
+    "write-mmap": ("写入引擎：经页缓存，mmap切片写出并同步计算摘要", "empty"),
+    "write-readinto": ("写入引擎：经页缓存，readinto预分配缓冲区并同步计算摘要", "empty"),
+    "write-direct": ("写入引擎：O_DIRECT直接写入并同步计算摘要", "empty"),
+    "write-depth4": ("写入引擎：O_DIRECT，4个在途写请求", "empty"),
+    "write-skip-zero": ("写入引擎：跳过全零块，由设备清零跳过的区间", "empty"),
+    "write-delta": ("写入引擎：增量写入，目标已是相同镜像", "image"),
+    "write-usb": ("USBWriter.write_iso_to_device（Linux写入路径）", "empty"),
+    "write-windows": ("USBWriter.write_iso_windows（Windows写入路径）", "empty"),
+    "verify": ("ImageVerifier.verify：回读整体摘要比较", "image"),
+    "diff": ("ImageVerifier.diff：逐块摘要比较", "image"),
+    "manifest": ("ManifestCache.build：计算块摘要清单", "empty"),
+    "copy": ("BootloaderManager.copy_tree：文件模式复制", "empty"),
+    "erase-discard": ("DeviceEraser：TRIM（BLKDISCARD），不支持时降级", "image"),
+    "erase-zeroout": ("DeviceEraser：设备清零（BLKZEROOUT），不支持时降级", "image"),
+    "erase-zero-fill": ("DeviceEraser：多线程写入全零", "image"),
+}
+
+
+def generate_iso(path, size, sparsity=0.0, holes=True, seed=0):
+    """生成测试ISO：按sparsity比例随机把块设为全零，holes为True时全零块留作文件空洞"""
+    rng = random.Random(seed)
+    with open(path, "wb") as f:
+        offset = 0
+        while offset < size:
+            length = min(GENERATE_BLOCK_SIZE, size - offset)
+            if rng.random() < sparsity:
+                if holes:
+                    f.seek(length, os.SEEK_CUR)
+                else:
+                    f.write(bytes(length))
+            else:
+                f.write(rng.getrandbits(length * 8).to_bytes(length, "little"))
+            offset += length
+        f.truncate(size)
+
+
+def generate_tree(path, total_size, file_count, seed=0):
+    """生成用于复制测试的目录树：大小不一的文件分布在若干子目录中"""
+    rng = random.Random(seed)
+    weights = [rng.paretovariate(1.2) for _ in range(file_count)]
+    scale = total_size / sum(weights)
+    for index, weight in enumerate(weights):
+        directory = os.path.join(path, f"dir{index % 8}", f"sub{index % 3}")
+        os.makedirs(directory, exist_ok=True)
+        size = int(weight * scale)
+        with open(os.path.join(directory, f"file{index:04d}.bin"), "wb") as f:
+            remaining = size
+            while remaining > 0:
+                length = min(GENERATE_BLOCK_SIZE, remaining)
+                f.write(rng.getrandbits(length * 8).to_bytes(length, "little"))
+                remaining -= length
+
+
+def tree_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def is_block_device(path):
+    try:
+        return stat.S_ISBLK(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+def drop_cache(path):
+    """刷写并丢弃文件或设备在页缓存中的内容，使每次运行都从冷缓存开始"""
+    if not hasattr(os, "posix_fadvise") or not os.path.exists(path):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def prepare_target(target, iso_path, state):
+    """把目标恢复为用例需要的状态（不计入测量）"""
+    if state == "image":
+        from write_engine import ISOWriteEngine
+        if not os.path.exists(target):
+            # 单独运行需要已有镜像的用例时，普通文件目标可能还不存在
+            open(target, "wb").close()
+        ISOWriteEngine().write(iso_path, target)
+    elif not is_block_device(target):
+        # 普通文件目标每次从空文件开始；块设备保持原样，由写入覆盖
+        with open(target, "wb"):
+            pass
+
+
+def read_proc_io():
+    """读取/proc/self/io，包含已回收子进程的计数"""
+    counters = {}
+    try:
+        with open("/proc/self/io", "r") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                counters[name.strip()] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters
+
+
+def read_proc_status(field):
+    """读取/proc/self/status中以kB为单位的字段"""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def run_case(spec):
+    """在子进程中运行一个用例并返回测量结果"""
+    from bootloader_utils import BootloaderManager
+    from device_erase import DeviceEraser
+    from hash_cache import ManifestCache
+    from usb_writer import USBWriter
+    from verify_utils import ImageVerifier
+    from write_engine import ISOWriteEngine
+
+    case = spec["case"]
+    iso_path = spec["iso"]
+    target = spec["target"]
+    size = os.path.getsize(iso_path)
+    info = {"bytes": size}
+
+    def engine_write(**options):
+        engine = ISOWriteEngine(**options)
+        engine.write(iso_path, target)
+        info["copy_method"] = engine.copy_method
+        if engine.bytes_skipped:
+            info["bytes_skipped"] = engine.bytes_skipped
+        if options.get("delta"):
+            info["bytes_changed"] = engine.bytes_changed
+
+    def erase(method):
+        # 只擦除ISO所占的区间，各方式处理的字节数相同，速度可以直接比较
+        result = DeviceEraser(method=method).erase(target, 0, size)
+        info["erase_methods"] = sorted(result.methods)
+
+    def usb_writer():
+        return USBWriter(verify=True, format_device=False, bootable=False,
+                         manifest_cache=ManifestCache(cache_dir=spec["cache_dir"]))
+
+    actions = {
+        "write-kernel": lambda: engine_write(),
+        "write-mmap": lambda: engine_write(hash_algorithm="sha256"),
+        "write-readinto": lambda: engine_write(hash_algorithm="sha256", zero_copy=False),
+        "write-direct": lambda: engine_write(hash_algorithm="sha256", direct_io=True),
+        "write-depth4": lambda: engine_write(hash_algorithm="sha256", direct_io=True, write_depth=4),
+        "write-skip-zero": lambda: engine_write(hash_algorithm="sha256", skip_zero=True, skip_fill="zeroout"),
+        "write-delta": lambda: engine_write(hash_algorithm="sha256", delta=True),
+        "write-usb": lambda: usb_writer().write_iso_to_device(iso_path, target),
+        "write-windows": lambda: usb_writer().write_iso_windows(iso_path, target),
+        "verify": lambda: info.update(match=ImageVerifier().verify(iso_path, target)),
+        "diff": lambda: info.update(mismatched=len(ImageVerifier().diff(iso_path, target))),
+        "manifest": lambda: ManifestCache(cache_dir=spec["cache_dir"]).build(iso_path),
+        "copy": lambda: BootloaderManager().copy_tree(spec["tree_source"], spec["tree_target"]),
+        "erase-discard": lambda: erase("discard"),
+        "erase-zeroout": lambda: erase("zeroout"),
+        "erase-zero-fill": lambda: erase("write"),
+    }
+    if case == "copy":
+        info["bytes"] = spec["tree_bytes"]
+
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io_before = read_proc_io()
+    baseline_rss = read_proc_status("VmRSS")
+    start = time.perf_counter()
+    actions[case]()
+    seconds = time.perf_counter() - start
+    self_after = resource.getrusage(resource.RUSAGE_SELF)
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io_after = read_proc_io()
+
+    # 外部命令（如cp）的CPU时间计入子进程部分
+    cpu_user = (self_after.ru_utime - self_before.ru_utime) + (children_after.ru_utime - children_before.ru_utime)
+    cpu_system = (self_after.ru_stime - self_before.ru_stime) + (children_after.ru_stime - children_before.ru_stime)
+    peak_rss = max(read_proc_status("VmHWM") or self_after.ru_maxrss, children_after.ru_maxrss)
+    result = {
+        "case": case,
+        "seconds": round(seconds, 4),
+        "mb_s": round(info["bytes"] / MB / seconds, 2) if seconds > 0 else None,
+        "cpu_user": round(cpu_user, 4),
+        "cpu_system": round(cpu_system, 4),
+        "cpu_seconds": round(cpu_user + cpu_system, 4),
+        "peak_rss_kb": peak_rss,
+        "baseline_rss_kb": baseline_rss,
+    }
+    for name in ("syscr", "syscw", "read_bytes", "write_bytes"):
+        if name in io_after:
+            result[name] = io_after[name] - io_before.get(name, 0)
+    result.update(info)
+    return result
+
+
+def spawn_case(spec):
+    """在新的Python进程中运行用例，峰值内存互不影响"""
+    env = dict(os.environ)
+    # 调优、断点等缓存写到临时目录，不影响用户自己的缓存
+    env["XDG_CACHE_HOME"] = spec["cache_dir"]
+    cmd = [sys.executable, os.path.abspath(__file__), "--run-case", json.dumps(spec)]
+    result = subprocess.run(cmd, capture_output=True, text=True, env=env,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    lines = result.stdout.strip().splitlines()
+    if result.returncode != 0 or not lines:
+        error = result.stderr.strip().splitlines()
+        return {"case": spec["case"], "error": error[-1] if error else f"退出码 {result.returncode}"}
+    return json.loads(lines[-1])
+
+
+def git_commit():
+    """当前代码的提交号，便于把结果与版本对应"""
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    if result.returncode != 0:
+        return None
+    return result.stdout.strip() or None
+
+
+def summarize(results):
+    """每个用例多次运行的中位数"""
+    summary = {}
+    for case in dict.fromkeys(result["case"] for result in results):
+        runs = [result for result in results if result["case"] == case and "error" not in result]
+        if not runs:
+            continue
+        summary[case] = {
+            "runs": len(runs),
+            "mb_s": round(statistics.median(run["mb_s"] for run in runs), 2),
+            "cpu_seconds": round(statistics.median(run["cpu_seconds"] for run in runs), 4),
+            "peak_rss_kb": max(run["peak_rss_kb"] or 0 for run in runs),
+            "syscr": statistics.median(run.get("syscr", 0) for run in runs),
+            "syscw": statistics.median(run.get("syscw", 0) for run in runs),
+        }
+    return summary
+
+
+def run_benchmark(args, log):
+    """生成测试数据并依次运行用例，返回结果报告"""
+    workdir = args.workdir or tempfile.mkdtemp(prefix="iso_writer_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    cache_dir = os.path.join(workdir, "cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    cases = args.case or list(CASES)
+    loop_device = None
+
+    try:
+        iso_path = args.iso
+        if not iso_path:
+            iso_path = os.path.join(workdir, "bench.iso")
+            log(f"生成测试ISO: {args.size} MB，稀疏度 {args.sparsity}")
+            generate_iso(iso_path, args.size * MB, args.sparsity, holes=not args.no_holes, seed=args.seed)
+        size = os.path.getsize(iso_path)
+
+        target = args.target
+        if not target:
+            target = os.path.join(workdir, "target.img")
+            if args.loop:
+                # 以普通文件为后端创建loop设备（需要root权限）
+                with open(target, "wb") as f:
+                    f.truncate(size)
+                result = subprocess.run(["losetup", "--find", "--show", target], capture_output=True, text=True)
+                if result.returncode != 0:
+                    raise Exception(f"创建loop设备失败: {result.stderr.strip()}")
+                loop_device = target = result.stdout.strip()
+
+        tree_source = os.path.join(workdir, "tree")
+        tree_target = os.path.join(workdir, "tree_copy")
+        tree_bytes = 0
+        if "copy" in cases:
+            if not os.path.isdir(tree_source):
+                log(f"生成复制测试目录: {args.tree_files} 个文件")
+                generate_tree(tree_source, size, args.tree_files, seed=args.seed)
+            tree_bytes = tree_size(tree_source)
+
+        results = []
+        for case in cases:
+            for run in range(args.repeat):
+                prepare_target(target, iso_path, CASES[case][1])
+                if case == "copy":
+                    shutil.rmtree(tree_target, ignore_errors=True)
+                    os.makedirs(tree_target)
+                if not args.warm:
+                    for path in (iso_path, target, *([tree_source] if case == "copy" else [])):
+                        if os.path.isdir(path):
+                            for root, _, files in os.walk(path):
+                                for name in files:
+                                    drop_cache(os.path.join(root, name))
+                        else:
+                            drop_cache(path)
+                spec = {"case": case, "iso": iso_path, "target": target, "cache_dir": cache_dir,
+                        "tree_source": tree_source, "tree_target": tree_target, "tree_bytes": tree_bytes}
+                result = spawn_case(spec)
+                result["run"] = run
+                results.append(result)
+                if "error" in result:
+                    log(f"{case} #{run}: 失败 - {result['error']}")
+                else:
+                    log(f"{case} #{run}: {result['mb_s']} MB/s，CPU {result['cpu_seconds']} 秒，"
+                        f"峰值内存 {(result['peak_rss_kb'] or 0) // 1024} MB")
+
+        return {
+            "label": args.label,
+            "commit": git_commit(),
+            "time": round(time.time(), 3),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "config": {
+                "size": size,
+                "sparsity": None if args.iso else args.sparsity,
+                "holes": None if args.iso else not args.no_holes,
+                "seed": args.seed,
+                "target": target,
+                "target_type": "block" if is_block_device(target) else "file",
+                "cold_cache": not args.warm,
+                "repeat": args.repeat,
+            },
+            "results": results,
+            "summary": summarize(results),
+        }
+    finally:
+        if loop_device:
+            subprocess.run(["losetup", "--detach", loop_device], capture_output=True, text=True)
+        if not args.workdir and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def print_table(report, stream):
+    """以表格形式输出各用例的中位数"""
+    stream.write(f"{'用例':<16}{'MB/s':>10}{'CPU秒':>10}{'峰值内存MB':>12}{'读调用':>10}{'写调用':>10}\n")
+    for case, row in report["summary"].items():
+        stream.write(f"{case:<16}{row['mb_s']:>10}{row['cpu_seconds']:>10}"
+                     f"{row['peak_rss_kb'] // 1024:>12}{int(row['syscr']):>10}{int(row['syscw']):>10}\n")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="benchmark", description="ISO写入器基准测试")
+    parser.add_argument("--size", type=int, default=DEFAULT_SIZE_MB, help="生成的测试ISO大小（MB）")
+    parser.add_argument("--sparsity", type=float, default=0.0, help="全零块所占比例（0到1）")
+    parser.add_argument("--no-holes", action="store_true", help="全零块实际写入零，而不是留作文件空洞")
+    parser.add_argument("--seed", type=int, default=0, help="生成数据的随机种子，相同种子生成相同的测试数据")
+    parser.add_argument("--iso", help="使用已有的ISO文件，而不是生成测试ISO")
+    parser.add_argument("--target", help="写入目标（普通文件或loop设备，其内容会被覆盖）")
+    parser.add_argument("--loop", action="store_true", help="自动创建loop设备作为写入目标（需要root权限）")
+    parser.add_argument("--case", action="append", choices=list(CASES), help="要运行的用例，可重复指定，默认全部")
+    parser.add_argument("--repeat", type=int, default=3, help="每个用例运行的次数")
+    parser.add_argument("--tree-files", type=int, default=DEFAULT_TREE_FILES, help="复制测试的文件数量")
+    parser.add_argument("--warm", action="store_true", help="运行前不丢弃页缓存")
+    parser.add_argument("--workdir", help="存放测试数据的目录（默认使用临时目录并在结束后删除）")
+    parser.add_argument("--keep", action="store_true", help="保留临时目录")
+    parser.add_argument("--label", help="写入结果的版本标签")
+    parser.add_argument("--json", action="store_true", help="以JSON格式输出结果")
+    parser.add_argument("--output", help="把JSON结果写入文件")
+    parser.add_argument("--list", action="store_true", help="列出所有用例")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.run_case:
+        print(json.dumps(run_case(json.loads(args.run_case)), ensure_ascii=False))
+        return 0
+    if args.list:
+        for name, (description, _) in CASES.items():
+            print(f"{name:<16}{description}")
+        return 0
+    if resource is None:
+        print("基准测试需要Linux等提供resource模块的系统", file=sys.stderr)
+        return 1
+
+    # JSON输出到标准输出时，进度信息写到标准错误
+    log_stream = sys.stderr if args.json else sys.stdout
+    report = run_benchmark(args, lambda message: print(message, file=log_stream, flush=True))
+    data = json.dumps(report, ensure_ascii=False, indent=1)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(data + "\n")
+    if args.json:
+        print(data)
+    else:
+        print_table(report, sys.stdout)
+    failed = [result for result in report["results"] if "error" in result]
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
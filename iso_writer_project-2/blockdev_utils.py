@@ -0,0 +1,190 @@
+"""
+块设备底层工具
+封装Linux块设备ioctl，在非Linux平台或普通文件目标上自动回退
+"""
+
+import os
+import stat
+import struct
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# linux/fs.h
+BLKSSZGET = 0x1268
+BLKGETSIZE64 = 0x80081272
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127f
+BLKRRPART = 0x125f
+
+ZERO_FILL_CHUNK = 4 * 1024 * 1024
+
+# macOS fcntl: 关闭统一缓冲缓存
+F_NOCACHE = 48
+
+DEFAULT_SECTOR_SIZE = 512
+
+# 重新读取分区表后等待分区设备节点出现的时间
+PARTITION_WAIT_TIMEOUT = 10
+
+
+def is_block_device(fd):
+    """判断fd是否为块设备"""
+    try:
+        return stat.S_ISBLK(os.fstat(fd).st_mode)
+    except OSError:
+        return False
+
+
+def get_logical_sector_size(fd, default=DEFAULT_SECTOR_SIZE):
+    """获取设备逻辑扇区大小，失败时返回默认值"""
+    if fcntl is None or not is_block_device(fd):
+        return default
+    try:
+        buf = fcntl.ioctl(fd, BLKSSZGET, struct.pack('I', 0))
+        size = struct.unpack('I', buf)[0]
+        return size if size > 0 else default
+    except OSError:
+        return default
+
+
+def get_device_size(fd):
+    """获取设备或文件的总字节数"""
+    if fcntl is not None and is_block_device(fd):
+        try:
+            buf = fcntl.ioctl(fd, BLKGETSIZE64, struct.pack('Q', 0))
+            return struct.unpack('Q', buf)[0]
+        except OSError:
+            pass
+    return os.fstat(fd).st_size
+
+
+def disable_page_cache(fd):
+    """在不支持O_DIRECT的平台上尽量绕过页缓存，返回是否成功"""
+    if fcntl is not None and hasattr(fcntl, 'F_NOCACHE'):
+        cmd = fcntl.F_NOCACHE
+    elif fcntl is not None and sys.platform == "darwin":
+        cmd = F_NOCACHE
+    else:
+        return False
+    try:
+        fcntl.fcntl(fd, cmd, 1)
+        return True
+    except OSError:
+        return False
+
+
+def datasync(fd):
+    """将fd上的数据刷写到设备"""
+    if hasattr(os, 'fdatasync'):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+
+def _range_ioctl(fd, request, start, length):
+    """对块设备的一段区间发出BLKDISCARD/BLKZEROOUT，返回是否成功"""
+    if fcntl is None or length <= 0 or not is_block_device(fd):
+        return False
+    try:
+        fcntl.ioctl(fd, request, struct.pack('QQ', start, length))
+        return True
+    except OSError:
+        return False
+
+
+def discard_range(fd, start, length):
+    """通知设备丢弃一段区间（TRIM），设备不支持时返回False"""
+    return _range_ioctl(fd, BLKDISCARD, start, length)
+
+
+def zeroout_range(fd, start, length):
+    """由内核/设备将一段区间清零，设备不支持时返回False"""
+    return _range_ioctl(fd, BLKZEROOUT, start, length)
+
+
+def write_zeros(fd, start, length, workers=1):
+    """写入全零数据覆盖一段区间；workers大于1时把区间分段由多个线程同时写入"""
+    if workers > 1 and length > ZERO_FILL_CHUNK and hasattr(os, 'pwrite'):
+        step = -(-length // workers)
+        step += -step % ZERO_FILL_CHUNK
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(write_zeros, fd, offset, min(step, start + length - offset))
+                       for offset in range(start, start + length, step)]
+        for future in futures:
+            future.result()
+        return
+    zeros = memoryview(bytes(min(length, ZERO_FILL_CHUNK)))
+    offset = start
+    end = start + length
+    while offset < end:
+        chunk = min(len(zeros), end - offset)
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, zeros[:chunk], offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, zeros[:chunk])
+        if written <= 0:
+            raise OSError("写入全零数据失败")
+        offset += written
+
+
+def fill_range(fd, start, length, method, workers=1):
+    """按指定方式清空区间：discard、zeroout，不支持时回退为写零，返回实际使用的方式"""
+    if method == "discard" and discard_range(fd, start, length):
+        return "discard"
+    if method in ("discard", "zeroout") and zeroout_range(fd, start, length):
+        return "zeroout"
+    write_zeros(fd, start, length, workers)
+    return "write"
+
+
+def user_mount_options():
+    """以普通用户运行时，挂载FAT分区让当前用户拥有其中的文件，之后可以不用sudo直接写入"""
+    if not hasattr(os, 'geteuid') or os.geteuid() == 0:
+        return []
+    return ["-o", f"uid={os.getuid()},gid={os.getgid()}"]
+
+
+def partition_start_sector(device):
+    """分区在所在磁盘上的起始扇区（512字节为单位），无法获取时返回0"""
+    name = os.path.basename(os.path.realpath(device))
+    try:
+        with open(os.path.join("/sys/class/block", name, "start"), "r") as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return 0
+
+
+def reread_partitions(fd):
+    """通知内核重新读取分区表（BLKRRPART），分区仍在使用中或不是块设备时返回False"""
+    if fcntl is None or not is_block_device(fd):
+        return False
+    try:
+        fcntl.ioctl(fd, BLKRRPART)
+        return True
+    except OSError:
+        return False
+
+
+def partition_path(device, number):
+    """磁盘上第number个分区的设备路径；名称以数字结尾的磁盘（nvme0n1、mmcblk0）分区名带p"""
+    if device[-1:].isdigit():
+        return f"{device}p{number}"
+    return f"{device}{number}"
+
+
+def wait_for_partitions(device, count, timeout=PARTITION_WAIT_TIMEOUT):
+    """等待udev创建前count个分区的设备节点，超时抛出异常"""
+    deadline = time.monotonic() + timeout
+    paths = [partition_path(device, number) for number in range(1, count + 1)]
+    while not all(os.path.exists(path) for path in paths):
+        if time.monotonic() > deadline:
+            missing = ", ".join(path for path in paths if not os.path.exists(path))
+            raise Exception(f"等待分区设备超时: {missing}")
+        time.sleep(0.05)
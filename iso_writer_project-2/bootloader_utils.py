@@ -2,89 +2,88 @@ import os
 import subprocess
 import shutil
 import tempfile
+import time
 import platform
 from pathlib import Path
 
+from blockdev_utils import (get_device_size, partition_path, partition_start_sector, user_mount_options,
+                            wait_for_partitions)
+from fat32_builder import Fat32Builder
+from file_copy import CopyStats, FileCopier
+from iso_catalog import CatalogCache
+from partition_table import PartitionTable
+from pipeline import EventBus, Pipeline, Stage
+from write_engine import open_device
+
+# EFI系统分区从1MiB到100MiB
+EFI_PARTITION_SIZE = 99 * 1024 * 1024
+
 class BootloaderManager:
     """引导加载器管理类"""
     
     def __init__(self):
         self.system = platform.system()
         self.temp_dir = None
+        # ISO目录索引缓存，同一ISO再次制作时不必重新解析目录；与块摘要清单使用相同的ISO身份作为键。
+        # 文件模式把ISO内容重新排布为FAT32，设备上的数据与ISO的块不对应，因此不使用块摘要清单
+        self.catalog_cache = CatalogCache()
+        # 制作过程中的阶段事件，调用方可订阅
+        self.bus = EventBus()
         
     def create_bootable_usb(self, iso_path, usb_device, pe_iso_path=None):
         """创建可引导USB"""
+        # 创建临时工作目录
+        self.temp_dir = tempfile.mkdtemp(prefix="iso_writer_")
+        pipeline = self.build_pipeline(iso_path, usb_device, pe_iso_path)
         try:
-            # 创建临时工作目录
-            self.temp_dir = tempfile.mkdtemp(prefix="iso_writer_")
-            
-            # 挂载ISO文件
-            iso_mount_point = self.mount_iso(iso_path)
-            
-            # 准备USB设备
-            self.prepare_usb_device(usb_device)
-            
-            # 复制ISO内容到USB
-            self.copy_iso_contents(iso_mount_point, usb_device)
-            
-            # 安装引导加载器
-            self.install_bootloader(usb_device, iso_mount_point)
-            
-            # 如果有PE文件，集成PE工具
-            if pe_iso_path and os.path.exists(pe_iso_path):
-                self.integrate_pe_tools(pe_iso_path, usb_device)
-                
-            # 清理
-            self.cleanup(iso_mount_point)
-            
+            pipeline.run()
             return True
             
         except Exception as e:
             print(f"创建可引导USB时出错: {e}")
-            if self.temp_dir:
-                self.cleanup()
             return False
             
-    def mount_iso(self, iso_path):
-        """挂载ISO文件"""
-        mount_point = os.path.join(self.temp_dir, "iso_mount")
-        os.makedirs(mount_point, exist_ok=True)
-        
-        if self.system == "Linux":
-            # Linux下使用loop设备挂载
-            cmd = ["sudo", "mount", "-o", "loop", iso_path, mount_point]
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            if result.returncode != 0:
-                raise Exception(f"挂载ISO失败: {result.stderr}")
-                
-        elif self.system == "Windows":
-            # Windows下使用PowerShell挂载
-            cmd = ["powershell", "-Command", f"Mount-DiskImage -ImagePath '{iso_path}'"]
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            if result.returncode != 0:
-                raise Exception(f"挂载ISO失败: {result.stderr}")
-            # 获取挂载点
-            mount_point = self.get_windows_mount_point(iso_path)
+        finally:
+            # 清理
+            self.cleanup(pipeline.state.get("iso_image"))
             
-        elif self.system == "Darwin":  # macOS
-            # macOS下使用hdiutil挂载
-            cmd = ["hdiutil", "attach", iso_path, "-mountpoint", mount_point]
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            if result.returncode != 0:
-                raise Exception(f"挂载ISO失败: {result.stderr}")
-                
-        return mount_point
+    def build_pipeline(self, iso_path, usb_device, pe_iso_path=None):
+        """读取ISO目录与准备USB设备互不依赖，同时进行；之后依次复制、安装引导、集成PE；
+        Linux下PE文件与ISO内容一起写入数据分区"""
+        include_pe = bool(pe_iso_path) and os.path.exists(pe_iso_path)
         
-    def get_windows_mount_point(self, iso_path):
-        """获取Windows下的ISO挂载点"""
-        cmd = ["powershell", "-Command", 
-               f"Get-DiskImage -ImagePath '{iso_path}' | Get-Volume | Select-Object -ExpandProperty DriveLetter"]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        if result.returncode == 0 and result.stdout.strip():
-            drive_letter = result.stdout.strip()
-            return f"{drive_letter}:\\"
-        else:
-            raise Exception("无法获取Windows ISO挂载点")
+        def open_stage(context):
+            # 直接解析ISO文件系统，不需要挂载
+            context.state["iso_image"] = self.catalog_cache.open(iso_path)
+            
+        def prepare_stage(context):
+            self.prepare_usb_device(usb_device)
+            
+        def copy_stage(context):
+            progress = lambda done, total: context.progress(done / total if total else 1.0, done, total)
+            stats = self.copy_iso_contents(context.state["iso_image"], usb_device, progress,
+                                           context.cancel_token, pe_iso_path if include_pe else None)
+            if stats is not None:
+                for warning in stats.warnings:
+                    context.status(warning, "warning")
+                context.status(stats.describe())
+            
+        def bootloader_stage(context):
+            self.install_bootloader(usb_device, context.state["iso_image"])
+            
+        def pe_stage(context):
+            self.integrate_pe_tools(pe_iso_path, usb_device)
+            
+        stages = [
+            Stage("open", open_stage, title="读取ISO目录"),
+            Stage("prepare", prepare_stage, title="准备USB设备"),
+            Stage("copy", copy_stage, requires=("open", "prepare"), weight=4, title="复制ISO内容"),
+            Stage("bootloader", bootloader_stage, requires=("copy",), title="安装引导加载器"),
+        ]
+        # 如果有PE文件，集成PE工具
+        if include_pe and self.system != "Linux":
+            stages.append(Stage("pe", pe_stage, requires=("bootloader",), weight=2, title="集成PE工具"))
+        return Pipeline(stages, self.bus)
             
     def prepare_usb_device(self, usb_device):
         """准备USB设备"""
@@ -115,37 +114,20 @@ class BootloaderManager:
             pass  # 忽略卸载错误
             
     def create_partition_table(self, device):
-        """创建分区表"""
-        # 创建GPT分区表
-        cmd = ["sudo", "parted", device, "--script", "mklabel", "gpt"]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        if result.returncode != 0:
-            raise Exception(f"创建分区表失败: {result.stderr}")
-            
-        # 创建EFI系统分区
-        cmd = ["sudo", "parted", device, "--script", "mkpart", "primary", "fat32", "1MiB", "100MiB"]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        if result.returncode != 0:
-            raise Exception(f"创建EFI分区失败: {result.stderr}")
-            
-        # 创建主数据分区
-        cmd = ["sudo", "parted", device, "--script", "mkpart", "primary", "fat32", "100MiB", "100%"]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        if result.returncode != 0:
-            raise Exception(f"创建数据分区失败: {result.stderr}")
-            
-        # 设置启动标志
-        cmd = ["sudo", "parted", device, "--script", "set", "1", "esp", "on"]
-        subprocess.run(cmd, capture_output=True, text=True)
-        
-        # 格式化分区
-        efi_partition = f"{device}1"
-        data_partition = f"{device}2"
-        
-        subprocess.run(["sudo", "mkfs.fat", "-F32", efi_partition], 
-                      capture_output=True, text=True)
-        subprocess.run(["sudo", "mkfs.fat", "-F32", data_partition], 
-                      capture_output=True, text=True)
+        """创建GPT分区表：EFI系统分区（格式化为FAT32）和占用其余空间的数据分区；
+        分区表和EFI分区的文件系统在内存中生成后直接写入，只重新读取一次分区表"""
+        fd, _ = open_device(device)
+        try:
+            table = PartitionTable.for_device(fd, "gpt")
+            table.add(EFI_PARTITION_SIZE, kind="esp", name="EFI System Partition", label="EFI")
+            # 数据分区的文件系统在复制阶段直接生成（见write_data_partition）
+            table.add(kind="fat32", name="ISO Data")
+            reread = table.commit(fd)
+        finally:
+            os.close(fd)
+        if reread:
+            # 等待udev创建分区节点，之后的阶段按分区路径打开和挂载
+            wait_for_partitions(device, len(table.partitions))
                       
     def format_usb_windows(self, usb_device):
         """Windows下格式化USB设备"""
@@ -169,51 +151,78 @@ exit
         if result.returncode != 0:
             raise Exception(f"格式化USB失败: {result.stderr}")
             
-    def copy_iso_contents(self, iso_mount_point, usb_device):
-        """复制ISO内容到USB"""
+    def copy_iso_contents(self, iso_image, usb_device, progress_callback=None, cancel_token=None,
+                          pe_iso_path=None):
+        """把ISO内容写入USB数据分区，返回复制统计（CopyStats）"""
         if self.system == "Linux":
-            usb_mount_point = os.path.join(self.temp_dir, "usb_mount")
-            os.makedirs(usb_mount_point, exist_ok=True)
-            
-            # 挂载USB数据分区
-            data_partition = f"{usb_device}2"
-            cmd = ["sudo", "mount", data_partition, usb_mount_point]
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            if result.returncode != 0:
-                raise Exception(f"挂载USB失败: {result.stderr}")
-                
-            # 复制文件
-            cmd = ["sudo", "cp", "-r", f"{iso_mount_point}/*", usb_mount_point]
-            result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-            if result.returncode != 0:
-                raise Exception(f"复制文件失败: {result.stderr}")
-                
-            # 卸载USB
-            subprocess.run(["sudo", "umount", usb_mount_point], 
-                          capture_output=True, text=True)
+            return self.write_data_partition(iso_image, partition_path(usb_device, 2), progress_callback, cancel_token,
+                                             pe_iso_path)
                           
         elif self.system == "Windows":
-            # Windows下直接复制
-            cmd = ["xcopy", f"{iso_mount_point}\\*", f"{usb_device}\\", "/E", "/H", "/Y"]
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            if result.returncode != 0:
-                raise Exception(f"复制文件失败: {result.stderr}")
+            # Windows下直接解压到盘符
+            return iso_image.extract("/", f"{usb_device}\\", progress_callback, cancel_token)
+        return None
+        
+    def write_data_partition(self, iso_image, data_partition, progress_callback=None, cancel_token=None,
+                             pe_iso_path=None):
+        """在内存中排好FAT32文件系统（ISO内容，可选PE放在/PE下），整个分区一次顺序写出，
+        不需要mkfs、挂载和逐个复制文件"""
+        start_time = time.monotonic()
+        fd, _ = open_device(data_partition)
+        pe_image = None
+        try:
+            builder = Fat32Builder(get_device_size(fd), label=iso_image.volume_id or "ISO_WRITER",
+                                   hidden_sectors=partition_start_sector(data_partition))
+            builder.add_image(iso_image)
+            if pe_iso_path:
+                pe_image = self.catalog_cache.open(pe_iso_path)
+                builder.add_image(pe_image, "/", "/PE")
+            builder.layout()
+            builder.write(fd, 0, progress_callback, cancel_token)
+        finally:
+            os.close(fd)
+            if pe_image is not None:
+                pe_image.close()
+        stats = CopyStats()
+        for path, count in builder.split_files:
+            stats.warnings.append(f"{path} 超过FAT32单文件上限，已切分为 {count} 个分卷")
+        stats.files = builder.file_count
+        stats.bytes = builder.data_bytes
+        stats.elapsed = time.monotonic() - start_time
+        return stats
+        
+    def mount_data_partition(self, usb_device):
+        """挂载USB数据分区，返回挂载点；以普通用户运行时挂载为当前用户所有，解压无需sudo"""
+        usb_mount_point = os.path.join(self.temp_dir, "usb_mount")
+        os.makedirs(usb_mount_point, exist_ok=True)
+        
+        data_partition = partition_path(usb_device, 2)
+        cmd = ["sudo", "mount", *user_mount_options(), data_partition, usb_mount_point]
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise Exception(f"挂载USB失败: {result.stderr}")
+        return usb_mount_point
+        
+    def copy_tree(self, source_dir, target_dir, progress_callback=None, cancel_token=None):
+        """把source_dir下的所有内容（含隐藏文件）复制到target_dir，返回复制统计"""
+        copier = FileCopier(progress_callback=progress_callback, cancel_token=cancel_token)
+        return copier.copy_directory(source_dir, target_dir)
                 
-    def install_bootloader(self, usb_device, iso_mount_point):
+    def install_bootloader(self, usb_device, iso_image):
         """安装引导加载器"""
         if self.system == "Linux":
-            self.install_grub_linux(usb_device, iso_mount_point)
+            self.install_grub_linux(usb_device, iso_image)
         elif self.system == "Windows":
-            self.install_bootloader_windows(usb_device, iso_mount_point)
+            self.install_bootloader_windows(usb_device, iso_image)
             
-    def install_grub_linux(self, usb_device, iso_mount_point):
+    def install_grub_linux(self, usb_device, iso_image):
         """Linux下安装GRUB"""
         try:
             # 挂载EFI分区
             efi_mount_point = os.path.join(self.temp_dir, "efi_mount")
             os.makedirs(efi_mount_point, exist_ok=True)
             
-            efi_partition = f"{usb_device}1"
+            efi_partition = partition_path(usb_device, 1)
             cmd = ["sudo", "mount", efi_partition, efi_mount_point]
             subprocess.run(cmd, capture_output=True, text=True)
             
@@ -224,7 +233,7 @@ exit
             result = subprocess.run(cmd, capture_output=True, text=True)
             
             # 创建GRUB配置
-            self.create_grub_config(efi_mount_point, iso_mount_point)
+            self.create_grub_config(efi_mount_point, iso_image)
             
             # 卸载EFI分区
             subprocess.run(["sudo", "umount", efi_mount_point], 
@@ -238,7 +247,7 @@ exit
     def install_syslinux(self, usb_device):
         """安装Syslinux引导加载器"""
         try:
-            data_partition = f"{usb_device}2"
+            data_partition = partition_path(usb_device, 2)
             cmd = ["sudo", "syslinux", "-i", data_partition]
             result = subprocess.run(cmd, capture_output=True, text=True)
             
@@ -249,99 +258,73 @@ exit
         except Exception as e:
             print(f"安装Syslinux失败: {e}")
             
-    def create_grub_config(self, efi_mount_point, iso_mount_point):
+    def create_grub_config(self, efi_mount_point, iso_image):
         """创建GRUB配置文件"""
         grub_dir = os.path.join(efi_mount_point, "EFI", "BOOT")
         os.makedirs(grub_dir, exist_ok=True)
         
         grub_cfg = os.path.join(grub_dir, "grub.cfg")
         
-        config_content = """
+        # 从ISO目录索引中找到内核和initrd的实际位置，找不到时使用常见路径
+        boot_files = iso_image.catalog.boot_files() if iso_image.catalog is not None else {}
+        kernel = boot_files.get("kernel", "/boot/vmlinuz")
+        initrd = boot_files.get("initrd", "/boot/initrd.img")
+        
+        config_content = f"""
 set timeout=10
 set default=0
 
-menuentry "Boot from USB" {
-    search --set=root --file /boot/vmlinuz
-    linux /boot/vmlinuz boot=live
-    initrd /boot/initrd.img
-}
+menuentry "Boot from USB" {{
+    search --set=root --file {kernel}
+    linux {kernel} boot=live
+    initrd {initrd}
+}}
 
-menuentry "Boot from ISO (if available)" {
+menuentry "Boot from ISO (if available)" {{
     search --set=root --file /boot.iso
     loopback loop /boot.iso
     linux (loop)/boot/vmlinuz boot=live iso-scan/filename=/boot.iso
     initrd (loop)/boot/initrd.img
-}
+}}
 """
         
         with open(grub_cfg, 'w') as f:
             f.write(config_content)
             
-    def install_bootloader_windows(self, usb_device, iso_mount_point):
+    def install_bootloader_windows(self, usb_device, iso_image):
         """Windows下安装引导加载器"""
         # 检查是否有现有的引导文件
         boot_files = ["bootmgr", "boot", "efi"]
         
         for boot_file in boot_files:
-            src_path = os.path.join(iso_mount_point, boot_file)
-            if os.path.exists(src_path):
-                dst_path = os.path.join(usb_device, boot_file)
-                if os.path.isdir(src_path):
-                    shutil.copytree(src_path, dst_path, dirs_exist_ok=True)
-                else:
-                    shutil.copy2(src_path, dst_path)
+            if iso_image.exists(boot_file):
+                entry = iso_image.stat(boot_file)
+                target = os.path.join(usb_device, entry.name) if entry.is_dir else usb_device
+                iso_image.extract(boot_file, target)
                     
     def integrate_pe_tools(self, pe_iso_path, usb_device):
         """集成PE工具"""
         try:
-            # 挂载PE ISO
-            pe_mount_point = self.mount_iso(pe_iso_path)
-            
-            # 创建PE目录
-            if self.system == "Linux":
-                usb_mount_point = os.path.join(self.temp_dir, "usb_mount")
-                os.makedirs(usb_mount_point, exist_ok=True)
-                
-                data_partition = f"{usb_device}2"
-                cmd = ["sudo", "mount", data_partition, usb_mount_point]
-                subprocess.run(cmd, capture_output=True, text=True)
-                
-                pe_dir = os.path.join(usb_mount_point, "PE")
-                os.makedirs(pe_dir, exist_ok=True)
-                
-                # 复制PE文件
-                cmd = ["sudo", "cp", "-r", f"{pe_mount_point}/*", pe_dir]
-                subprocess.run(cmd, shell=True, capture_output=True, text=True)
-                
-                subprocess.run(["sudo", "umount", usb_mount_point], 
-                              capture_output=True, text=True)
-                              
-            elif self.system == "Windows":
-                pe_dir = os.path.join(usb_device, "PE")
-                os.makedirs(pe_dir, exist_ok=True)
-                
-                cmd = ["xcopy", f"{pe_mount_point}\\*", f"{pe_dir}\\", "/E", "/H", "/Y"]
-                subprocess.run(cmd, capture_output=True, text=True)
-                
-            # 卸载PE ISO
-            self.cleanup(pe_mount_point)
-            
+            # 直接从PE ISO解压，不需要挂载
+            with self.catalog_cache.open(pe_iso_path) as pe_image:
+                if self.system == "Linux":
+                    usb_mount_point = self.mount_data_partition(usb_device)
+                    try:
+                        pe_image.extract("/", os.path.join(usb_mount_point, "PE"))
+                    finally:
+                        subprocess.run(["sudo", "umount", usb_mount_point], 
+                                      capture_output=True, text=True)
+                                  
+                elif self.system == "Windows":
+                    pe_image.extract("/", os.path.join(usb_device, "PE"))
+                    
         except Exception as e:
             print(f"集成PE工具失败: {e}")
             
-    def cleanup(self, mount_point=None):
-        """清理临时文件和挂载点"""
-        if mount_point:
-            if self.system == "Linux":
-                subprocess.run(["sudo", "umount", mount_point], 
-                              capture_output=True, text=True)
-            elif self.system == "Windows":
-                # Windows下卸载ISO
-                cmd = ["powershell", "-Command", f"Dismount-DiskImage -ImagePath '{mount_point}'"]
-                subprocess.run(cmd, capture_output=True, text=True)
-            elif self.system == "Darwin":
-                subprocess.run(["hdiutil", "detach", mount_point], 
-                              capture_output=True, text=True)
+    def cleanup(self, iso_image=None):
+        """关闭ISO并清理临时文件"""
+        if iso_image is not None:
+            iso_image.close()
                               
         if self.temp_dir and os.path.exists(self.temp_dir):
             shutil.rmtree(self.temp_dir, ignore_errors=True)
@@ -0,0 +1,106 @@
+"""
+写入前擦除设备
+对整个设备（或镜像之后未被覆盖的区间）发出BLKDISCARD，让闪存控制器回收所有块，重复使用的U盘之后的写入不再变慢；
+设备不支持时依次回退为BLKZEROOUT和多线程写零。按段执行，可报告进度和取消，并统计每种方式的速度
+"""
+
+import os
+import time
+
+from blockdev_utils import datasync, fill_range, get_device_size
+from device_inventory import format_size, read_sysfs
+from write_engine import open_device
+
+# 每次ioctl或写零的区间，段与段之间报告进度、检查取消
+ERASE_CHUNK_SIZE = 1024 * 1024 * 1024  # 1GB
+ZERO_FILL_WORKERS = 4
+# 只擦除镜像之外的区间时，起点按1MiB对齐
+ERASE_ALIGNMENT = 1024 * 1024
+# 擦除范围：all为整个设备，unused为镜像末尾之后的区间
+ERASE_SCOPES = ("all", "unused")
+METHOD_NAMES = {"discard": "TRIM（BLKDISCARD）", "zeroout": "设备清零（BLKZEROOUT）", "write": "写入全零"}
+
+
+def discard_zeroes_data(device):
+    """设备声明丢弃后的块读出为零时，TRIM之后无需再清零"""
+    name = os.path.basename(os.path.realpath(device))
+    return read_sysfs(f"/sys/block/{name}/queue/discard_zeroes_data") == "1"
+
+
+def unused_start(image_size):
+    """镜像之后未被覆盖的区间的起点"""
+    return -(-image_size // ERASE_ALIGNMENT) * ERASE_ALIGNMENT
+
+
+class EraseResult:
+    """一次擦除的统计：每种方式处理的字节数和用时"""
+
+    def __init__(self):
+        # 方式 -> [字节数, 用时]
+        self.methods = {}
+        self.bytes = 0
+        self.elapsed = 0.0
+        # 擦除后的区间是否保证读出为零（此时跳过全零块写入时无需再清零）
+        self.zeroed = False
+
+    def add(self, method, length, seconds):
+        record = self.methods.setdefault(method, [0, 0.0])
+        record[0] += length
+        record[1] += seconds
+        self.bytes += length
+
+    @property
+    def rate(self):
+        return self.bytes / self.elapsed if self.elapsed > 0 else 0.0
+
+    def describe(self):
+        parts = []
+        for method, (length, seconds) in self.methods.items():
+            rate = length / seconds if seconds > 0 else 0.0
+            parts.append(f"{METHOD_NAMES[method]} {format_size(length)}，{rate / (1024 * 1024):.0f} MB/s")
+        return f"已擦除 {format_size(self.bytes)}，用时 {self.elapsed:.1f} 秒（{'；'.join(parts)}）"
+
+
+class DeviceEraser:
+    """按段擦除设备区间；首选方式不被支持时自动降级，降级后剩余的段不再尝试"""
+
+    def __init__(self, method="discard", chunk_size=ERASE_CHUNK_SIZE, workers=ZERO_FILL_WORKERS,
+                 progress_callback=None, cancel_token=None):
+        if method not in METHOD_NAMES:
+            raise Exception(f"不支持的擦除方式: {method}")
+        self.method = method
+        self.chunk_size = chunk_size
+        self.workers = workers
+        # progress_callback(已擦除字节数, 总字节数)
+        self.progress_callback = progress_callback
+        self.cancel_token = cancel_token
+
+    def erase(self, device, start=0, end=None):
+        """擦除设备的[start, end)区间，end为None时到设备末尾，返回EraseResult"""
+        result = EraseResult()
+        start_time = time.monotonic()
+        fd, _ = open_device(device)
+        try:
+            size = get_device_size(fd)
+            end = size if end is None else min(end, size)
+            total = max(0, end - start)
+            method = self.method
+            offset = start
+            while offset < end:
+                if self.cancel_token is not None:
+                    self.cancel_token.check()
+                length = min(self.chunk_size, end - offset)
+                chunk_start = time.monotonic()
+                method = fill_range(fd, offset, length, method, self.workers)
+                if method == "write":
+                    # 写零经过页缓存，刷写后计时才反映设备的真实速度
+                    datasync(fd)
+                result.add(method, length, time.monotonic() - chunk_start)
+                offset += length
+                if self.progress_callback:
+                    self.progress_callback(offset - start, total)
+        finally:
+            os.close(fd)
+        result.elapsed = time.monotonic() - start_time
+        result.zeroed = bool(result.methods) and ("discard" not in result.methods or discard_zeroes_data(device))
+        return result
@@ -0,0 +1,357 @@
+"""
+块设备清单
+直接读取/sys/block、udev数据库和/proc/self/mountinfo，维护结构化的设备表（厂商、型号、序列号、
+容量、可移动、总线类型、分区和挂载状态）；通过内核uevent（netlink）监听热插拔增量更新，
+无法使用netlink时退回定时轮询。扫描不需要启动lsblk子进程
+"""
+
+import os
+import socket
+import threading
+
+from pipeline import EventBus
+
+SYS_BLOCK = "/sys/block"
+UDEV_DATA_DIR = "/run/udev/data"
+MOUNTINFO_PATH = "/proc/self/mountinfo"
+NETLINK_KOBJECT_UEVENT = 15
+# 内核uevent广播组
+UEVENT_GROUP_KERNEL = 1
+POLL_INTERVAL = 2.0
+
+
+def read_sysfs(path):
+    try:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def find_serial(device_dir):
+    """USB序列号位于上层的USB设备目录中，逐级向上查找"""
+    parent = device_dir
+    while parent not in ("/", "/sys", ""):
+        serial = read_sysfs(os.path.join(parent, "serial"))
+        if serial:
+            return serial
+        parent = os.path.dirname(parent)
+    return ""
+
+
+def read_udev_properties(dev_number):
+    """读取udev数据库中设备的属性（E:开头的行）"""
+    properties = {}
+    try:
+        with open(os.path.join(UDEV_DATA_DIR, f"b{dev_number}"), "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                if line.startswith("E:") and "=" in line:
+                    key, _, value = line[2:].rstrip("\n").partition("=")
+                    properties[key] = value
+    except OSError:
+        pass
+    return properties
+
+
+def _unescape_mount_path(path):
+    """mountinfo中的空格等字符以八进制转义"""
+    if "\\" not in path:
+        return path
+    result = []
+    index = 0
+    while index < len(path):
+        if path[index] == "\\" and path[index + 1:index + 4].isdigit():
+            result.append(chr(int(path[index + 1:index + 4], 8)))
+            index += 4
+        else:
+            result.append(path[index])
+            index += 1
+    return "".join(result)
+
+
+def read_mounts(mountinfo_path=MOUNTINFO_PATH):
+    """返回{设备号"主:次": [挂载点]}"""
+    mounts = {}
+    try:
+        with open(mountinfo_path, "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                fields = line.split(" - ", 1)[0].split()
+                if len(fields) >= 5:
+                    mounts.setdefault(fields[2], []).append(_unescape_mount_path(fields[4]))
+    except OSError:
+        pass
+    return mounts
+
+
+def format_size(size):
+    if size >= 1024 ** 3:
+        return f"{size / 1024 ** 3:.1f}GB"
+    return f"{size / 1024 ** 2:.0f}MB"
+
+
+class BlockDevice:
+    """一个磁盘设备及其分区"""
+
+    def __init__(self, name, size=0, vendor="", model="", serial="", removable=False, read_only=False,
+                 transport="", sys_path="", dev_number="", partitions=None):
+        self.name = name
+        self.path = f"/dev/{name}"
+        self.size = size
+        self.vendor = vendor
+        self.model = model
+        self.serial = serial
+        self.removable = removable
+        self.read_only = read_only
+        # 总线类型：usb、ata、nvme、mmc等
+        self.transport = transport
+        # sysfs中的设备路径，用于判断所在的USB集线器
+        self.sys_path = sys_path
+        self.dev_number = dev_number
+        # [{"name", "path", "size", "dev_number", "mountpoints"}]
+        self.partitions = partitions or []
+        self.mountpoints = []
+
+    @property
+    def is_usb(self):
+        return self.transport == "usb"
+
+    @property
+    def mounted(self):
+        return bool(self.mountpoints) or any(part["mountpoints"] for part in self.partitions)
+
+    def apply_mounts(self, mounts):
+        self.mountpoints = mounts.get(self.dev_number, [])
+        for part in self.partitions:
+            part["mountpoints"] = mounts.get(part["dev_number"], [])
+
+    def signature(self):
+        """不含挂载状态的设备特征，用于判断设备是否变化"""
+        return (self.size, self.vendor, self.model, self.serial, self.removable, self.read_only,
+                self.transport, tuple((part["name"], part["size"]) for part in self.partitions))
+
+    def display_name(self):
+        description = " ".join(part for part in (self.vendor, self.model) if part) or "USB设备"
+        return f"{description} ({format_size(self.size)})"
+
+    def to_dict(self):
+        """与list_usb_devices返回的格式兼容，附带完整信息"""
+        return {
+            "path": self.path,
+            "size": format_size(self.size),
+            "name": self.display_name(),
+            "bytes": self.size,
+            "vendor": self.vendor,
+            "model": self.model,
+            "serial": self.serial,
+            "removable": self.removable,
+            "read_only": self.read_only,
+            "transport": self.transport,
+            "mounted": self.mounted,
+            "partitions": [{"path": part["path"], "size": part["size"], "mountpoints": part["mountpoints"]}
+                           for part in self.partitions],
+        }
+
+
+def read_block_device(name, sys_block=SYS_BLOCK):
+    """从sysfs和udev读取一个磁盘，虚拟设备（loop、ram等没有device链接的）或已移除时返回None"""
+    sys_dir = os.path.join(sys_block, name)
+    if not os.path.exists(os.path.join(sys_dir, "device")):
+        return None
+    size_text = read_sysfs(os.path.join(sys_dir, "size"))
+    if not size_text.isdigit():
+        return None
+    sys_path = os.path.realpath(sys_dir)
+    device_dir = os.path.realpath(os.path.join(sys_dir, "device"))
+    dev_number = read_sysfs(os.path.join(sys_dir, "dev"))
+    udev = read_udev_properties(dev_number) if dev_number else {}
+
+    transport = udev.get("ID_BUS", "")
+    if "/usb" in sys_path:
+        # 经USB转接的SATA/NVMe在udev中可能标为ata/scsi，以拓扑为准
+        transport = "usb"
+    elif not transport:
+        if name.startswith("nvme"):
+            transport = "nvme"
+        elif name.startswith("mmcblk"):
+            transport = "mmc"
+
+    partitions = []
+    try:
+        children = sorted(os.listdir(sys_dir))
+    except OSError:
+        children = []
+    for child in children:
+        part_dir = os.path.join(sys_dir, child)
+        if child.startswith(name) and os.path.exists(os.path.join(part_dir, "partition")):
+            part_size = read_sysfs(os.path.join(part_dir, "size"))
+            partitions.append({
+                "name": child,
+                "path": f"/dev/{child}",
+                "size": int(part_size) * 512 if part_size.isdigit() else 0,
+                "dev_number": read_sysfs(os.path.join(part_dir, "dev")),
+                "mountpoints": [],
+            })
+
+    return BlockDevice(
+        name,
+        size=int(size_text) * 512,
+        vendor=read_sysfs(os.path.join(device_dir, "vendor")) or udev.get("ID_VENDOR", ""),
+        model=read_sysfs(os.path.join(device_dir, "model")) or udev.get("ID_MODEL", "").replace("_", " "),
+        serial=udev.get("ID_SERIAL_SHORT") or find_serial(device_dir),
+        removable=read_sysfs(os.path.join(sys_dir, "removable")) == "1",
+        read_only=read_sysfs(os.path.join(sys_dir, "ro")) == "1",
+        transport=transport,
+        sys_path=sys_path,
+        dev_number=dev_number,
+        partitions=partitions,
+    )
+
+
+class DeviceInventory:
+    """缓存的设备表；启动监听后由热插拔事件增量更新，并在事件总线上发布
+    device_added、device_removed、device_changed事件（字段device为BlockDevice）"""
+
+    def __init__(self, sys_block=SYS_BLOCK):
+        self.sys_block = sys_block
+        self.bus = EventBus()
+        self._devices = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        # 监听方式：netlink、poll，未启动时为None
+        self.monitor_mode = None
+
+    def scan(self, usb_only=False):
+        """重新读取所有磁盘，返回设备列表"""
+        try:
+            names = os.listdir(self.sys_block)
+        except OSError:
+            names = []
+        with self._lock:
+            known = set(self._devices)
+        for name in sorted(set(names) | known):
+            self.refresh(name)
+        return self.devices(usb_only, rescan=False)
+
+    def refresh(self, name):
+        """重新读取单个磁盘并与缓存比较，发布相应事件"""
+        device = read_block_device(name, self.sys_block)
+        with self._lock:
+            previous = self._devices.get(name)
+            if device is None:
+                self._devices.pop(name, None)
+            else:
+                self._devices[name] = device
+        if device is None:
+            if previous is not None:
+                self.bus.publish("device_removed", device=previous)
+        elif previous is None:
+            self.bus.publish("device_added", device=device)
+        elif previous.signature() != device.signature():
+            self.bus.publish("device_changed", device=device)
+        return device
+
+    def devices(self, usb_only=True, rescan=None):
+        """返回设备列表；未启动监听时每次重新扫描（只读sysfs，很快），挂载状态总是现读"""
+        if rescan is None:
+            rescan = self.monitor_mode is None
+        if rescan:
+            return self.scan(usb_only)
+        mounts = read_mounts()
+        with self._lock:
+            devices = sorted(self._devices.values(), key=lambda device: device.name)
+        for device in devices:
+            device.apply_mounts(mounts)
+        return [device for device in devices if device.is_usb or not usb_only]
+
+    def get(self, device):
+        """按设备路径或名称查找"""
+        name = os.path.basename(os.path.realpath(device)) if device.startswith("/") else device
+        with self._lock:
+            return self._devices.get(name)
+
+    # ------------------------------------------------------------------
+    # 热插拔监听
+
+    def start_monitor(self):
+        """开始监听热插拔，返回使用的方式（netlink或poll）"""
+        if self._thread is not None:
+            return self.monitor_mode
+        self.scan()
+        self._stop.clear()
+        sock = None
+        if hasattr(socket, "AF_NETLINK"):
+            try:
+                sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+                sock.bind((0, UEVENT_GROUP_KERNEL))
+                sock.settimeout(0.5)
+            except OSError:
+                # 容器等环境中可能不允许订阅uevent
+                if sock is not None:
+                    sock.close()
+                sock = None
+        if sock is not None:
+            self.monitor_mode = "netlink"
+            target = lambda: self._netlink_loop(sock)
+        else:
+            self.monitor_mode = "poll"
+            target = self._poll_loop
+        self._thread = threading.Thread(target=target, name="device-monitor", daemon=True)
+        self._thread.start()
+        return self.monitor_mode
+
+    def stop_monitor(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+        self.monitor_mode = None
+
+    def _netlink_loop(self, sock):
+        try:
+            while not self._stop.is_set():
+                try:
+                    data = sock.recv(65536)
+                except socket.timeout:
+                    continue
+                except OSError:
+                    # 接收缓冲区溢出会丢失事件，整体重新扫描一次
+                    self.scan()
+                    continue
+                self._handle_uevent(data)
+        finally:
+            sock.close()
+
+    def _handle_uevent(self, data):
+        fields = data.split(b"\0")
+        env = {}
+        for field in fields[1:]:
+            key, sep, value = field.partition(b"=")
+            if sep:
+                env[key.decode("ascii", "replace")] = value.decode("utf-8", "replace")
+        if env.get("SUBSYSTEM") != "block":
+            return
+        devpath = env.get("DEVPATH", "")
+        name = os.path.basename(devpath)
+        if env.get("DEVTYPE") == "partition":
+            # 分区变化时更新所属磁盘
+            name = os.path.basename(os.path.dirname(devpath))
+        if name:
+            self.refresh(name)
+
+    def _poll_loop(self):
+        while not self._stop.wait(POLL_INTERVAL):
+            self.scan()
+
+
+_inventory = None
+_inventory_lock = threading.Lock()
+
+
+def get_inventory():
+    """进程内共享的设备表"""
+    global _inventory
+    with _inventory_lock:
+        if _inventory is None:
+            _inventory = DeviceInventory()
+        return _inventory
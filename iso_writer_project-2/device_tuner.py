@@ -0,0 +1,169 @@
+"""
+设备写入参数自动调优
+用ISO开头的数据分段试写，比较不同块大小和在途写请求数下的实际落盘速度，选出最快的组合；
+试写的数据就是ISO本身，调优结束后从试写结束的位置继续写入，不浪费写入量。
+结果按设备型号和序列号缓存，同一型号的设备再次写入时直接使用
+"""
+
+import os
+import json
+import time
+import threading
+
+from device_inventory import find_serial, read_sysfs
+from hash_cache import atomic_write, get_cache_dir
+from write_engine import ISOWriteEngine
+
+MB = 1024 * 1024
+TUNE_BLOCK_SIZES = (1 * MB, 2 * MB, 4 * MB, 8 * MB, 16 * MB)
+TUNE_WRITE_DEPTHS = (1, 2, 4)
+# 每个组合试写的数据量，需为所有候选块大小的整数倍
+TRIAL_BYTES = 32 * MB
+# 速度提升不足该比例时视为测量误差，保留先测的（更小的）组合
+MIN_IMPROVEMENT = 1.05
+
+
+def device_identity(device):
+    """由sysfs中的厂商、型号和序列号组成设备标识，无法识别时（非Linux、普通文件）返回None"""
+    name = os.path.basename(os.path.realpath(device))
+    sys_dir = os.path.join("/sys/class/block", name)
+    if not os.path.isdir(sys_dir):
+        return None
+    if os.path.exists(os.path.join(sys_dir, "partition")):
+        # 分区使用其所在磁盘的信息
+        sys_dir = os.path.dirname(os.path.realpath(sys_dir))
+
+    device_dir = os.path.realpath(os.path.join(sys_dir, "device"))
+    vendor = read_sysfs(os.path.join(device_dir, "vendor"))
+    model = read_sysfs(os.path.join(device_dir, "model"))
+    serial = find_serial(device_dir)
+
+    if not (vendor or model or serial):
+        return None
+    return " ".join(part for part in (vendor, model, serial) if part)
+
+
+class TuningResult:
+    """调优结果"""
+
+    def __init__(self, block_size, write_depth, rate, end_offset=0, cached=False):
+        self.block_size = block_size
+        self.write_depth = write_depth
+        # 测得的落盘速度（字节/秒）
+        self.rate = rate
+        # 试写结束的位置，正式写入从这里继续
+        self.end_offset = end_offset
+        self.cached = cached
+
+    def describe(self):
+        text = f"块大小 {self.block_size // MB} MB，在途写请求 {self.write_depth}"
+        if self.rate:
+            text += f"，{self.rate / MB:.1f} MB/s"
+        return text
+
+
+class TuningCache:
+    """按设备标识缓存调优结果"""
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or get_cache_dir("tuning")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.path = os.path.join(self.cache_dir, "devices.json")
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, identity):
+        """查找设备的调优结果，未缓存时返回None"""
+        if not identity:
+            return None
+        with self._lock:
+            entry = self._load().get(identity)
+        if not entry:
+            return None
+        try:
+            return TuningResult(int(entry["block_size"]), int(entry["write_depth"]),
+                                float(entry.get("rate", 0)), cached=True)
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def put(self, identity, result):
+        if not identity:
+            return
+        with self._lock:
+            entries = self._load()
+            entries[identity] = {
+                "block_size": result.block_size,
+                "write_depth": result.write_depth,
+                "rate": result.rate,
+                "updated": time.time(),
+            }
+            atomic_write(self.path, json.dumps(entries, indent=1, ensure_ascii=False).encode("utf-8"))
+
+
+class DeviceTuner:
+    """在写入开始的几秒内试写ISO开头的数据，选出最快的块大小和在途写请求数"""
+
+    def __init__(self, block_sizes=TUNE_BLOCK_SIZES, write_depths=TUNE_WRITE_DEPTHS,
+                 trial_bytes=TRIAL_BYTES, direct_io=True, cancel_token=None,
+                 progress_callback=None, checkpoint_callback=None):
+        self.block_sizes = tuple(block_sizes)
+        # 经过页缓存写入时在途请求由内核回写决定，只调块大小
+        self.write_depths = tuple(write_depths) if direct_io else (1,)
+        self.trial_bytes = trial_bytes
+        self.direct_io = direct_io
+        self.cancel_token = cancel_token
+        # progress_callback(已写入字节数, ISO总字节数)
+        self.progress_callback = progress_callback
+        self.checkpoint_callback = checkpoint_callback
+        # 每次试写的结果[(块大小, 在途写请求数, 速度)]
+        self.trials = []
+
+    def required_bytes(self):
+        """完成全部试写需要的ISO数据量"""
+        extra_depths = len([depth for depth in self.write_depths if depth > 1])
+        return self.trial_bytes * (len(self.block_sizes) + extra_depths)
+
+    def tune(self, iso_file, device, start_offset=0):
+        """依次试写各个组合，返回TuningResult；ISO剩余部分不足以完成试写时返回None"""
+        iso_size = os.path.getsize(iso_file)
+        if iso_size - start_offset < self.required_bytes() * 2:
+            return None
+        self.trials = []
+        offset = start_offset
+
+        # 先在单个在途请求下比较块大小，再用最佳块大小比较在途请求数
+        best = None
+        for block_size in self.block_sizes:
+            offset, best = self._trial(iso_file, device, iso_size, offset, block_size, 1, best)
+        for depth in self.write_depths:
+            if depth > 1:
+                offset, best = self._trial(iso_file, device, iso_size, offset, best.block_size, depth, best)
+
+        best.end_offset = offset
+        return best
+
+    def _trial(self, iso_file, device, iso_size, offset, block_size, write_depth, best):
+        """试写一段，返回(新的位置, 当前最佳结果)"""
+        progress = None
+        if self.progress_callback:
+            progress = lambda done, total: self.progress_callback(done, iso_size)
+        engine = ISOWriteEngine(block_size=block_size, write_depth=write_depth, direct_io=self.direct_io,
+                                progress_callback=progress, cancel_token=self.cancel_token,
+                                checkpoint_callback=self.checkpoint_callback)
+        end = offset + self.trial_bytes
+        start_time = time.monotonic()
+        # 引擎结束时执行fsync，测得的是真正落盘的速度
+        engine.write(iso_file, device, offset, end)
+        elapsed = max(time.monotonic() - start_time, 1e-6)
+        rate = (end - offset) / elapsed
+        self.trials.append((block_size, write_depth, rate))
+        if best is None or rate > best.rate * MIN_IMPROVEMENT:
+            best = TuningResult(block_size, write_depth, rate)
+        return end, best
+
@@ -0,0 +1,493 @@
+"""
+FAT32文件系统直接生成
+在内存中排好FAT、目录项和每个文件的连续簇，然后把整个分区从头到尾顺序写到设备，
+不需要mkfs、挂载和逐个文件复制；超过FAT32单文件上限（4GB）的文件切分为多个分卷
+"""
+
+import os
+import time
+import array
+import struct
+
+from blockdev_utils import datasync
+from write_engine import write_all
+
+SECTOR_SIZE = 512
+RESERVED_SECTORS = 32
+FAT_COUNT = 2
+FSINFO_SECTOR = 1
+BACKUP_BOOT_SECTOR = 6
+ROOT_CLUSTER = 2
+# 数据区起点对齐到1MB，与闪存擦除块对齐
+DATA_ALIGNMENT = 1024 * 1024
+# FAT32要求的最少簇数
+MIN_CLUSTERS = 65525
+MAX_CLUSTERS = 0x0FFFFFF5
+END_OF_CHAIN = 0x0FFFFFFF
+# FAT32单个文件的最大长度
+MAX_FILE_SIZE = 0xFFFFFFFF
+WRITE_CHUNK_SIZE = 8 * 1024 * 1024  # 8MB
+
+ATTR_READ_ONLY = 0x01
+ATTR_VOLUME_ID = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_LONG_NAME = 0x0F
+DIR_ENTRY_SIZE = 32
+LFN_CHARS = 13
+
+# 短文件名允许的字符（其他字符替换为下划线）
+SHORT_NAME_CHARS = set("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!#$%&'()-@^_`{}~")
+
+
+def default_cluster_size(volume_size):
+    """与Windows格式化FAT32时的默认簇大小一致"""
+    if volume_size <= 8 * 1024 ** 3:
+        return 4096
+    if volume_size <= 16 * 1024 ** 3:
+        return 8192
+    if volume_size <= 32 * 1024 ** 3:
+        return 16384
+    return 32768
+
+
+def _fat_datetime(timestamp):
+    """转换为FAT目录项的(日期, 时间)"""
+    if timestamp is None:
+        timestamp = time.time()
+    t = time.localtime(max(timestamp, 315532800))  # 不早于1980年
+    if t.tm_year > 2107:
+        t = time.localtime(4354819199)
+    date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    clock = (t.tm_hour << 11) | (t.tm_min << 5) | (min(t.tm_sec, 59) // 2)
+    return date, clock
+
+
+def _short_name_checksum(short_name):
+    checksum = 0
+    for byte in short_name:
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + byte) & 0xFF
+    return checksum
+
+
+def _slice_sources(sources, start, length):
+    """截取源区间列表中[start, start+length)的部分"""
+    result = []
+    position = 0
+    for fd, offset, size in sources:
+        end = position + size
+        if end > start and position < start + length:
+            skip = max(0, start - position)
+            take = min(end, start + length) - position - skip
+            result.append((fd, None if offset is None else offset + skip, take))
+        position = end
+    return result
+
+
+class FatNode:
+    """待写入的文件或目录"""
+
+    __slots__ = ('name', 'is_dir', 'size', 'sources', 'mtime', 'children', 'cluster', 'short_name', 'order')
+
+    def __init__(self, name, is_dir, size=0, sources=None, mtime=None, order=0):
+        self.name = name
+        self.is_dir = is_dir
+        self.size = size
+        # 文件数据来源[(源fd, 源偏移, 长度)]，偏移为None表示全零
+        self.sources = sources or []
+        self.mtime = mtime
+        self.children = {} if is_dir else None
+        self.cluster = 0
+        self.short_name = None
+        # 数据写入顺序的排序键（ISO中为区间偏移）
+        self.order = order
+
+
+class _StreamWriter:
+    """把分区内容攒成大块后顺序写出"""
+
+    def __init__(self, fd, offset, total, chunk_size, progress_callback, cancel_token):
+        self.fd = fd
+        self.buffer = bytearray(chunk_size)
+        self.view = memoryview(self.buffer)
+        self.fill = 0
+        # 缓冲区开头对应的设备偏移
+        self.position = offset
+        self.start = offset
+        self.total = total
+        self.progress_callback = progress_callback
+        self.cancel_token = cancel_token
+
+    def _space(self):
+        if self.fill == len(self.buffer):
+            self.flush()
+        return len(self.buffer) - self.fill
+
+    def write(self, data):
+        data = memoryview(data)
+        while len(data):
+            length = min(self._space(), len(data))
+            self.view[self.fill:self.fill + length] = data[:length]
+            self.fill += length
+            data = data[length:]
+
+    def zeros(self, length):
+        while length > 0:
+            piece = min(self._space(), length)
+            self.view[self.fill:self.fill + piece] = bytes(piece)
+            self.fill += piece
+            length -= piece
+
+    def copy(self, fd, offset, length):
+        """从源fd读取数据直接放入缓冲区"""
+        while length > 0:
+            piece = min(self._space(), length)
+            target = self.view[self.fill:self.fill + piece]
+            if hasattr(os, 'preadv'):
+                got = os.preadv(fd, [target], offset)
+            else:
+                os.lseek(fd, offset, os.SEEK_SET)
+                data = os.read(fd, piece)
+                target[:len(data)] = data
+                got = len(data)
+            if got <= 0:
+                raise Exception("读取源文件失败：数据提前结束")
+            self.fill += got
+            offset += got
+            length -= got
+
+    def flush(self):
+        if self.cancel_token is not None:
+            self.cancel_token.check()
+        if self.fill:
+            write_all(self.fd, self.view[:self.fill], self.position)
+            self.position += self.fill
+            self.fill = 0
+        if self.progress_callback:
+            self.progress_callback(self.position - self.start, self.total)
+
+
+class Fat32Builder:
+    """生成完整的FAT32分区内容"""
+
+    def __init__(self, volume_size, cluster_size=None, label="ISO_WRITER", hidden_sectors=0,
+                 sector_size=SECTOR_SIZE):
+        self.sector_size = sector_size
+        self.total_sectors = min(volume_size // sector_size, 0xFFFFFFFF)
+        # 分区在磁盘上的起始扇区，写入引导扇区
+        self.hidden_sectors = hidden_sectors
+        self.label = label
+        self.root = FatNode("", True)
+        # 被切分的文件[(路径, 分卷数)]
+        self.split_files = []
+        self._order = 0
+        self._geometry(cluster_size or default_cluster_size(volume_size))
+        self._laid_out = False
+
+    def _geometry(self, cluster_size):
+        """确定每簇扇区数、FAT大小和数据区起点"""
+        while True:
+            sectors_per_cluster = cluster_size // self.sector_size
+            # 按不扣除FAT时的簇数估算FAT大小，略有富余
+            estimate = (self.total_sectors - RESERVED_SECTORS) // sectors_per_cluster + 2
+            fat_sectors = -(-estimate * 4 // self.sector_size)
+            reserved = RESERVED_SECTORS
+            data_start = reserved + FAT_COUNT * fat_sectors
+            align = max(DATA_ALIGNMENT // self.sector_size, sectors_per_cluster)
+            reserved += (-(self.hidden_sectors + data_start)) % align
+            data_start = reserved + FAT_COUNT * fat_sectors
+            clusters = (self.total_sectors - data_start) // sectors_per_cluster if self.total_sectors > data_start else 0
+            if clusters >= MIN_CLUSTERS or sectors_per_cluster == 1:
+                break
+            cluster_size //= 2
+        if clusters < MIN_CLUSTERS:
+            raise Exception("分区太小，无法创建FAT32文件系统")
+        self.sectors_per_cluster = sectors_per_cluster
+        self.cluster_size = sectors_per_cluster * self.sector_size
+        self.reserved_sectors = reserved
+        self.fat_sectors = fat_sectors
+        self.data_start = data_start * self.sector_size
+        self.cluster_count = min(clusters, MAX_CLUSTERS - 2)
+
+    # ------------------------------------------------------------------
+    # 添加内容
+
+    def _directory(self, path):
+        """返回路径对应的目录节点，不存在时逐级创建"""
+        node = self.root
+        for part in path.replace("\\", "/").split("/"):
+            if not part:
+                continue
+            key = part.casefold()
+            child = node.children.get(key)
+            if child is None:
+                self._check_name(part)
+                child = FatNode(part, True)
+                node.children[key] = child
+            elif not child.is_dir:
+                raise Exception(f"路径冲突: {path}")
+            node = child
+        return node
+
+    def add_file(self, path, size, sources, mtime=None, order=None):
+        """添加文件，超过4GB时切分为 文件名.001、文件名.002…"""
+        directory, _, name = path.replace("\\", "/").rstrip("/").rpartition("/")
+        parent = self._directory(directory)
+        if order is None:
+            order = self._order
+            self._order += 1
+        if size <= MAX_FILE_SIZE:
+            parts = [(name, 0, size)]
+        else:
+            # 分卷大小取簇大小的整数倍，避免分卷末尾浪费
+            part_size = MAX_FILE_SIZE - MAX_FILE_SIZE % self.cluster_size
+            count = -(-size // part_size)
+            parts = [(f"{name}.{index + 1:03d}", index * part_size, min(part_size, size - index * part_size))
+                     for index in range(count)]
+            self.split_files.append((path, count))
+        for part_name, start, length in parts:
+            self._check_name(part_name)
+            key = part_name.casefold()
+            if key in parent.children:
+                raise Exception(f"文件已存在: {path}")
+            parent.children[key] = FatNode(part_name, False, length, _slice_sources(sources, start, length),
+                                           mtime, order + start)
+
+    @staticmethod
+    def _check_name(name):
+        if len(name.encode("utf-16-le")) // 2 > 255:
+            raise Exception(f"文件名过长: {name}")
+
+    def add_image(self, image, path="/", target="/"):
+        """添加ISOImage中path目录下的全部内容，放在target目录下"""
+        source_fd = image.fileno()
+        prefix = target.replace("\\", "/").strip("/")
+        self._directory(prefix)
+        for relative, entry in image.tree(path):
+            target_path = f"{prefix}/{relative}" if prefix else relative
+            if entry.is_dir:
+                self._directory(target_path)
+            elif entry.link is None:
+                # FAT32不支持符号链接，跳过
+                sources = [(source_fd, offset, length) for offset, length in entry.extents]
+                self.add_file(target_path, entry.size, sources, entry.mtime, entry.offset)
+
+    # ------------------------------------------------------------------
+    # 布局
+
+    def _assign_short_names(self, directory):
+        """为目录中的每一项生成唯一的8.3短文件名"""
+        used = set()
+        # 本身就是合法8.3名称的项优先保留原名，其余再生成~N形式
+        children = sorted(directory.children.values(), key=lambda node: self._short_parts(node.name)[2])
+        for child in children:
+            base, ext, lossy = self._short_parts(child.name)
+            candidate = (base.ljust(8) + ext.ljust(3)).encode("ascii")
+            if not lossy and candidate not in used:
+                child.short_name = candidate
+            else:
+                index = 1
+                while True:
+                    suffix = f"~{index}"
+                    candidate = ((base[:8 - len(suffix)] + suffix).ljust(8) + ext.ljust(3)).encode("ascii")
+                    if candidate not in used:
+                        break
+                    index += 1
+                child.short_name = candidate
+            used.add(child.short_name)
+
+    @staticmethod
+    def _short_parts(name):
+        """拆分为大写的主名和扩展名，返回(主名, 扩展名, 是否有损)"""
+        stripped = name.strip(" ").lstrip(".")
+        if "." in stripped:
+            base, ext = stripped.rsplit(".", 1)
+        else:
+            base, ext = stripped, ""
+        clean = lambda text: "".join(ch if ch in SHORT_NAME_CHARS else "_" for ch in text.upper().replace(" ", ""))
+        short_base = clean(base)[:8] or "_"
+        short_ext = clean(ext)[:3]
+        lossy = (short_base != base.upper() or short_ext != ext.upper()
+                 or stripped != name or base.count(".") > 0)
+        return short_base, short_ext, lossy
+
+    def _entry_count(self, directory):
+        """目录占用的目录项数（含长文件名项）"""
+        count = 1 if directory is self.root else 2
+        for child in directory.children.values():
+            count += 1
+            if self._needs_long_name(child):
+                count += -(-len(child.name.encode("utf-16-le")) // 2 // LFN_CHARS)
+        return count
+
+    @staticmethod
+    def _needs_long_name(node):
+        short = node.short_name.decode("ascii")
+        display = short[:8].rstrip() + ("." + short[8:].rstrip() if short[8:].strip() else "")
+        return display != node.name
+
+    def layout(self):
+        """分配所有目录和文件的簇，返回已用字节数；空间不足时抛出异常"""
+        directories = []
+        pending = [self.root]
+        while pending:
+            directory = pending.pop(0)
+            directories.append(directory)
+            self._assign_short_names(directory)
+            pending.extend(child for child in directory.children.values() if child.is_dir)
+
+        next_cluster = ROOT_CLUSTER
+        self._chains = []
+        # 先放所有目录，再按源数据顺序放文件，写入时源和目标都是顺序访问
+        for directory in directories:
+            clusters = -(-self._entry_count(directory) * DIR_ENTRY_SIZE // self.cluster_size)
+            directory.cluster = next_cluster
+            self._chains.append((next_cluster, clusters))
+            next_cluster += clusters
+        self._directories = directories
+
+        files = [child for directory in directories for child in directory.children.values() if not child.is_dir]
+        files.sort(key=lambda node: node.order)
+        for node in files:
+            if node.size == 0:
+                continue
+            clusters = -(-node.size // self.cluster_size)
+            node.cluster = next_cluster
+            self._chains.append((next_cluster, clusters))
+            next_cluster += clusters
+        self._files = files
+        self.file_count = len(files)
+        self.data_bytes = sum(node.size for node in files)
+
+        self.used_clusters = next_cluster - ROOT_CLUSTER
+        if self.used_clusters > self.cluster_count:
+            need = self.used_clusters * self.cluster_size
+            have = self.cluster_count * self.cluster_size
+            raise Exception(f"分区空间不足：需要 {need // (1024 * 1024)} MB，可用 {have // (1024 * 1024)} MB")
+        self._laid_out = True
+        return self.data_start + self.used_clusters * self.cluster_size
+
+    # ------------------------------------------------------------------
+    # 生成
+
+    def _boot_sector(self):
+        sector = bytearray(self.sector_size)
+        sector[0:3] = b"\xEB\x58\x90"
+        sector[3:11] = b"MSWIN4.1"
+        struct.pack_into("<HBHBHHBHHHII", sector, 11,
+                         self.sector_size, self.sectors_per_cluster, self.reserved_sectors, FAT_COUNT,
+                         0, 0, 0xF8, 0, 63, 255, self.hidden_sectors, self.total_sectors)
+        struct.pack_into("<IHHIHH", sector, 36, self.fat_sectors, 0, 0, ROOT_CLUSTER,
+                         FSINFO_SECTOR, BACKUP_BOOT_SECTOR)
+        volume_id = int(time.time()) & 0xFFFFFFFF
+        struct.pack_into("<BBBI", sector, 64, 0x80, 0, 0x29, volume_id)
+        sector[71:82] = self._label_bytes()
+        sector[82:90] = b"FAT32   "
+        sector[510:512] = b"\x55\xAA"
+        return bytes(sector)
+
+    def _fsinfo_sector(self):
+        sector = bytearray(self.sector_size)
+        struct.pack_into("<I", sector, 0, 0x41615252)
+        struct.pack_into("<III", sector, 484, 0x61417272, self.cluster_count - self.used_clusters,
+                         ROOT_CLUSTER + self.used_clusters)
+        struct.pack_into("<I", sector, 508, 0xAA550000)
+        return bytes(sector)
+
+    def _label_bytes(self):
+        label = "".join(ch if ch in SHORT_NAME_CHARS else "_" for ch in self.label.upper())[:11]
+        return label.ljust(11).encode("ascii")
+
+    def _reserved_region(self):
+        region = bytearray(self.reserved_sectors * self.sector_size)
+        boot = self._boot_sector()
+        fsinfo = self._fsinfo_sector()
+        for base in (0, BACKUP_BOOT_SECTOR):
+            region[base * self.sector_size:(base + 1) * self.sector_size] = boot
+            start = (base + FSINFO_SECTOR) * self.sector_size
+            region[start:start + self.sector_size] = fsinfo
+        return region
+
+    def _fat(self):
+        """只生成FAT中已使用的部分，其余为零（空闲）"""
+        fat = array.array("I", [0x0FFFFFF8, END_OF_CHAIN])
+        fat.extend([0] * self.used_clusters)
+        for start, count in self._chains:
+            fat[start:start + count - 1] = array.array("I", range(start + 1, start + count))
+            fat[start + count - 1] = END_OF_CHAIN
+        if struct.pack("=I", 1) != struct.pack("<I", 1):
+            fat.byteswap()
+        return fat.tobytes()
+
+    def _directory_bytes(self, directory, parent_cluster):
+        entries = bytearray()
+        if directory is self.root:
+            entries += self._entry(self._label_bytes(), ATTR_VOLUME_ID, 0, 0, None)
+        else:
+            entries += self._entry(b".          ", ATTR_DIRECTORY, directory.cluster, 0, directory.mtime)
+            entries += self._entry(b"..         ", ATTR_DIRECTORY,
+                                   0 if parent_cluster == ROOT_CLUSTER else parent_cluster, 0, directory.mtime)
+        for child in sorted(directory.children.values(), key=lambda node: node.name.casefold()):
+            if self._needs_long_name(child):
+                entries += self._long_name_entries(child.name, child.short_name)
+            attr = ATTR_DIRECTORY if child.is_dir else ATTR_ARCHIVE
+            entries += self._entry(child.short_name, attr, child.cluster, 0 if child.is_dir else child.size,
+                                   child.mtime)
+        padding = -len(entries) % self.cluster_size
+        return bytes(entries) + bytes(padding)
+
+    @staticmethod
+    def _entry(short_name, attr, cluster, size, mtime):
+        date, clock = _fat_datetime(mtime)
+        return struct.pack("<11sBBBHHHHHHHI", short_name, attr, 0, 0, clock, date, date,
+                           cluster >> 16, clock, date, cluster & 0xFFFF, size)
+
+    @staticmethod
+    def _long_name_entries(name, short_name):
+        units = name.encode("utf-16-le")
+        count = -(-len(units) // 2 // LFN_CHARS)
+        # 名称以0x0000结尾，剩余位置填0xFFFF
+        padded = units + (b"\x00\x00" if len(units) // 2 % LFN_CHARS else b"")
+        padded += b"\xFF" * (count * LFN_CHARS * 2 - len(padded))
+        checksum = _short_name_checksum(short_name)
+        entries = []
+        for index in range(count):
+            chunk = padded[index * LFN_CHARS * 2:(index + 1) * LFN_CHARS * 2]
+            sequence = index + 1 | (0x40 if index == count - 1 else 0)
+            entries.append(bytes([sequence]) + chunk[0:10] + bytes([ATTR_LONG_NAME, 0, checksum])
+                           + chunk[10:22] + b"\x00\x00" + chunk[22:26])
+        # 长文件名项按倒序存放在短文件名项之前
+        return b"".join(reversed(entries))
+
+    def write(self, fd, offset=0, progress_callback=None, cancel_token=None, chunk_size=WRITE_CHUNK_SIZE):
+        """把分区内容顺序写到fd的offset处，返回写入的字节数"""
+        total = self.layout() if not self._laid_out else \
+            self.data_start + self.used_clusters * self.cluster_size
+        writer = _StreamWriter(fd, offset, total, chunk_size, progress_callback, cancel_token)
+
+        writer.write(self._reserved_region())
+        fat = self._fat()
+        for _ in range(FAT_COUNT):
+            writer.write(fat)
+            writer.zeros(self.fat_sectors * self.sector_size - len(fat))
+
+        parents = {id(self.root): ROOT_CLUSTER}
+        for directory in self._directories:
+            for child in directory.children.values():
+                if child.is_dir:
+                    parents[id(child)] = directory.cluster
+            writer.write(self._directory_bytes(directory, parents[id(directory)]))
+
+        for node in self._files:
+            if node.size == 0:
+                continue
+            for source_fd, source_offset, length in node.sources:
+                if source_offset is None:
+                    writer.zeros(length)
+                else:
+                    writer.copy(source_fd, source_offset, length)
+            writer.zeros(-node.size % self.cluster_size)
+
+        writer.flush()
+        datasync(fd)
+        return total
@@ -0,0 +1,290 @@
+"""
+文件模式复制引擎
+按源数据的位置顺序读取（ISO按区间偏移），读取线程始终顺序推进，避免光盘镜像上的随机寻道；
+小文件读出后交给线程池并发写入目标，大文件用copy_file_range在内核中直接复制，不经过用户态缓冲
+"""
+
+import os
+import time
+import errno
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from write_engine import write_all
+
+COPY_WORKERS = 8
+# 不小于该大小的文件用copy_file_range复制
+LARGE_FILE_THRESHOLD = 4 * 1024 * 1024  # 4MB
+# 已读出、等待写入的小文件数据上限
+MAX_PENDING_BYTES = 64 * 1024 * 1024  # 64MB
+COPY_CHUNK_SIZE = 8 * 1024 * 1024  # 8MB
+# copy_file_range不支持当前源/目标组合时的错误码，改为普通读写
+KERNEL_COPY_FALLBACK_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                               errno.EBADF, errno.EPERM)
+
+
+class CopyStats:
+    """一次复制的统计"""
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        # 通过copy_file_range复制的字节数
+        self.kernel_bytes = 0
+        self.elapsed = 0.0
+        # 需要提示用户的情况，如超过FAT32单文件上限而被切分的文件
+        self.warnings = []
+
+    @property
+    def rate(self):
+        return self.bytes / self.elapsed if self.elapsed > 0 else 0.0
+
+    def describe(self):
+        return (f"复制 {self.files} 个文件，{self.bytes / (1024 * 1024):.1f} MB，"
+                f"用时 {self.elapsed:.1f} 秒，{self.rate / (1024 * 1024):.1f} MB/s")
+
+
+class CopyJob:
+    """待复制的一个文件：ranges为[(源fd, 源偏移, 长度)]，偏移为None表示全零；
+    来源为普通文件时给出source_path，轮到该文件时才打开"""
+
+    __slots__ = ('dest', 'size', 'ranges', 'mtime', 'order', 'source_path')
+
+    def __init__(self, dest, size, ranges, mtime=None, order=0, source_path=None):
+        self.dest = dest
+        self.size = size
+        self.ranges = ranges
+        self.mtime = mtime
+        # 读取顺序的排序键
+        self.order = order
+        self.source_path = source_path
+
+
+class FileCopier:
+    """按源位置顺序读取、并发写入的文件复制"""
+
+    def __init__(self, workers=COPY_WORKERS, large_file_threshold=LARGE_FILE_THRESHOLD,
+                 max_pending_bytes=MAX_PENDING_BYTES, progress_callback=None, cancel_token=None):
+        self.workers = max(1, workers)
+        self.large_file_threshold = large_file_threshold
+        self.max_pending_bytes = max_pending_bytes
+        # progress_callback(已复制字节数, 总字节数)
+        self.progress_callback = progress_callback
+        self.cancel_token = cancel_token
+        self._kernel_copy = hasattr(os, 'copy_file_range')
+        self._lock = threading.Lock()
+        self._pending_cond = threading.Condition(self._lock)
+        self._pending = 0
+        self._done = 0
+        self._total = 0
+
+    # ------------------------------------------------------------------
+    # 复制来源
+
+    def copy_image(self, image, path, target_dir):
+        """把ISOImage中path目录的内容（或单个文件）复制到target_dir，文件按区间偏移顺序读取"""
+        source_fd = image.fileno()
+        dirs = []
+        jobs = []
+        symlinks = []
+        top = image.stat(path)
+        items = image.tree(path) if top.is_dir else [(top.name, top)]
+        for relative, entry in items:
+            local_path = os.path.join(target_dir, *relative.split("/"))
+            if entry.is_dir:
+                dirs.append(local_path)
+            elif entry.link is not None:
+                symlinks.append((entry.link, local_path))
+            else:
+                ranges = [(source_fd, offset, length) for offset, length in entry.extents]
+                jobs.append(CopyJob(local_path, entry.size, ranges, entry.mtime, entry.offset))
+        return self._run(target_dir, dirs, jobs, symlinks)
+
+    def copy_directory(self, source_dir, target_dir):
+        """把source_dir下的所有内容复制到target_dir；普通文件无法得知物理位置，按inode顺序近似"""
+        dirs = []
+        jobs = []
+        symlinks = []
+        for root, dir_names, file_names in os.walk(source_dir):
+            relative = os.path.relpath(root, source_dir)
+            local_root = target_dir if relative == "." else os.path.join(target_dir, relative)
+            for name in dir_names:
+                source_path = os.path.join(root, name)
+                if os.path.islink(source_path):
+                    symlinks.append((os.readlink(source_path), os.path.join(local_root, name)))
+                else:
+                    dirs.append(os.path.join(local_root, name))
+            for name in file_names:
+                source_path = os.path.join(root, name)
+                if os.path.islink(source_path):
+                    symlinks.append((os.readlink(source_path), os.path.join(local_root, name)))
+                    continue
+                st = os.stat(source_path)
+                jobs.append(CopyJob(os.path.join(local_root, name), st.st_size, None,
+                                    st.st_mtime, st.st_ino, source_path))
+        return self._run(target_dir, dirs, jobs, symlinks)
+
+    # ------------------------------------------------------------------
+    # 执行
+
+    def _run(self, target_dir, dirs, jobs, symlinks):
+        stats = CopyStats()
+        start_time = time.monotonic()
+        os.makedirs(target_dir, exist_ok=True)
+        for local_dir in dirs:
+            os.makedirs(local_dir, exist_ok=True)
+
+        jobs.sort(key=lambda job: job.order)
+        self._done = 0
+        self._pending = 0
+        self._total = sum(job.size for job in jobs)
+        errors = []
+        futures = []
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="file-copy") as pool:
+            try:
+                for job in jobs:
+                    if self.cancel_token is not None:
+                        self.cancel_token.check()
+                    if errors:
+                        break
+                    source_fd = None
+                    if job.source_path is not None:
+                        source_fd = os.open(job.source_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+                        job.ranges = [(source_fd, 0, job.size)]
+                    try:
+                        if job.size >= self.large_file_threshold:
+                            # 大文件在读取线程中按顺序复制，保持源的顺序读
+                            stats.kernel_bytes += self._copy_large(job)
+                        else:
+                            data = self._read_small(job)
+                            self._reserve(len(data))
+                            futures.append(pool.submit(self._write_small, job, data, errors))
+                    finally:
+                        if source_fd is not None:
+                            os.close(source_fd)
+                    stats.files += 1
+            finally:
+                # 取消或出错时等待已提交的写入结束，不留下写到一半的线程
+                for future in futures:
+                    future.result()
+        if errors:
+            raise Exception(f"复制文件失败: {errors[0]}")
+
+        for link, local_path in symlinks:
+            try:
+                os.symlink(link, local_path)
+            except (OSError, NotImplementedError):
+                # 目标文件系统（如FAT32）不支持符号链接
+                pass
+
+        stats.bytes = self._done
+        stats.elapsed = time.monotonic() - start_time
+        return stats
+
+    def _advance(self, length):
+        with self._lock:
+            self._done += length
+            done = self._done
+        if self.progress_callback:
+            self.progress_callback(done, self._total)
+
+    def _reserve(self, length):
+        """等待未写出的数据降到上限以下，限制内存占用"""
+        with self._pending_cond:
+            while self._pending > 0 and self._pending + length > self.max_pending_bytes:
+                self._pending_cond.wait()
+            self._pending += length
+
+    def _release(self, length):
+        with self._pending_cond:
+            self._pending -= length
+            self._pending_cond.notify_all()
+
+    def _read_small(self, job):
+        parts = []
+        for fd, offset, length in job.ranges:
+            if offset is None:
+                parts.append(bytes(length))
+                continue
+            if hasattr(os, 'pread'):
+                data = os.pread(fd, length, offset)
+            else:
+                os.lseek(fd, offset, os.SEEK_SET)
+                data = os.read(fd, length)
+            if len(data) != length:
+                raise Exception(f"读取源文件失败: {job.dest}")
+            parts.append(data)
+        return b"".join(parts)
+
+    def _write_small(self, job, data, errors):
+        try:
+            with open(job.dest, "wb") as f:
+                f.write(data)
+            self._set_mtime(job)
+            self._advance(len(data))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            self._release(len(data))
+
+    def _copy_large(self, job):
+        """复制大文件，返回通过copy_file_range复制的字节数"""
+        kernel_bytes = 0
+        dest_fd = os.open(job.dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+        try:
+            for fd, offset, length in job.ranges:
+                if offset is None:
+                    # 稀疏区间留出空洞
+                    os.lseek(dest_fd, length, os.SEEK_CUR)
+                    self._advance(length)
+                    continue
+                end = offset + length
+                while offset < end:
+                    if self.cancel_token is not None:
+                        self.cancel_token.check()
+                    chunk = min(COPY_CHUNK_SIZE, end - offset)
+                    copied = self._copy_chunk(fd, dest_fd, offset, chunk)
+                    if copied is None:
+                        if hasattr(os, 'pread'):
+                            data = os.pread(fd, chunk, offset)
+                        else:
+                            os.lseek(fd, offset, os.SEEK_SET)
+                            data = os.read(fd, chunk)
+                        if not data:
+                            raise Exception(f"读取源文件失败: {job.dest}")
+                        write_all(dest_fd, data)
+                        copied = len(data)
+                    else:
+                        kernel_bytes += copied
+                    offset += copied
+                    self._advance(copied)
+            os.ftruncate(dest_fd, job.size)
+        finally:
+            os.close(dest_fd)
+        self._set_mtime(job)
+        return kernel_bytes
+
+    def _copy_chunk(self, source_fd, dest_fd, offset, length):
+        """用copy_file_range复制一段（目标使用当前文件位置），不支持时返回None"""
+        if not self._kernel_copy:
+            return None
+        try:
+            copied = os.copy_file_range(source_fd, dest_fd, length, offset)
+        except OSError as e:
+            if e.errno not in KERNEL_COPY_FALLBACK_ERRORS:
+                raise
+            self._kernel_copy = False
+            return None
+        if copied <= 0:
+            raise Exception("源文件提前结束")
+        return copied
+
+    @staticmethod
+    def _set_mtime(job):
+        if job.mtime is None:
+            return
+        try:
+            os.utime(job.dest, (job.mtime, job.mtime))
+        except OSError:
+            pass
@@ -0,0 +1,219 @@
+"""
+ISO块摘要清单缓存
+按ISO路径、大小、修改时间和inode缓存每块摘要与整体摘要，超过容量上限时按LRU淘汰
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import threading
+
+from write_engine import BLOCK_DIGEST_SIZE, DEFAULT_DELTA_BLOCK_SIZE
+from verify_utils import ImageVerifier
+
+DEFAULT_CACHE_LIMIT = 64 * 1024 * 1024  # 64MB
+MANIFEST_MAGIC = b"ISOMANIFEST1\n"
+
+
+def get_cache_dir(name):
+    """返回程序缓存目录下的子目录（不存在时创建）"""
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    path = os.path.join(base, "iso_writer", name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def iso_identity(iso_path):
+    """ISO的身份信息：文件被替换或修改后身份随之改变"""
+    st = os.stat(iso_path)
+    return {
+        "path": os.path.realpath(iso_path),
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "inode": st.st_ino,
+    }
+
+
+def identity_key(identity):
+    """由身份信息生成缓存键"""
+    data = json.dumps(identity, sort_keys=True).encode("utf-8")
+    return hashlib.sha1(data).hexdigest()
+
+
+def atomic_write(path, data):
+    """先写临时文件再替换，避免中途退出留下损坏的缓存"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class BlockManifest:
+    """ISO块摘要清单：所有块摘要连续存放在一个bytes中"""
+
+    def __init__(self, size, block_size, digest, algorithm, hashes):
+        self.size = size
+        self.block_size = block_size
+        self.digest = digest
+        self.algorithm = algorithm
+        self.hashes = bytes(hashes)
+
+    @classmethod
+    def from_hash_list(cls, size, block_size, digest, algorithm, hash_list):
+        """由块摘要列表构造清单"""
+        return cls(size, block_size, digest, algorithm, b"".join(hash_list))
+
+    def __len__(self):
+        return len(self.hashes) // BLOCK_DIGEST_SIZE
+
+    def __getitem__(self, index):
+        if index < 0 or index >= len(self):
+            raise IndexError(index)
+        start = index * BLOCK_DIGEST_SIZE
+        return self.hashes[start:start + BLOCK_DIGEST_SIZE]
+
+    def to_bytes(self):
+        """序列化：魔数 + JSON头 + 块摘要原始数据"""
+        header = json.dumps({
+            "size": self.size,
+            "block_size": self.block_size,
+            "digest": self.digest,
+            "algorithm": self.algorithm,
+            "count": len(self),
+        }).encode("utf-8")
+        return MANIFEST_MAGIC + header + b"\n" + self.hashes
+
+    @classmethod
+    def from_bytes(cls, data):
+        """反序列化，格式不符时抛出异常"""
+        if not data.startswith(MANIFEST_MAGIC):
+            raise ValueError("不是块摘要清单文件")
+        header_end = data.index(b"\n", len(MANIFEST_MAGIC))
+        header = json.loads(data[len(MANIFEST_MAGIC):header_end].decode("utf-8"))
+        hashes = data[header_end + 1:]
+        if len(hashes) != header["count"] * BLOCK_DIGEST_SIZE:
+            raise ValueError("块摘要清单已损坏")
+        return cls(header["size"], header["block_size"], header["digest"],
+                   header["algorithm"], hashes)
+
+
+class ManifestCache:
+    """块摘要清单的持久化LRU缓存"""
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_CACHE_LIMIT,
+                 block_size=DEFAULT_DELTA_BLOCK_SIZE, algorithm="sha256", workers=None):
+        self.cache_dir = cache_dir or get_cache_dir("manifests")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.algorithm = algorithm
+        self.workers = workers or os.cpu_count() or 4
+        self.index_path = os.path.join(self.cache_dir, "index.json")
+        self._lock = threading.Lock()
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self, index):
+        atomic_write(self.index_path, json.dumps(index, indent=1).encode("utf-8"))
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.manifest")
+
+    def get(self, iso_path):
+        """查找缓存的清单，未命中或已失效时返回None"""
+        key = identity_key(iso_identity(iso_path))
+        with self._lock:
+            index = self._load_index()
+            entry = index.get(key)
+            if entry is None:
+                return None
+            try:
+                with open(self._entry_path(key), "rb") as f:
+                    manifest = BlockManifest.from_bytes(f.read())
+            except (OSError, ValueError):
+                # 清单文件丢失或损坏，移除索引项
+                index.pop(key, None)
+                self._save_index(index)
+                return None
+            if manifest.block_size != self.block_size or manifest.algorithm != self.algorithm:
+                return None
+            entry["last_access"] = time.time()
+            self._save_index(index)
+            return manifest
+
+    def put(self, iso_path, manifest):
+        """保存清单，超过容量上限时淘汰最久未使用的项"""
+        identity = iso_identity(iso_path)
+        key = identity_key(identity)
+        data = manifest.to_bytes()
+        with self._lock:
+            atomic_write(self._entry_path(key), data)
+            index = self._load_index()
+            index[key] = {
+                "path": identity["path"],
+                "bytes": len(data),
+                "last_access": time.time(),
+            }
+            self._evict(index, keep=key)
+            self._save_index(index)
+
+    def _evict(self, index, keep=None):
+        """按最近访问时间淘汰，直到总大小不超过上限"""
+        total = sum(entry["bytes"] for entry in index.values())
+        for key in sorted(index, key=lambda k: index[k]["last_access"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= index[key]["bytes"]
+            del index[key]
+            try:
+                os.remove(self._entry_path(key))
+            except OSError:
+                pass
+
+    def build(self, iso_path, progress_callback=None, cancel_token=None):
+        """多线程计算ISO的块摘要清单，同时在另一线程计算整体摘要"""
+        size = os.path.getsize(iso_path)
+        verifier = ImageVerifier(algorithm=self.algorithm, workers=self.workers, direct_io=False,
+                                 cancel_token=cancel_token)
+        whole = {}
+
+        def hash_whole():
+            try:
+                whole["digest"] = verifier.hash_range(iso_path, size)
+            except Exception as e:
+                whole["error"] = e
+
+        whole_thread = threading.Thread(target=hash_whole, name="iso-manifest-digest", daemon=True)
+        whole_thread.start()
+        try:
+            block_hashes = verifier.hash_blocks(iso_path, size, self.block_size,
+                                                progress_callback=progress_callback)
+        finally:
+            whole_thread.join()
+        if "error" in whole:
+            if cancel_token is not None:
+                cancel_token.check()
+            raise Exception(f"计算ISO摘要失败: {whole['error']}")
+
+        return BlockManifest.from_hash_list(size, self.block_size, whole["digest"], self.algorithm,
+                                            [block_hashes[i] for i in range(len(block_hashes))])
+
+    def get_or_build(self, iso_path, progress_callback=None, cancel_token=None):
+        """返回缓存的清单，未命中时计算并写入缓存"""
+        manifest = self.get(iso_path)
+        if manifest is None:
+            manifest = self.build(iso_path, progress_callback, cancel_token)
+            self.put(iso_path, manifest)
+        return manifest
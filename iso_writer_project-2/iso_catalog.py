@@ -0,0 +1,207 @@
+"""
+ISO目录索引缓存
+一次遍历ISO的整个目录树，把每个文件的路径、区间、大小和属性保存为紧凑的索引，按ISO身份缓存；
+之后按路径查找、列目录和按数据位置顺序遍历都不再需要挂载或重复解析目录
+"""
+
+import os
+import json
+import zlib
+import threading
+
+from hash_cache import atomic_write, get_cache_dir, identity_key, iso_identity
+from iso_reader import ISOEntry, ISOImage
+
+CATALOG_MAGIC = b"ISOCATALOG1\n"
+# 保留的索引文件数量，超出时删除最久未使用的
+MAX_CACHED_CATALOGS = 64
+
+# 常见引导文件在ISO中的位置
+BOOT_FILE_CANDIDATES = {
+    "bootmgr": ("/bootmgr",),
+    "uefi": ("/efi/boot/bootx64.efi", "/efi/boot/bootia32.efi", "/efi/boot/bootaa64.efi"),
+    "isolinux": ("/isolinux/isolinux.bin", "/boot/isolinux/isolinux.bin", "/syslinux/isolinux.bin"),
+    "grub": ("/boot/grub/grub.cfg", "/boot/grub2/grub.cfg", "/efi/boot/grub.cfg"),
+    "kernel": ("/boot/vmlinuz", "/casper/vmlinuz", "/live/vmlinuz", "/isolinux/vmlinuz",
+               "/images/pxeboot/vmlinuz"),
+    "initrd": ("/boot/initrd.img", "/casper/initrd", "/live/initrd.img", "/isolinux/initrd.img",
+               "/images/pxeboot/initrd.img"),
+}
+
+
+def normalize_path(path):
+    """统一为以/开头、不含多余分隔符的路径"""
+    parts = [part for part in path.replace("\\", "/").split("/") if part and part != "."]
+    return "/" + "/".join(parts)
+
+
+class ISOCatalog:
+    """ISO目录树的扁平索引：路径 -> ISOEntry"""
+
+    def __init__(self, namespace, entries):
+        self.namespace = namespace
+        # [(路径, ISOEntry)]，路径使用ISO中的实际大小写
+        self.entries = entries
+        self._by_path = {}
+        # 不区分大小写的路径 -> 实际路径
+        self._by_folded = {}
+        self._children = {}
+        for path, entry in entries:
+            self._by_path[path] = entry
+            self._by_folded.setdefault(path.casefold(), path)
+            if path != "/":
+                parent = path.rsplit("/", 1)[0] or "/"
+                self._children.setdefault(parent, []).append(entry)
+        # 所有文件按数据在镜像中的位置排序，解压时按此顺序读取
+        self.by_extent = sorted(((path, entry) for path, entry in entries if not entry.is_dir),
+                                key=lambda item: item[1].offset)
+
+    @classmethod
+    def from_image(cls, image):
+        """遍历ISOImage的整个目录树构建索引"""
+        entries = []
+        for dir_path, dirs, files in image.walk("/"):
+            if dir_path == "/":
+                entries.append(("/", image.root))
+            prefix = dir_path.rstrip("/")
+            for entry in dirs + files:
+                entries.append((f"{prefix}/{entry.name}", entry))
+        return cls(image.namespace, entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, path):
+        return self.lookup(path) is not None
+
+    def lookup(self, path):
+        """按路径查找，ISO9660和Joliet文件名不区分大小写；找不到时返回None"""
+        return self._by_path.get(self._canonical(path))
+
+    def listdir(self, path="/"):
+        entry = self.lookup(path)
+        if entry is None:
+            raise FileNotFoundError(f"ISO中不存在: {path}")
+        if not entry.is_dir:
+            raise NotADirectoryError(f"不是目录: {path}")
+        return list(self._children.get(self._canonical(path), ()))
+
+    def _canonical(self, path):
+        """查找时不区分大小写，返回索引中实际使用的路径"""
+        path = normalize_path(path)
+        if path in self._by_path:
+            return path
+        return self._by_folded.get(path.casefold(), path)
+
+    def tree(self, path="/"):
+        """path下的所有目录和文件[(相对路径, ISOEntry)]；目录在前（父目录先于子目录），文件按数据位置排序"""
+        top = self._canonical(path)
+        prefix = "" if top == "/" else top
+        dirs = [(item_path[len(prefix) + 1:], entry) for item_path, entry in self.entries
+                if entry.is_dir and item_path.startswith(prefix + "/") and item_path != "/"]
+        files = [(item_path[len(prefix) + 1:], entry) for item_path, entry in self.by_extent
+                 if item_path.startswith(prefix + "/")]
+        return dirs + files
+
+    def boot_files(self):
+        """检测ISO中的引导文件，返回{类型: 实际路径}，如{"uefi": "/EFI/BOOT/BOOTX64.EFI"}"""
+        found = {}
+        for kind, candidates in BOOT_FILE_CANDIDATES.items():
+            for candidate in candidates:
+                entry = self.lookup(candidate)
+                if entry is not None and not entry.is_dir:
+                    found[kind] = self._canonical(candidate)
+                    break
+        return found
+
+    def to_bytes(self):
+        """序列化：魔数 + 压缩的JSON"""
+        records = [[path, int(entry.is_dir), entry.size, entry.mtime, entry.mode, entry.link, entry.extents]
+                   for path, entry in self.entries]
+        data = json.dumps({"namespace": self.namespace, "entries": records},
+                          ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        return CATALOG_MAGIC + zlib.compress(data, 6)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """反序列化，格式不符时抛出ValueError"""
+        if not data.startswith(CATALOG_MAGIC):
+            raise ValueError("不是ISO目录索引文件")
+        try:
+            payload = json.loads(zlib.decompress(data[len(CATALOG_MAGIC):]).decode("utf-8"))
+            entries = []
+            for path, is_dir, size, mtime, mode, link, extents in payload["entries"]:
+                name = path.rsplit("/", 1)[-1]
+                entries.append((path, ISOEntry(name, bool(is_dir), size,
+                                               [tuple(extent) for extent in extents], mtime, mode, link)))
+            return cls(payload["namespace"], entries)
+        except (zlib.error, KeyError, TypeError, UnicodeDecodeError) as e:
+            raise ValueError(f"ISO目录索引已损坏: {e}")
+
+
+class CatalogCache:
+    """按ISO身份缓存目录索引"""
+
+    def __init__(self, cache_dir=None, max_entries=MAX_CACHED_CATALOGS):
+        self.cache_dir = cache_dir or get_cache_dir("catalogs")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+    def _entry_path(self, iso_path, namespace):
+        key = identity_key({"iso": iso_identity(iso_path), "namespace": namespace or "auto"})
+        return os.path.join(self.cache_dir, f"{key}.catalog")
+
+    def get(self, iso_path, namespace=None):
+        """查找缓存的索引，未命中或已失效时返回None"""
+        path = self._entry_path(iso_path, namespace)
+        with self._lock:
+            try:
+                with open(path, "rb") as f:
+                    catalog = ISOCatalog.from_bytes(f.read())
+            except (OSError, ValueError):
+                return None
+            try:
+                # 更新访问时间，用于淘汰
+                os.utime(path)
+            except OSError:
+                pass
+        return catalog
+
+    def put(self, iso_path, catalog, namespace=None):
+        path = self._entry_path(iso_path, namespace)
+        with self._lock:
+            atomic_write(path, catalog.to_bytes())
+            self._evict()
+
+    def _evict(self):
+        try:
+            names = [name for name in os.listdir(self.cache_dir) if name.endswith(".catalog")]
+        except OSError:
+            return
+        if len(names) <= self.max_entries:
+            return
+        paths = sorted((os.path.join(self.cache_dir, name) for name in names), key=os.path.getmtime)
+        for path in paths[:len(paths) - self.max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def open(self, iso_path, namespace=None):
+        """打开ISO并附上目录索引，未缓存时遍历目录树建立索引并写入缓存"""
+        catalog = self.get(iso_path, namespace)
+        image = ISOImage(iso_path, catalog.namespace if catalog is not None else namespace)
+        try:
+            if catalog is None:
+                catalog = ISOCatalog.from_image(image)
+                try:
+                    self.put(iso_path, catalog, namespace)
+                except OSError as e:
+                    # 缓存只影响下次打开的速度
+                    print(f"保存ISO目录索引失败: {e}")
+            image.catalog = catalog
+        except Exception:
+            image.close()
+            raise
+        return image
@@ -0,0 +1,639 @@
+"""
+ISO镜像文件读取
+直接解析卷描述符和目录记录，支持ISO9660、Joliet长文件名、Rock Ridge扩展和UDF；
+在只读内存映射上按需读取目录，解压时按数据在镜像中的位置顺序读取（见file_copy），
+不需要挂载ISO，也不需要管理员权限
+"""
+
+import os
+import mmap
+import struct
+import calendar
+import threading
+
+from file_copy import COPY_WORKERS, FileCopier
+
+SECTOR_SIZE = 2048
+# 卷描述符从第16扇区开始
+VOLUME_DESCRIPTOR_START = 16
+UDF_ANCHOR_SECTOR = 256
+
+# ISO9660目录记录标志
+FLAG_DIRECTORY = 0x02
+FLAG_MULTI_EXTENT = 0x80
+
+# Joliet补充卷描述符的转义序列（UCS-2 Level 1/2/3）
+JOLIET_ESCAPES = (b"%/@", b"%/C", b"%/E")
+
+# UDF描述符标签
+UDF_TAG_ANCHOR = 2
+UDF_TAG_PARTITION = 5
+UDF_TAG_LOGICAL_VOLUME = 6
+UDF_TAG_TERMINATOR = 8
+UDF_TAG_FILE_SET = 256
+UDF_TAG_FILE_ID = 257
+UDF_TAG_ALLOCATION_EXTENT = 258
+UDF_TAG_FILE_ENTRY = 261
+UDF_TAG_EXTENDED_FILE_ENTRY = 266
+UDF_FILE_TYPE_DIRECTORY = 4
+UDF_FILE_TYPE_SYMLINK = 12
+
+
+class ISOEntry:
+    """镜像中的一个文件或目录"""
+
+    __slots__ = ('name', 'is_dir', 'size', 'extents', 'mtime', 'mode', 'link', '_key')
+
+    def __init__(self, name, is_dir, size, extents, mtime=None, mode=None, link=None):
+        self.name = name
+        self.is_dir = is_dir
+        self.size = size
+        # 数据所在的[(镜像中的字节偏移, 长度)]，偏移为None表示全零（UDF稀疏区间）
+        self.extents = extents
+        self.mtime = mtime
+        # Rock Ridge提供的权限位
+        self.mode = mode
+        # 符号链接目标（Rock Ridge）
+        self.link = link
+        # 目录缓存键：目录数据的起始偏移
+        self._key = extents[0][0] if extents else None
+
+    @property
+    def offset(self):
+        """数据在镜像中的起始偏移，用于按位置排序"""
+        for offset, _ in self.extents:
+            if offset is not None:
+                return offset
+        return 0
+
+    def __repr__(self):
+        kind = "目录" if self.is_dir else "文件"
+        return f"<ISOEntry {kind} {self.name!r} {self.size}字节>"
+
+
+def _both_endian32(data, offset):
+    """ISO9660的双字节序32位整数，取小端部分"""
+    return struct.unpack_from("<I", data, offset)[0]
+
+
+def _iso_time(data, offset):
+    """解析目录记录中的7字节时间"""
+    year, month, day, hour, minute, second, tz = struct.unpack_from("<6Bb", data, offset)
+    if not month or not day:
+        return None
+    try:
+        return calendar.timegm((1900 + year, month, day, hour, minute, second)) - tz * 15 * 60
+    except (ValueError, OverflowError):
+        return None
+
+
+def _udf_time(data, offset):
+    """解析UDF的12字节时间戳"""
+    type_tz, year, month, day, hour, minute, second = struct.unpack_from("<HhBBBBB", data, offset)
+    if not month or not day:
+        return None
+    tz = type_tz & 0x0FFF
+    if tz & 0x0800:
+        tz -= 0x1000
+    if tz == -2047:
+        tz = 0
+    try:
+        return calendar.timegm((year, month, day, hour, minute, second)) - tz * 60
+    except (ValueError, OverflowError):
+        return None
+
+
+def _udf_name(data):
+    """解码OSTA压缩Unicode文件名"""
+    if not data:
+        return ""
+    if data[0] == 16:
+        return data[1:].decode("utf-16-be", errors="replace")
+    return data[1:].decode("latin-1")
+
+
+def _clean_iso_name(name):
+    """去掉ISO9660文件名的版本号和多余的点"""
+    if ";" in name:
+        name = name[:name.rindex(";")]
+    if name.endswith(".") and not name.startswith("."):
+        name = name[:-1]
+    return name
+
+
+class ISOImage:
+    """只读打开ISO镜像，按需解析目录"""
+
+    def __init__(self, path, namespace=None):
+        self.path = path
+        self._file = open(path, "rb")
+        self.size = os.fstat(self._file.fileno()).st_size
+        self._lock = threading.Lock()
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError, OverflowError):
+            # 32位进程映射不了大镜像，退回到按偏移读取
+            self._map = None
+        self._dirs = {}
+        self._susp_skip = None
+        self._udf = None
+        # 目录索引（见iso_catalog），设置后查找和遍历不再解析目录
+        self.catalog = None
+
+        try:
+            self._parse_volume_descriptors()
+            available = self.namespaces()
+            if namespace is None:
+                # UDF和Rock Ridge保留完整的文件名和属性，优先使用
+                namespace = next(name for name in ("udf", "rockridge", "joliet", "iso9660") if name in available)
+            elif namespace not in available:
+                raise Exception(f"ISO中没有{namespace}文件系统")
+            self.namespace = namespace
+            self.root = self._udf_root if namespace == "udf" else (
+                self._joliet_root if namespace == "joliet" else self._primary_root)
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _read(self, offset, length):
+        """读取镜像中的一段数据"""
+        if offset + length > self.size:
+            raise Exception(f"ISO镜像已损坏：读取位置 {offset} 超出文件末尾")
+        if self._map is not None:
+            return self._map[offset:offset + length]
+        with self._lock:
+            self._file.seek(offset)
+            return self._file.read(length)
+
+    def _read_extents(self, extents, size):
+        """按区间列表读取最多size字节"""
+        parts = []
+        for offset, length in extents:
+            length = min(length, size)
+            parts.append(bytes(length) if offset is None else self._read(offset, length))
+            size -= length
+            if size <= 0:
+                break
+        return b"".join(parts)
+
+    # ------------------------------------------------------------------
+    # 卷描述符
+
+    def _parse_volume_descriptors(self):
+        self._primary_root = None
+        self._joliet_root = None
+        self._udf_root = None
+        # 卷标，部分Linux发行版的引导配置按卷标查找启动盘
+        self.volume_id = ""
+        sector = VOLUME_DESCRIPTOR_START
+        while (sector + 1) * SECTOR_SIZE <= self.size:
+            data = self._read(sector * SECTOR_SIZE, SECTOR_SIZE)
+            if data[1:6] != b"CD001":
+                break
+            kind = data[0]
+            if kind == 255:
+                break
+            if kind == 1 and self._primary_root is None:
+                self._primary_root = self._root_record(data)
+                self.volume_id = data[40:72].decode("latin-1").strip()
+            elif kind == 2 and data[88:91] in JOLIET_ESCAPES and self._joliet_root is None:
+                self._joliet_root = self._root_record(data)
+            sector += 1
+
+        if self._primary_root is not None:
+            self._detect_rock_ridge()
+        try:
+            self._parse_udf()
+        except Exception:
+            # UDF结构不完整或使用了不支持的分区映射，仍可使用ISO9660部分
+            self._udf_root = None
+
+        if self._primary_root is None and self._udf_root is None:
+            raise Exception(f"不是有效的ISO镜像: {self.path}")
+
+    def _root_record(self, descriptor):
+        block_size = struct.unpack_from("<H", descriptor, 128)[0]
+        if block_size != SECTOR_SIZE:
+            raise Exception(f"不支持的逻辑块大小: {block_size}")
+        record = descriptor[156:156 + 34]
+        extent = _both_endian32(record, 2) * SECTOR_SIZE
+        size = _both_endian32(record, 10)
+        return ISOEntry("", True, size, [(extent, size)], _iso_time(record, 18))
+
+    def _detect_rock_ridge(self):
+        """根目录"."记录的系统使用区以SP开头时启用SUSP，其中有RR扩展时使用Rock Ridge文件名"""
+        root = self._primary_root
+        data = self._read(root.extents[0][0], SECTOR_SIZE)
+        length = data[0]
+        name_length = data[32]
+        system_use = data[33 + name_length + (1 - name_length % 2):length]
+        if system_use[:2] != b"SP" or system_use[4:6] != b"\xbe\xef":
+            return
+        self._susp_skip = system_use[6]
+        entries = self._susp_entries(system_use)
+        if any(signature in (b"ER", b"RR", b"PX", b"NM") for signature, _ in entries):
+            self._rock_ridge = True
+
+    def namespaces(self):
+        """镜像中可用的文件系统"""
+        available = []
+        if self._udf_root is not None:
+            available.append("udf")
+        if self._primary_root is not None and getattr(self, "_rock_ridge", False):
+            available.append("rockridge")
+        if self._joliet_root is not None:
+            available.append("joliet")
+        if self._primary_root is not None:
+            available.append("iso9660")
+        return available
+
+    # ------------------------------------------------------------------
+    # ISO9660 / Joliet / Rock Ridge 目录
+
+    def _susp_entries(self, system_use):
+        """解析系统使用区的SUSP条目，跟随CE延续区，返回[(签名, 条目数据)]"""
+        entries = []
+        pending = [system_use]
+        visited = 0
+        while pending and visited < 64:
+            area = pending.pop(0)
+            visited += 1
+            pos = 0
+            while pos + 4 <= len(area):
+                signature = area[pos:pos + 2]
+                length = area[pos + 2]
+                if length < 4 or pos + length > len(area):
+                    break
+                entry = area[pos:pos + length]
+                if signature == b"ST":
+                    break
+                if signature == b"CE":
+                    block = _both_endian32(entry, 4)
+                    offset = _both_endian32(entry, 12)
+                    size = _both_endian32(entry, 20)
+                    pending.append(self._read(block * SECTOR_SIZE + offset, size))
+                else:
+                    entries.append((signature, entry))
+                pos += length
+        return entries
+
+    def _iso_children(self, directory):
+        """解析目录的所有记录，返回子项列表"""
+        joliet = self.namespace == "joliet"
+        rock_ridge = self.namespace == "rockridge"
+        data = self._read_extents(directory.extents, directory.size)
+        children = []
+        pending = None
+        pos = 0
+        while pos < len(data):
+            length = data[pos]
+            if length == 0:
+                # 目录记录不跨扇区，剩余部分为填充
+                pos = (pos // SECTOR_SIZE + 1) * SECTOR_SIZE
+                continue
+            record = data[pos:pos + length]
+            pos += length
+            if len(record) < 34:
+                break
+            name_length = record[32]
+            raw_name = record[33:33 + name_length]
+            if raw_name in (b"\x00", b"\x01"):
+                continue
+
+            flags = record[25]
+            extent = _both_endian32(record, 2) * SECTOR_SIZE
+            size = _both_endian32(record, 10)
+            is_dir = bool(flags & FLAG_DIRECTORY)
+            if joliet:
+                name = _clean_iso_name(raw_name.decode("utf-16-be", errors="replace"))
+            else:
+                # 与Linux挂载ISO9660时的默认行为（map=normal）一致，文件名转为小写
+                name = _clean_iso_name(raw_name.decode("latin-1")).lower()
+            mode = None
+            link = None
+
+            if rock_ridge and self._susp_skip is not None:
+                system_use = record[33 + name_length + (1 - name_length % 2) + self._susp_skip:]
+                rr = self._rock_ridge_fields(system_use)
+                if rr.get("relocated"):
+                    # 被移动到rr_moved的深层目录，在其原位置通过CL记录出现
+                    continue
+                name = rr.get("name", name)
+                mode = rr.get("mode")
+                link = rr.get("link")
+                if "child" in rr:
+                    extent = rr["child"]
+                    is_dir = True
+                    size = _both_endian32(self._read(extent, 34), 10)
+
+            if pending is not None and pending.name == name and not pending.is_dir:
+                # 多区间文件（单个区间不超过4GB）
+                pending.extents.append((extent, size))
+                pending.size += size
+            else:
+                pending = ISOEntry(name, is_dir, size, [(extent, size)], _iso_time(record, 18), mode, link)
+                children.append(pending)
+            if not flags & FLAG_MULTI_EXTENT:
+                pending = None
+        return children
+
+    def _rock_ridge_fields(self, system_use):
+        """提取Rock Ridge的文件名、权限、符号链接和目录重定位信息"""
+        fields = {}
+        name_parts = []
+        link_parts = []
+        for signature, entry in self._susp_entries(system_use):
+            if signature == b"NM":
+                flags = entry[4]
+                if flags & 0x02:
+                    name_parts.append(".")
+                elif flags & 0x04:
+                    name_parts.append("..")
+                else:
+                    name_parts.append(entry[5:].decode("utf-8", errors="replace"))
+            elif signature == b"PX":
+                fields["mode"] = _both_endian32(entry, 4)
+            elif signature == b"SL":
+                pos = 5
+                while pos + 2 <= len(entry):
+                    flags, length = entry[pos], entry[pos + 1]
+                    content = entry[pos + 2:pos + 2 + length]
+                    if flags & 0x02:
+                        link_parts.append(".")
+                    elif flags & 0x04:
+                        link_parts.append("..")
+                    elif flags & 0x08:
+                        link_parts.append("")
+                    else:
+                        link_parts.append(content.decode("utf-8", errors="replace"))
+                    pos += 2 + length
+            elif signature == b"CL":
+                fields["child"] = _both_endian32(entry, 4) * SECTOR_SIZE
+            elif signature == b"RE":
+                fields["relocated"] = True
+        if name_parts:
+            fields["name"] = "".join(name_parts)
+        if link_parts:
+            fields["link"] = "/".join(link_parts) or "/"
+        return fields
+
+    # ------------------------------------------------------------------
+    # UDF
+
+    def _parse_udf(self):
+        """读取锚点、卷描述符序列和文件集描述符，只支持Type 1分区映射（Windows安装镜像等）"""
+        if (UDF_ANCHOR_SECTOR + 1) * SECTOR_SIZE > self.size:
+            return
+        nsr = False
+        sector = VOLUME_DESCRIPTOR_START
+        while sector < UDF_ANCHOR_SECTOR:
+            ident = self._read(sector * SECTOR_SIZE + 1, 5)
+            if ident in (b"NSR02", b"NSR03"):
+                nsr = True
+            elif ident not in (b"CD001", b"BEA01", b"BOOT2", b"CDW02"):
+                break
+            sector += 1
+        if not nsr:
+            return
+
+        anchor = self._read(UDF_ANCHOR_SECTOR * SECTOR_SIZE, SECTOR_SIZE)
+        if struct.unpack_from("<H", anchor, 0)[0] != UDF_TAG_ANCHOR:
+            return
+        vds_length, vds_location = struct.unpack_from("<II", anchor, 16)
+
+        partitions = {}
+        logical_volume = None
+        for index in range(max(1, vds_length // SECTOR_SIZE)):
+            data = self._read((vds_location + index) * SECTOR_SIZE, SECTOR_SIZE)
+            tag = struct.unpack_from("<H", data, 0)[0]
+            if tag == UDF_TAG_TERMINATOR:
+                break
+            if tag == UDF_TAG_PARTITION:
+                number = struct.unpack_from("<H", data, 22)[0]
+                partitions[number] = struct.unpack_from("<I", data, 188)[0]
+            elif tag == UDF_TAG_LOGICAL_VOLUME and logical_volume is None:
+                logical_volume = data
+        if logical_volume is None or not partitions:
+            return
+
+        block_size = struct.unpack_from("<I", logical_volume, 212)[0]
+        if block_size != SECTOR_SIZE:
+            raise Exception(f"不支持的UDF逻辑块大小: {block_size}")
+        map_count = struct.unpack_from("<I", logical_volume, 268)[0]
+        partition_starts = []
+        pos = 440
+        for _ in range(map_count):
+            map_type, map_length = logical_volume[pos], logical_volume[pos + 1]
+            if map_type != 1:
+                raise Exception("不支持的UDF分区映射")
+            number = struct.unpack_from("<H", logical_volume, pos + 4)[0]
+            partition_starts.append(partitions[number])
+            pos += map_length
+        self._udf = partition_starts
+
+        fsd_block, fsd_partition = struct.unpack_from("<IH", logical_volume, 252)
+        fsd = self._read(self._udf_offset(fsd_block, fsd_partition), SECTOR_SIZE)
+        if struct.unpack_from("<H", fsd, 0)[0] != UDF_TAG_FILE_SET:
+            raise Exception("找不到UDF文件集描述符")
+        root_block, root_partition = struct.unpack_from("<IH", fsd, 404)
+        self._udf_root = self._udf_entry("", root_block, root_partition)
+
+    def _udf_offset(self, block, partition):
+        return (self._udf[partition] + block) * SECTOR_SIZE
+
+    def _udf_entry(self, name, block, partition):
+        """读取文件条目（File Entry或Extended File Entry），返回ISOEntry"""
+        offset = self._udf_offset(block, partition)
+        data = self._read(offset, SECTOR_SIZE)
+        tag = struct.unpack_from("<H", data, 0)[0]
+        if tag == UDF_TAG_FILE_ENTRY:
+            mtime = _udf_time(data, 84)
+            ea_length, ad_length = struct.unpack_from("<II", data, 168)
+            ad_start = 176 + ea_length
+        elif tag == UDF_TAG_EXTENDED_FILE_ENTRY:
+            mtime = _udf_time(data, 92)
+            ea_length, ad_length = struct.unpack_from("<II", data, 208)
+            ad_start = 216 + ea_length
+        else:
+            raise Exception(f"UDF文件条目已损坏（标签 {tag}）")
+        file_type = data[27]
+        ad_type = struct.unpack_from("<H", data, 34)[0] & 0x07
+        size = struct.unpack_from("<Q", data, 56)[0]
+
+        if ad_type == 3:
+            # 数据直接内嵌在文件条目中
+            extents = [(offset + ad_start, size)]
+        else:
+            extents = self._udf_extents(data[ad_start:ad_start + ad_length], ad_type, partition, size)
+        entry = ISOEntry(name, file_type == UDF_FILE_TYPE_DIRECTORY, size, extents, mtime)
+        if file_type == UDF_FILE_TYPE_SYMLINK:
+            entry.link = ""
+        return entry
+
+    def _udf_extents(self, area, ad_type, partition, size):
+        """解析分配描述符，返回数据区间列表"""
+        if ad_type not in (0, 1):
+            raise Exception("不支持的UDF分配描述符类型")
+        ad_size = 8 if ad_type == 0 else 16
+        extents = []
+        remaining = size
+        pos = 0
+        while pos + ad_size <= len(area) and remaining > 0:
+            raw_length = struct.unpack_from("<I", area, pos)[0]
+            kind = raw_length >> 30
+            length = raw_length & 0x3FFFFFFF
+            if ad_type == 0:
+                block = struct.unpack_from("<I", area, pos + 4)[0]
+                ad_partition = partition
+            else:
+                block, ad_partition = struct.unpack_from("<IH", area, pos + 4)
+            pos += ad_size
+            if length == 0:
+                break
+            if kind == 3:
+                # 后续分配描述符位于分配扩展描述符中
+                next_area = self._read(self._udf_offset(block, ad_partition), length)
+                next_length = struct.unpack_from("<I", next_area, 20)[0]
+                area = next_area[24:24 + next_length]
+                pos = 0
+                continue
+            length = min(length, remaining)
+            # 已分配未记录和未分配的区间读出为零
+            extents.append((self._udf_offset(block, ad_partition) if kind == 0 else None, length))
+            remaining -= length
+        return extents
+
+    def _udf_children(self, directory):
+        """解析目录中的文件标识描述符"""
+        data = self._read_extents(directory.extents, directory.size)
+        children = []
+        pos = 0
+        while pos + 38 <= len(data):
+            if struct.unpack_from("<H", data, pos)[0] != UDF_TAG_FILE_ID:
+                break
+            characteristics = data[pos + 18]
+            name_length = data[pos + 19]
+            block, partition = struct.unpack_from("<IH", data, pos + 24)
+            use_length = struct.unpack_from("<H", data, pos + 36)[0]
+            name_start = pos + 38 + use_length
+            raw_name = data[name_start:name_start + name_length]
+            pos += (38 + use_length + name_length + 3) & ~3
+            # 跳过父目录和已删除的条目
+            if characteristics & 0x0C:
+                continue
+            children.append(self._udf_entry(_udf_name(raw_name), block, partition))
+        return children
+
+    # ------------------------------------------------------------------
+    # 查找与遍历
+
+    def listdir(self, path="/"):
+        """返回目录中的子项列表"""
+        if self.catalog is not None:
+            return self.catalog.listdir(path)
+        directory = self.stat(path)
+        if not directory.is_dir:
+            raise NotADirectoryError(f"不是目录: {path}")
+        return self._children(directory)
+
+    def _children(self, directory):
+        children = self._dirs.get(directory._key)
+        if children is None:
+            if self.namespace == "udf":
+                children = self._udf_children(directory)
+            else:
+                children = self._iso_children(directory)
+            self._dirs[directory._key] = children
+        return children
+
+    def stat(self, path):
+        """按路径查找文件或目录，找不到时抛出FileNotFoundError"""
+        if self.catalog is not None:
+            entry = self.catalog.lookup(path)
+            if entry is None:
+                raise FileNotFoundError(f"ISO中不存在: {path}")
+            return entry
+        entry = self.root
+        for part in path.replace("\\", "/").split("/"):
+            if not part or part == ".":
+                continue
+            if not entry.is_dir:
+                raise FileNotFoundError(f"ISO中不存在: {path}")
+            children = self._children(entry)
+            match = next((child for child in children if child.name == part), None)
+            if match is None:
+                # ISO9660和Joliet文件名不区分大小写
+                folded = part.casefold()
+                match = next((child for child in children if child.name.casefold() == folded), None)
+            if match is None:
+                raise FileNotFoundError(f"ISO中不存在: {path}")
+            entry = match
+        return entry
+
+    def exists(self, path):
+        try:
+            self.stat(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def walk(self, path="/"):
+        """与os.walk类似，生成(目录路径, 子目录列表, 文件列表)，列表元素为ISOEntry"""
+        top = "/" + path.replace("\\", "/").strip("/")
+        pending = [(top, self.stat(path))]
+        while pending:
+            dir_path, directory = pending.pop()
+            children = self._children(directory)
+            dirs = [child for child in children if child.is_dir]
+            files = [child for child in children if not child.is_dir]
+            yield dir_path, dirs, files
+            for child in reversed(dirs):
+                pending.append((dir_path.rstrip("/") + "/" + child.name, child))
+
+    def tree(self, path="/"):
+        """path下的所有目录和文件[(相对路径, ISOEntry)]，目录在前，文件按数据位置排序"""
+        if self.catalog is not None:
+            return self.catalog.tree(path)
+        top = "/" + path.replace("\\", "/").strip("/")
+        dirs = []
+        files = []
+        for dir_path, children_dirs, children_files in self.walk(path):
+            relative = dir_path[len(top):].strip("/")
+            prefix = relative + "/" if relative else ""
+            dirs.extend((prefix + child.name, child) for child in children_dirs)
+            files.extend((prefix + child.name, child) for child in children_files)
+        files.sort(key=lambda item: item[1].offset)
+        return dirs + files
+
+    def read(self, path):
+        """读取整个文件（适合配置文件等小文件）"""
+        entry = self.stat(path)
+        if entry.is_dir:
+            raise IsADirectoryError(f"是目录: {path}")
+        return self._read_extents(entry.extents, entry.size)
+
+    # ------------------------------------------------------------------
+    # 解压
+
+    def extract(self, path, target_dir, progress_callback=None, cancel_token=None, workers=COPY_WORKERS):
+        """把ISO中的目录内容（或单个文件）解压到target_dir，返回CopyStats；
+        文件按数据在镜像中的位置顺序读取，小文件由线程池并发写入"""
+        copier = FileCopier(workers=workers, progress_callback=progress_callback, cancel_token=cancel_token)
+        return copier.copy_image(self, path, target_dir)
+
+    def fileno(self):
+        return self._file.fileno()
@@ -0,0 +1,308 @@
+"""
+ISO写入器命令行入口
+不导入tkinter，可在无图形界面的服务器上由脚本或任务系统调用
+
+用法:
+    python -m iso_writer write --iso X.iso --device /dev/sdb --verify --json
+    python -m iso_writer list --json
+    python -m iso_writer list --watch --json
+    python -m iso_writer auto --iso X.iso --min-size 8G --max-size 64G --vendor "SanDisk*" --log results.jsonl
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import threading
+
+from auto_flash import DEFAULT_WORKERS, AutoFlasher, DeviceRule, parse_size
+from device_erase import ERASE_SCOPES
+from device_inventory import get_inventory
+from hash_cache import atomic_write
+from job_control import OperationCancelled
+from job_scheduler import CONTROLLER_JOBS, USB2_HUB_JOBS, USB3_HUB_JOBS
+from progress_meter import format_eta, format_rate
+from usb_writer import USBWriter, list_usb_devices
+
+# 退出码
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_PARTIAL = 2
+EXIT_CANCELLED = 130
+
+
+class EventPrinter:
+    """把制作过程中的状态和进度输出到标准输出，--json时每行一个JSON事件"""
+
+    def __init__(self, as_json=False, stream=None):
+        self.as_json = as_json
+        self.stream = stream or sys.stdout
+        self._lock = threading.Lock()
+        self._last_percent = None
+
+    def emit(self, event, **fields):
+        with self._lock:
+            if self.as_json:
+                record = {"event": event, "time": round(time.time(), 3)}
+                record.update(fields)
+                self.stream.write(json.dumps(record, ensure_ascii=False) + "\n")
+            elif event == "progress":
+                line = f"\r进度: {fields['percent']:5.1f}%"
+                if fields.get("rate"):
+                    line += f"  {format_rate(fields['rate'])}  剩余 {format_eta(fields.get('eta'))}"
+                self.stream.write(line + "   ")
+            else:
+                if self._last_percent is not None:
+                    self.stream.write("\n")
+                    self._last_percent = None
+                text = fields.get("message") or fields.get("error") or json.dumps(fields, ensure_ascii=False)
+                self.stream.write(f"[{event}] {text}\n")
+            self.stream.flush()
+
+    def on_event(self, event, **fields):
+        """事件总线回调"""
+        if event == "progress":
+            # 流水线已按固定频率发布进度，这里只去掉小数位过多的部分
+            self._last_percent = fields["percent"]
+            fields["percent"] = round(fields["percent"], 1)
+            if fields.get("rate") is not None:
+                fields["rate"] = round(fields["rate"])
+            if fields.get("eta") is not None:
+                fields["eta"] = round(fields["eta"], 1)
+            self.emit(event, **fields)
+        elif self.as_json or event in ("status", "stage_failed", "device_status",
+                                       "cancel_requested", "paused", "resumed"):
+            self.emit(event, **fields)
+
+
+def default_pe_path():
+    """与图形界面一致：程序目录下的pe.iso"""
+    if getattr(sys, 'frozen', False):
+        app_dir = os.path.dirname(sys.executable)
+    else:
+        app_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(app_dir, "pe.iso")
+
+
+def install_signal_handlers(writer):
+    """SIGINT/SIGTERM取消写入；POSIX上SIGUSR1暂停、SIGUSR2继续"""
+    def handler(action):
+        # 信号处理函数在主线程中打断任意代码执行，主线程可能正持有事件总线的锁，
+        # 因此在独立线程中发布事件
+        return lambda signum, frame: threading.Thread(target=action, daemon=True).start()
+
+    signal.signal(signal.SIGINT, handler(writer.cancel))
+    signal.signal(signal.SIGTERM, handler(writer.cancel))
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, handler(writer.pause))
+        signal.signal(signal.SIGUSR2, handler(writer.resume))
+
+
+def cmd_write(args, printer):
+    """执行写入命令"""
+    if not os.path.exists(args.iso):
+        printer.emit("error", message=f"ISO文件不存在: {args.iso}")
+        return EXIT_FAILED
+
+    pe_path = None if args.no_pe else (args.pe or default_pe_path())
+    writer = USBWriter(pe_path=pe_path,
+                       verify=args.verify,
+                       format_device=not args.no_format,
+                       bootable=not args.no_boot,
+                       direct_io=not args.buffered,
+                       skip_zero=args.skip_zero,
+                       delta=args.delta,
+                       resume=args.resume,
+                       tune=args.tune,
+                       erase=args.erase)
+    writer.bus.subscribe(printer.on_event)
+    install_signal_handlers(writer)
+    start = time.monotonic()
+    try:
+        if len(args.device) > 1:
+            succeeded, failed = writer.run_multiple(args.iso, args.device)
+        else:
+            writer.run(args.iso, args.device[0])
+            succeeded, failed = list(args.device), {}
+    except OperationCancelled:
+        succeeded, failed = [], {device: "操作已取消" for device in args.device}
+    except Exception as e:
+        succeeded, failed = [], {device: str(e) for device in args.device}
+
+    elapsed = time.monotonic() - start
+    size = os.path.getsize(args.iso)
+    cancelled = writer.cancel_token.cancelled
+    message = "制作完成" if not failed else "制作失败"
+    if cancelled:
+        message = "操作已取消"
+    printer.emit("done", success=not failed, succeeded=succeeded, failed=failed,
+                 digest=writer.image_digest, bytes=size, seconds=round(elapsed, 3),
+                 cancelled=cancelled, checkpoint=writer.cancel_token.checkpoint,
+                 message=message)
+    if cancelled:
+        return EXIT_CANCELLED
+    if not failed:
+        return EXIT_OK
+    return EXIT_PARTIAL if succeeded else EXIT_FAILED
+
+
+def cmd_list(args, printer):
+    """列出USB设备"""
+    devices = list_usb_devices()
+    if printer.as_json:
+        printer.emit("devices", devices=devices)
+    else:
+        for device in devices:
+            print(f"{device['path']}\t{device['name']}")
+    if not args.watch:
+        return EXIT_OK
+
+    # 持续输出插拔事件，直到收到SIGINT/SIGTERM
+    inventory = get_inventory()
+
+    def on_device(event, device):
+        if device.is_usb:
+            printer.emit(event, device=device.to_dict(), message=f"{device.path}\t{device.display_name()}")
+
+    inventory.bus.subscribe(on_device, "device_added", "device_removed", "device_changed")
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    inventory.start_monitor()
+    while not stop.wait(0.5):
+        pass
+    inventory.stop_monitor()
+    return EXIT_OK
+
+
+def cmd_auto(args, printer):
+    """制作工位模式：持续监听新插入的设备，符合规则的自动写入并验证，直到收到SIGINT/SIGTERM"""
+    try:
+        rule = DeviceRule(min_size=parse_size(args.min_size) if args.min_size else 0,
+                          max_size=parse_size(args.max_size) if args.max_size else None,
+                          vendor=args.vendor, model=args.model, serial=args.serial,
+                          removable_only=not args.any_removable)
+        pe_path = None if args.no_pe else (args.pe or default_pe_path())
+        flasher = AutoFlasher(args.iso, rule, workers=args.workers, log_path=args.log,
+                              usb2_hub_jobs=args.usb2_hub_jobs, usb3_hub_jobs=args.usb3_hub_jobs,
+                              controller_jobs=args.controller_jobs,
+                              writer_options={"pe_path": pe_path,
+                                              "verify": not args.no_verify,
+                                              "format_device": not args.no_format,
+                                              "bootable": not args.no_boot,
+                                              "direct_io": not args.buffered,
+                                              "skip_zero": args.skip_zero,
+                                              "tune": args.tune,
+                                              "erase": args.erase})
+    except Exception as e:
+        printer.emit("error", message=str(e))
+        return EXIT_FAILED
+
+    def on_event(event, **fields):
+        if event == "queue_changed":
+            # 队列状态写入文件供查看（如watch cat），不逐条输出
+            if args.state_file:
+                try:
+                    atomic_write(args.state_file, json.dumps(fields["state"], ensure_ascii=False, indent=2)
+                                 .encode("utf-8"))
+                except OSError as e:
+                    printer.emit("warning", message=f"写入队列状态失败: {e}")
+            return
+        # 多个设备同时写入时逐行输出进度会相互覆盖，非JSON模式只输出状态变化
+        if printer.as_json or event != "job_progress":
+            printer.emit(event, **fields)
+
+    flasher.bus.subscribe(on_event)
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    mode = flasher.start()
+    printer.emit("status", message=f"等待插入设备（{rule.describe()}，{flasher.workers}个并行任务，监听方式: {mode}）")
+    while not stop.wait(0.5):
+        pass
+    printer.emit("status", message="正在停止，取消进行中的写入...")
+    flasher.stop()
+    counts = flasher.summary()
+    printer.emit("done", **counts, message=f"成功 {counts['succeeded']} 个，失败 {counts['failed']} 个，"
+                                          f"取消 {counts['cancelled']} 个")
+    return EXIT_OK if not counts["failed"] else EXIT_PARTIAL
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="iso_writer", description="专业ISO写入器命令行")
+    subparsers = parser.add_subparsers(dest="command")
+
+    write_parser = subparsers.add_parser("write", help="把ISO写入USB设备（会擦除设备上的所有数据）")
+    write_parser.add_argument("--iso", required=True, help="源ISO文件")
+    write_parser.add_argument("--device", required=True, action="append",
+                              help="目标设备，可重复指定以同时写入多个设备")
+    write_parser.add_argument("--verify", action="store_true", help="写入后回读验证")
+    write_parser.add_argument("--no-format", action="store_true", help="写入前不格式化设备")
+    write_parser.add_argument("--no-boot", action="store_true", help="不安装引导程序")
+    write_parser.add_argument("--pe", help="PE工具ISO路径（默认使用程序目录下的pe.iso）")
+    write_parser.add_argument("--no-pe", action="store_true", help="不集成PE工具")
+    write_parser.add_argument("--buffered", action="store_true", help="经过页缓存写入（默认直接写入）")
+    write_parser.add_argument("--skip-zero", action="store_true", help="跳过全零块")
+    write_parser.add_argument("--delta", action="store_true", help="增量写入，只写入与设备现有内容不同的块")
+    write_parser.add_argument("--resume", action="store_true",
+                              help="上次写入同一设备中断时，校验断点后从断点继续写入")
+    write_parser.add_argument("--tune", action="store_true",
+                              help="设备没有缓存的写入参数时，先试写比较不同的块大小和在途写请求数")
+    write_parser.add_argument("--erase", choices=ERASE_SCOPES,
+                              help="写入前擦除设备（TRIM，不支持时清零）：all整个设备，unused只擦除镜像之外的区间")
+    write_parser.add_argument("--json", action="store_true", help="以JSON行格式输出事件")
+    write_parser.set_defaults(func=cmd_write)
+
+    list_parser = subparsers.add_parser("list", help="列出USB设备")
+    list_parser.add_argument("--json", action="store_true", help="以JSON格式输出")
+    list_parser.add_argument("--watch", action="store_true", help="列出后继续监听设备插拔（仅Linux）")
+    list_parser.set_defaults(func=cmd_list)
+
+    auto_parser = subparsers.add_parser("auto", help="制作工位模式：新插入的设备符合规则时自动写入并验证（仅Linux）")
+    auto_parser.add_argument("--iso", required=True, help="源ISO文件")
+    auto_parser.add_argument("--min-size", help="最小容量，如4G")
+    auto_parser.add_argument("--max-size", help="最大容量，如64G")
+    auto_parser.add_argument("--vendor", help="厂商，支持通配符，如\"SanDisk*\"")
+    auto_parser.add_argument("--model", help="型号，支持通配符")
+    auto_parser.add_argument("--serial", help="序列号，支持通配符")
+    auto_parser.add_argument("--any-removable", action="store_true",
+                             help="也接受未标记为可移动的USB磁盘（如移动硬盘）")
+    auto_parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="同时写入的设备总数")
+    auto_parser.add_argument("--usb2-hub-jobs", type=int, default=USB2_HUB_JOBS,
+                             help="每个USB2集线器（或根端口）下同时写入的设备数")
+    auto_parser.add_argument("--usb3-hub-jobs", type=int, default=USB3_HUB_JOBS,
+                             help="每个USB3集线器（或根端口）下同时写入的设备数")
+    auto_parser.add_argument("--controller-jobs", type=int, default=CONTROLLER_JOBS,
+                             help="每个USB主控制器下同时写入的设备数")
+    auto_parser.add_argument("--state-file", help="调度队列状态（进行中、排队、各集线器占用）持续写入该JSON文件")
+    auto_parser.add_argument("--log", help="结果日志文件，每个设备追加一行JSON")
+    auto_parser.add_argument("--no-verify", action="store_true", help="写入后不验证")
+    auto_parser.add_argument("--no-format", action="store_true", help="写入前不格式化设备")
+    auto_parser.add_argument("--no-boot", action="store_true", help="不安装引导程序")
+    auto_parser.add_argument("--pe", help="PE工具ISO路径（默认使用程序目录下的pe.iso）")
+    auto_parser.add_argument("--no-pe", action="store_true", help="不集成PE工具")
+    auto_parser.add_argument("--buffered", action="store_true", help="经过页缓存写入（默认直接写入）")
+    auto_parser.add_argument("--skip-zero", action="store_true", help="跳过全零块")
+    auto_parser.add_argument("--tune", action="store_true", help="新型号设备先试写选择写入参数")
+    auto_parser.add_argument("--erase", choices=ERASE_SCOPES, help="写入前擦除设备，同write命令")
+    auto_parser.add_argument("--json", action="store_true", help="以JSON行格式输出事件")
+    auto_parser.set_defaults(func=cmd_auto)
+
+    return parser
+
+
+def main(argv=None):
+    """命令行主函数，返回退出码"""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if not args.command:
+        parser.print_help()
+        return EXIT_FAILED
+    printer = EventPrinter(as_json=args.json)
+    return args.func(args, printer)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
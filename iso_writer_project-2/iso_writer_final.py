@@ -1,15 +1,21 @@
 import os
 import sys
-import subprocess
 import threading
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 from tkinter import font
 import platform
-import shutil
-import tempfile
 from pathlib import Path
 
+from device_inventory import get_inventory
+from hash_cache import ManifestCache
+from job_control import OperationCancelled
+from progress_meter import format_eta, format_rate
+from usb_writer import USBWriter, list_usb_devices
+
+# 界面采样进度的间隔（毫秒），与写入速度无关
+PROGRESS_POLL_MS = 200
+
 class AdvancedISOWriter:
     def __init__(self, master):
         self.master = master
@@ -18,6 +24,7 @@ class AdvancedISOWriter:
         self.setup_styles()
         self.check_pe_file()
         self.create_widgets()
+        self.start_device_monitor()
         
     def setup_window(self):
         """设置主窗口"""
@@ -43,6 +50,12 @@ class AdvancedISOWriter:
         self.usb_path = tk.StringVar()
         self.status_text = tk.StringVar(value="准备就绪")
         self.progress_value = tk.DoubleVar()
+        self.speed_text = tk.StringVar(value="")
+        # 流水线最近一次发布的进度，由工作线程赋值、界面定时读取
+        self.latest_progress = None
+        self.progress_polling = False
+        self.image_digest = None
+        self.manifest_cache = ManifestCache()
         
         # 获取程序所在目录
         if getattr(sys, 'frozen', False):
@@ -148,6 +161,12 @@ class AdvancedISOWriter:
         self.verify_var = tk.BooleanVar(value=True)
         self.format_var = tk.BooleanVar(value=True)
         self.bootable_var = tk.BooleanVar(value=True)
+        self.direct_io_var = tk.BooleanVar(value=True)
+        self.skip_zero_var = tk.BooleanVar(value=False)
+        self.delta_var = tk.BooleanVar(value=False)
+        self.resume_var = tk.BooleanVar(value=True)
+        self.tune_var = tk.BooleanVar(value=False)
+        self.erase_var = tk.BooleanVar(value=False)
         
         verify_check = ttk.Checkbutton(options_frame, text="写入后验证", variable=self.verify_var)
         verify_check.grid(row=0, column=0, sticky=tk.W, padx=(0, 20))
@@ -158,6 +177,28 @@ class AdvancedISOWriter:
         bootable_check = ttk.Checkbutton(options_frame, text="创建可引导USB", variable=self.bootable_var)
         bootable_check.grid(row=0, column=2, sticky=tk.W)
         
+        direct_io_check = ttk.Checkbutton(options_frame, text="直接写入(绕过缓存)", variable=self.direct_io_var)
+        direct_io_check.grid(row=1, column=0, columnspan=2, sticky=tk.W, pady=(5, 0))
+        
+        skip_zero_check = ttk.Checkbutton(options_frame, text="跳过全零块", variable=self.skip_zero_var)
+        skip_zero_check.grid(row=1, column=2, sticky=tk.W, pady=(5, 0))
+        
+        delta_check = ttk.Checkbutton(options_frame, text="增量写入(只写入与设备现有内容不同的块)",
+                                      variable=self.delta_var)
+        delta_check.grid(row=2, column=0, columnspan=3, sticky=tk.W, pady=(5, 0))
+        
+        resume_check = ttk.Checkbutton(options_frame, text="断点续写(上次写入中断时从断点继续)",
+                                       variable=self.resume_var)
+        resume_check.grid(row=3, column=0, columnspan=3, sticky=tk.W, pady=(5, 0))
+        
+        tune_check = ttk.Checkbutton(options_frame, text="自动调优写入参数(首次写入该设备时测试最佳块大小)",
+                                     variable=self.tune_var)
+        tune_check.grid(row=4, column=0, columnspan=3, sticky=tk.W, pady=(5, 0))
+        
+        erase_check = ttk.Checkbutton(options_frame, text="写入前擦除设备(TRIM，恢复重复使用的U盘的写入速度)",
+                                      variable=self.erase_var)
+        erase_check.grid(row=5, column=0, columnspan=3, sticky=tk.W, pady=(5, 0))
+        
         # 功能说明
         features_frame = ttk.LabelFrame(main_frame, text="🔧 集成功能", padding="15")
         features_frame.grid(row=5, column=0, columnspan=3, sticky=(tk.W, tk.E), pady=(0, 15))
@@ -177,6 +218,10 @@ class AdvancedISOWriter:
         self.status_label = ttk.Label(progress_frame, textvariable=self.status_text, font=('Arial', 9))
         self.status_label.grid(row=1, column=0, sticky=tk.W)
         
+        self.speed_label = ttk.Label(progress_frame, textvariable=self.speed_text, font=('Arial', 9),
+                                     foreground='gray')
+        self.speed_label.grid(row=1, column=1, sticky=tk.E)
+        
         # 按钮区域
         button_frame = ttk.Frame(main_frame)
         button_frame.grid(row=7, column=0, columnspan=3, pady=(15, 0))
@@ -189,6 +234,10 @@ class AdvancedISOWriter:
                                     style='Custom.TButton', width=18, state='disabled')
         self.cancel_btn.pack(side=tk.LEFT, padx=(0, 15))
         
+        self.pause_btn = ttk.Button(button_frame, text="⏸️ 暂停", command=self.toggle_pause, 
+                                   style='Custom.TButton', width=12, state='disabled')
+        self.pause_btn.pack(side=tk.LEFT, padx=(0, 15))
+        
         self.help_btn = ttk.Button(button_frame, text="❓ 帮助", command=self.show_help, 
                                   style='Custom.TButton', width=18)
         self.help_btn.pack(side=tk.LEFT)
@@ -231,47 +280,25 @@ class AdvancedISOWriter:
         
     def get_usb_devices(self):
         """获取USB设备列表"""
-        devices = []
-        system = platform.system()
+        return list_usb_devices()
         
-        try:
-            if system == "Linux":
-                # Linux下扫描块设备
-                result = subprocess.run(['lsblk', '-d', '-n', '-o', 'NAME,SIZE,TYPE,TRAN'], 
-                                      capture_output=True, text=True)
-                if result.returncode == 0:
-                    lines = result.stdout.strip().split('\n')
-                    for line in lines:
-                        parts = line.split()
-                        if len(parts) >= 4 and 'usb' in parts[3].lower():
-                            devices.append({
-                                'path': f"/dev/{parts[0]}",
-                                'size': parts[1],
-                                'name': f"USB设备 ({parts[1]})"
-                            })
-                            
-            elif system == "Windows":
-                # Windows下使用wmic命令
-                result = subprocess.run(['wmic', 'logicaldisk', 'where', 'drivetype=2', 
-                                       'get', 'deviceid,size,freespace'], 
-                                      capture_output=True, text=True)
-                if result.returncode == 0:
-                    lines = result.stdout.strip().split('\n')[1:]  # 跳过标题行
-                    for line in lines:
-                        if line.strip():
-                            parts = line.split()
-                            if len(parts) >= 3:
-                                size_gb = int(parts[2]) / (1024**3) if parts[2].isdigit() else 0
-                                devices.append({
-                                    'path': parts[0].replace(':', ''),
-                                    'size': f"{size_gb:.1f}GB",
-                                    'name': f"可移动磁盘 {parts[0]} ({size_gb:.1f}GB)"
-                                })
-                                
-        except Exception as e:
-            print(f"扫描设备时出错: {e}")
-            
-        return devices
+    def start_device_monitor(self):
+        """Linux下监听U盘插拔：扫描直接使用缓存的设备表，插入或拔出时在状态栏提示"""
+        if platform.system() != "Linux":
+            return
+        inventory = get_inventory()
+        inventory.bus.subscribe(self.on_device_event, "device_added", "device_removed")
+        inventory.start_monitor()
+        
+    def on_device_event(self, event, device):
+        """热插拔事件在监听线程中回调，转到界面线程更新状态"""
+        if not device.is_usb:
+            return
+        if event == "device_added":
+            message = f"检测到新设备: {device.path} {device.display_name()}"
+        else:
+            message = f"设备已移除: {device.path}"
+        self.master.after(0, lambda: self.update_status(message, "normal"))
         
     def show_device_selection(self, devices):
         """显示设备选择对话框"""
@@ -290,7 +317,8 @@ class AdvancedISOWriter:
         listbox_frame = ttk.Frame(selection_window)
         listbox_frame.pack(fill=tk.BOTH, expand=True, padx=20, pady=10)
         
-        listbox = tk.Listbox(listbox_frame, font=('Arial', 10))
+        # 可按住Ctrl/Shift选择多个设备，同时写入
+        listbox = tk.Listbox(listbox_frame, font=('Arial', 10), selectmode=tk.EXTENDED)
         scrollbar = ttk.Scrollbar(listbox_frame, orient="vertical", command=listbox.yview)
         listbox.configure(yscrollcommand=scrollbar.set)
         
@@ -307,8 +335,7 @@ class AdvancedISOWriter:
         def select_device():
             selection = listbox.curselection()
             if selection:
-                selected_device = devices[selection[0]]
-                self.usb_path.set(selected_device['path'])
+                self.usb_path.set(";".join(devices[i]['path'] for i in selection))
                 selection_window.destroy()
             else:
                 messagebox.showwarning("未选择", "请选择一个设备")
@@ -366,264 +393,107 @@ class AdvancedISOWriter:
         if not response:
             return
             
-        # 在新线程中执行写入操作
+        # 在新线程中执行写入操作；制作流程在界面线程中创建，停止按钮随时可以取消它
+        self.usb_writer = self.create_usb_writer()
         self.write_thread = threading.Thread(target=self.write_iso_thread)
         self.write_thread.daemon = True
         self.write_thread.start()
+        self.start_progress_polling()
         
         # 更新UI状态
         self.write_btn.configure(state='disabled')
         self.cancel_btn.configure(state='normal')
+        self.pause_btn.configure(state='normal', text="⏸️ 暂停")
         self.update_status("正在准备制作...", "normal")
         
     def write_iso_thread(self):
         """在线程中执行ISO写入"""
         try:
             iso_file = self.iso_path.get()
-            usb_device = self.usb_path.get()
-            
-            # 阶段1: 准备设备
-            self.master.after(0, lambda: self.update_status("正在准备USB设备...", "normal"))
-            self.master.after(0, lambda: self.update_progress(10))
-            
-            if self.format_var.get():
-                self.format_usb_device(usb_device)
-                
-            # 阶段2: 写入ISO
-            self.master.after(0, lambda: self.update_status("正在写入ISO文件...", "normal"))
-            self.master.after(0, lambda: self.update_progress(30))
-            
-            self.write_iso_to_device(iso_file, usb_device)
-            
-            # 阶段3: 集成PE工具
-            if self.pe_available:
-                self.master.after(0, lambda: self.update_status("正在集成PE工具...", "normal"))
-                self.master.after(0, lambda: self.update_progress(70))
-                
-                self.integrate_pe_tools(usb_device)
-                
-            # 阶段4: 安装引导
-            if self.bootable_var.get():
-                self.master.after(0, lambda: self.update_status("正在安装引导程序...", "normal"))
-                self.master.after(0, lambda: self.update_progress(85))
-                
-                self.install_bootloader(usb_device)
-                
-            # 阶段5: 验证
-            if self.verify_var.get():
-                self.master.after(0, lambda: self.update_status("正在验证写入结果...", "normal"))
-                self.master.after(0, lambda: self.update_progress(95))
-                
-                self.verify_usb_device(usb_device)
+            devices = self.get_target_devices()
+            writer = self.usb_writer
+            
+            if len(devices) > 1:
+                succeeded, failed = writer.run_multiple(iso_file, devices)
+                details = "\n".join(f"{device}: {error}" for device, error in failed.items())
+                if writer.cancel_token.cancelled:
+                    raise OperationCancelled(checkpoint=writer.cancel_token.checkpoint)
+                if not succeeded:
+                    raise Exception(f"所有设备均制作失败:\n{details}")
+                if failed:
+                    self.master.after(0, lambda: messagebox.showwarning(
+                        "部分设备失败", f"成功: {', '.join(succeeded)}\n\n失败:\n{details}"))
+            else:
+                writer.run(iso_file, devices[0])
+            self.image_digest = writer.image_digest
                 
             # 完成
-            self.master.after(0, lambda: self.update_progress(100))
             self.master.after(0, lambda: self.write_completed(True))
             
+        except OperationCancelled as e:
+            # except块结束时e会被删除，先取出值再交给界面线程
+            checkpoint = e.checkpoint
+            self.master.after(0, lambda: self.write_cancelled(checkpoint))
         except Exception as e:
-            self.master.after(0, lambda: self.write_completed(False, str(e)))
-            
-    def format_usb_device(self, usb_device):
-        """格式化USB设备"""
-        system = platform.system()
-        
-        if system == "Linux":
-            # 卸载可能的挂载
-            subprocess.run(["sudo", "umount", f"{usb_device}*"], 
-                          capture_output=True, text=True)
-            
-            # 创建分区表
-            cmd = ["sudo", "parted", usb_device, "--script", "mklabel", "msdos"]
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            if result.returncode != 0:
-                raise Exception(f"创建分区表失败: {result.stderr}")
-                
-            # 创建主分区
-            cmd = ["sudo", "parted", usb_device, "--script", "mkpart", "primary", "fat32", "1MiB", "100%"]
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            if result.returncode != 0:
-                raise Exception(f"创建分区失败: {result.stderr}")
-                
-            # 设置启动标志
-            cmd = ["sudo", "parted", usb_device, "--script", "set", "1", "boot", "on"]
-            subprocess.run(cmd, capture_output=True, text=True)
-            
-            # 格式化分区
-            partition = f"{usb_device}1"
-            cmd = ["sudo", "mkfs.fat", "-F32", partition]
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            if result.returncode != 0:
-                raise Exception(f"格式化分区失败: {result.stderr}")
-                
-        elif system == "Windows":
-            # Windows下格式化
-            cmd = ["format", f"{usb_device}:", "/FS:FAT32", "/Q", "/Y"]
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            if result.returncode != 0:
-                raise Exception(f"格式化失败: {result.stderr}")
-                
-    def write_iso_to_device(self, iso_file, usb_device):
-        """写入ISO到设备"""
-        system = platform.system()
-        block_size = 4 * 1024 * 1024  # 4MB
-        
-        if system == "Linux":
-            cmd = ["sudo", "dd", f"if={iso_file}", f"of={usb_device}", 
-                   f"bs={block_size}", "status=progress"]
-        elif system == "Windows":
-            # Windows下需要特殊处理
-            usb_device_path = f"\\\\.\\{usb_device}:"
-            self.write_iso_windows(iso_file, usb_device_path)
-            return
-            
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, 
-                                 stderr=subprocess.PIPE, universal_newlines=True)
-        
-        iso_size = os.path.getsize(iso_file)
-        
-        while True:
-            output = process.stderr.readline()
-            if output == '' and process.poll() is not None:
-                break
-                
-            if output and "bytes" in output:
-                try:
-                    parts = output.split()
-                    if len(parts) > 0:
-                        bytes_copied = int(parts[0])
-                        progress = min((bytes_copied / iso_size) * 60 + 30, 70)  # 30-70%
-                        self.master.after(0, lambda p=progress: self.update_progress(p))
-                except (ValueError, IndexError):
-                    pass
-                    
-        stdout, stderr = process.communicate()
-        
-        if process.returncode != 0:
-            raise Exception(f"写入ISO失败: {stderr}")
-            
-    def write_iso_windows(self, iso_file, usb_device):
-        """Windows下写入ISO"""
-        try:
-            with open(iso_file, 'rb') as src, open(usb_device, 'wb') as dst:
-                iso_size = os.path.getsize(iso_file)
-                copied = 0
-                block_size = 4 * 1024 * 1024
-                
-                while True:
-                    chunk = src.read(block_size)
-                    if not chunk:
-                        break
-                        
-                    dst.write(chunk)
-                    copied += len(chunk)
-                    
-                    progress = min((copied / iso_size) * 40 + 30, 70)  # 30-70%
-                    self.master.after(0, lambda p=progress: self.update_progress(p))
-                    
-        except PermissionError:
-            raise Exception("需要管理员权限。请以管理员身份运行程序。")
-        except Exception as e:
-            raise Exception(f"写入失败: {str(e)}")
-            
-    def integrate_pe_tools(self, usb_device):
-        """集成PE工具"""
-        if not self.pe_available:
+            msg = str(e)
+            self.master.after(0, lambda: self.write_completed(False, msg))
+            
+    def create_usb_writer(self):
+        """按界面选项创建制作流程，状态消息通过master.after回到界面线程"""
+        writer = USBWriter(pe_path=self.pe_path if self.pe_available else None,
+                           verify=self.verify_var.get(),
+                           format_device=self.format_var.get(),
+                           bootable=self.bootable_var.get(),
+                           direct_io=self.direct_io_var.get(),
+                           skip_zero=self.skip_zero_var.get(),
+                           delta=self.delta_var.get(),
+                           resume=self.resume_var.get(),
+                           tune=self.tune_var.get(),
+                           erase="all" if self.erase_var.get() else None,
+                           manifest_cache=self.manifest_cache,
+                           status_callback=lambda message, status_type: self.master.after(
+                               0, lambda: self.update_status(message, status_type)))
+        writer.bus.subscribe(self.on_progress_event, "progress")
+        return writer
+        
+    def on_progress_event(self, event, **fields):
+        """工作线程中调用：只保存最新进度，由界面定时采样"""
+        self.latest_progress = fields
+        
+    def start_progress_polling(self):
+        """开始按固定间隔刷新进度条和速度"""
+        self.latest_progress = None
+        self.speed_text.set("")
+        if not self.progress_polling:
+            self.progress_polling = True
+            self.poll_progress()
+            
+    def poll_progress(self):
+        """读取最新进度并刷新界面，无论写入多快每秒只刷新固定次数"""
+        if not self.progress_polling:
             return
+        fields = self.latest_progress
+        if fields is not None:
+            self.update_progress(fields["percent"])
+            if fields.get("rate"):
+                self.speed_text.set(f"{format_rate(fields['rate'])}  剩余 {format_eta(fields.get('eta'))}")
+        self.master.after(PROGRESS_POLL_MS, self.poll_progress)
             
-        try:
-            system = platform.system()
-            
-            if system == "Linux":
-                # 挂载USB分区
-                mount_point = tempfile.mkdtemp(prefix="usb_mount_")
-                partition = f"{usb_device}1"
-                
-                cmd = ["sudo", "mount", partition, mount_point]
-                result = subprocess.run(cmd, capture_output=True, text=True)
-                if result.returncode != 0:
-                    raise Exception(f"挂载USB失败: {result.stderr}")
-                
-                try:
-                    # 创建PE目录
-                    pe_dir = os.path.join(mount_point, "PE")
-                    os.makedirs(pe_dir, exist_ok=True)
-                    
-                    # 挂载PE ISO
-                    pe_mount_point = tempfile.mkdtemp(prefix="pe_mount_")
-                    cmd = ["sudo", "mount", "-o", "loop", self.pe_path, pe_mount_point]
-                    subprocess.run(cmd, capture_output=True, text=True)
-                    
-                    try:
-                        # 复制PE文件
-                        cmd = ["sudo", "cp", "-r", f"{pe_mount_point}/.", pe_dir]
-                        subprocess.run(cmd, capture_output=True, text=True)
-                        
-                    finally:
-                        subprocess.run(["sudo", "umount", pe_mount_point], 
-                                     capture_output=True, text=True)
-                        os.rmdir(pe_mount_point)
-                        
-                finally:
-                    subprocess.run(["sudo", "umount", mount_point], 
-                                 capture_output=True, text=True)
-                    os.rmdir(mount_point)
-                    
-            elif system == "Windows":
-                # Windows下直接复制
-                usb_path = f"{usb_device}:\\"
-                pe_dir = os.path.join(usb_path, "PE")
-                os.makedirs(pe_dir, exist_ok=True)
-                
-                # 挂载PE ISO
-                cmd = ["powershell", "-Command", f"Mount-DiskImage -ImagePath '{self.pe_path}'"]
-                subprocess.run(cmd, capture_output=True, text=True)
-                
-                # 获取挂载点并复制文件
-                # 这里简化处理，实际应用中需要获取确切的挂载点
-                
-        except Exception as e:
-            print(f"集成PE工具失败: {e}")
-            
-    def install_bootloader(self, usb_device):
-        """安装引导程序"""
-        system = platform.system()
+    def get_target_devices(self):
+        """设备路径中可用分号分隔多个设备"""
+        return [device.strip() for device in self.usb_path.get().split(";") if device.strip()]
         
-        try:
-            if system == "Linux":
-                # 安装syslinux
-                partition = f"{usb_device}1"
-                cmd = ["sudo", "syslinux", "-i", partition]
-                subprocess.run(cmd, capture_output=True, text=True)
-                
-                # 安装MBR
-                mbr_path = "/usr/lib/syslinux/mbr/mbr.bin"
-                if os.path.exists(mbr_path):
-                    cmd = ["sudo", "dd", f"if={mbr_path}", f"of={usb_device}", "bs=440", "count=1"]
-                    subprocess.run(cmd, capture_output=True, text=True)
-                    
-        except Exception as e:
-            print(f"安装引导程序失败: {e}")
-            
-    def verify_usb_device(self, usb_device):
-        """验证USB设备"""
-        # 简单验证：检查设备是否可读
-        try:
-            if platform.system() == "Linux":
-                result = subprocess.run(["sudo", "fdisk", "-l", usb_device], 
-                                      capture_output=True, text=True)
-                if result.returncode != 0:
-                    raise Exception("设备验证失败")
-        except Exception as e:
-            print(f"验证失败: {e}")
-            
     def update_progress(self, progress):
         """更新进度条"""
         self.progress_value.set(progress)
         
     def write_completed(self, success, error_msg=None):
         """写入完成回调"""
+        self.progress_polling = False
+        self.speed_text.set("")
         self.write_btn.configure(state='normal')
         self.cancel_btn.configure(state='disabled')
+        self.pause_btn.configure(state='disabled', text="⏸️ 暂停")
         
         if success:
             self.progress_value.set(100)
@@ -643,13 +513,41 @@ class AdvancedISOWriter:
             messagebox.showerror("制作失败", f"制作过程中发生错误:\n\n{error_msg}")
             
     def cancel_operation(self):
-        """取消操作"""
+        """取消操作：停止写入并终止正在运行的外部命令"""
         response = messagebox.askyesno("确认取消", "确定要取消当前操作吗？")
-        if response:
-            self.update_status("操作已取消", "warning")
-            self.write_btn.configure(state='normal')
+        if response and getattr(self, 'usb_writer', None) is not None:
+            self.update_status("正在取消...", "warning")
             self.cancel_btn.configure(state='disabled')
-            self.progress_value.set(0)
+            self.pause_btn.configure(state='disabled')
+            # 写线程在下一个块之前刷写并退出，结束后由write_cancelled恢复界面
+            self.usb_writer.cancel()
+            
+    def toggle_pause(self):
+        """暂停或继续写入"""
+        writer = getattr(self, 'usb_writer', None)
+        if writer is None:
+            return
+        if writer.cancel_token.paused:
+            writer.resume()
+            self.pause_btn.configure(text="⏸️ 暂停")
+            self.update_status("已继续", "normal")
+        else:
+            writer.pause()
+            self.pause_btn.configure(text="▶️ 继续")
+            self.update_status("已暂停（当前块写完并刷写后停止）", "warning")
+            
+    def write_cancelled(self, checkpoint):
+        """取消完成回调"""
+        self.progress_polling = False
+        self.speed_text.set("")
+        self.write_btn.configure(state='normal')
+        self.cancel_btn.configure(state='disabled')
+        self.pause_btn.configure(state='disabled', text="⏸️ 暂停")
+        self.progress_value.set(0)
+        message = "操作已取消"
+        if checkpoint:
+            message += f"（已落盘 {checkpoint / (1024 * 1024):.1f} MB）"
+        self.update_status(message, "warning")
             
     def show_help(self):
         """显示帮助信息"""
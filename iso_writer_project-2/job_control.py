@@ -0,0 +1,111 @@
+"""
+任务控制
+协作式取消与暂停：写入引擎、校验器和流水线在块与块之间检查取消令牌，
+取消时同时终止正在运行的外部命令（parted、mkfs、syslinux等）
+"""
+
+import subprocess
+import threading
+
+# 终止外部命令后等待其退出的时间，超时则强制结束
+TERMINATE_TIMEOUT = 5
+
+
+class OperationCancelled(Exception):
+    """操作被用户取消"""
+
+    def __init__(self, message="操作已取消", checkpoint=None):
+        super().__init__(message)
+        # 取消时已确认落盘的写入位置
+        self.checkpoint = checkpoint
+
+
+class CancelToken:
+    """取消/暂停令牌，由界面线程控制、工作线程检查"""
+
+    def __init__(self):
+        self._cancelled = threading.Event()
+        self._running = threading.Event()
+        self._running.set()
+        self._processes = set()
+        self._lock = threading.Lock()
+        # 最近一次确认落盘的写入位置（字节）
+        self.checkpoint = 0
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    @property
+    def paused(self):
+        return not self._running.is_set()
+
+    def cancel(self):
+        """请求取消，并终止正在运行的外部命令"""
+        self._cancelled.set()
+        # 唤醒处于暂停中的工作线程，让它们看到取消请求
+        self._running.set()
+        with self._lock:
+            processes = list(self._processes)
+        for process in processes:
+            self._terminate(process)
+
+    def pause(self):
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    def check(self):
+        """工作线程在块与块之间调用：暂停时阻塞，已取消时抛出OperationCancelled"""
+        if not self._running.is_set():
+            self._running.wait()
+        if self._cancelled.is_set():
+            raise OperationCancelled(checkpoint=self.checkpoint)
+
+    def record_checkpoint(self, offset):
+        """记录已落盘的位置"""
+        self.checkpoint = offset
+
+    def run(self, cmd, **kwargs):
+        """与subprocess.run相同，但取消时终止该命令"""
+        self.check()
+        kwargs.setdefault("capture_output", True)
+        kwargs.setdefault("text", True)
+        capture = kwargs.pop("capture_output")
+        if capture:
+            kwargs.setdefault("stdout", subprocess.PIPE)
+            kwargs.setdefault("stderr", subprocess.PIPE)
+        process = subprocess.Popen(cmd, **kwargs)
+        with self._lock:
+            self._processes.add(process)
+        try:
+            # 注册之后再检查一次，避免cancel恰好发生在启动期间而漏掉终止
+            if self._cancelled.is_set():
+                self._terminate(process)
+            stdout, stderr = process.communicate()
+        finally:
+            with self._lock:
+                self._processes.discard(process)
+        if self._cancelled.is_set():
+            raise OperationCancelled(checkpoint=self.checkpoint)
+        return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+
+    def _terminate(self, process):
+        """先发送SIGTERM，超时仍未退出再强制结束；不阻塞调用方（通常是界面线程）"""
+        if process.poll() is not None:
+            return
+        try:
+            process.terminate()
+        except OSError:
+            return
+        timer = threading.Timer(TERMINATE_TIMEOUT, self._kill_if_alive, args=(process,))
+        timer.daemon = True
+        timer.start()
+
+    def _kill_if_alive(self, process):
+        if process.poll() is None:
+            try:
+                process.kill()
+            except OSError:
+                pass
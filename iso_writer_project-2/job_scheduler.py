@@ -0,0 +1,261 @@
+"""
+多设备写入调度
+同一USB集线器（或同一根端口、同一主控制器）下的设备共享带宽，同时写入过多只会互相拖慢。
+调度器从sysfs得到每个设备所在的集线器和控制器，分别限制其上同时进行的任务数，
+有空位时优先启动剩余字节数最少的任务，并可随时查询队列状态
+"""
+
+import os
+import re
+import time
+import itertools
+import threading
+
+from device_inventory import read_sysfs
+from pipeline import EventBus
+
+# 每个集线器上同时进行的任务数，按集线器的速率（Mbps）区分
+USB2_HUB_JOBS = 2
+USB3_HUB_JOBS = 4
+# 每个USB主控制器上同时进行的任务数
+CONTROLLER_JOBS = 8
+# 超高速（USB3）的最低速率
+SUPER_SPEED = 5000
+
+# sysfs中的USB设备目录名，如"2-1"、"2-1.3.4"（总线-端口.端口...）
+USB_PORT_PATTERN = re.compile(r"^\d+-\d+(\.\d+)*$")
+USB_BUS_PATTERN = re.compile(r"^usb\d+$")
+
+
+class UsbTopology:
+    """设备在USB树中的位置：所在集线器、主控制器及其速率"""
+
+    def __init__(self, controller=None, hub=None, port=None, hub_speed=0, speed=0):
+        # 主控制器的sysfs路径，如/sys/devices/pci0000:00/0000:00:14.0
+        self.controller = controller
+        # 设备所接的集线器，直接接在根端口时为根集线器（如usb2）
+        self.hub = hub
+        # 设备自身的USB端口路径，如2-1.3
+        self.port = port
+        self.hub_speed = hub_speed
+        self.speed = speed
+
+    @classmethod
+    def from_sys_path(cls, sys_path):
+        """从块设备的sysfs路径（BlockDevice.sys_path）解析，不是USB设备时各项为None"""
+        if not sys_path:
+            return cls()
+        parts = sys_path.split("/")
+        bus_index = next((index for index, part in enumerate(parts) if USB_BUS_PATTERN.match(part)), None)
+        if bus_index is None:
+            return cls()
+        port_indexes = [index for index, part in enumerate(parts)
+                        if index > bus_index and USB_PORT_PATTERN.match(part)]
+        if not port_indexes:
+            return cls()
+        port_index = port_indexes[-1]
+        # 上一级端口目录即所在的集线器；没有时接在根集线器上
+        hub_index = port_indexes[-2] if len(port_indexes) > 1 else bus_index
+        controller = "/".join(parts[:bus_index])
+        hub = "/".join(parts[:hub_index + 1])
+        port = "/".join(parts[:port_index + 1])
+        return cls(controller=controller, hub=hub, port=parts[port_index],
+                   hub_speed=cls._read_speed(hub), speed=cls._read_speed(port))
+
+    @staticmethod
+    def _read_speed(usb_dir):
+        text = read_sysfs(os.path.join(usb_dir, "speed"))
+        try:
+            return int(float(text))
+        except ValueError:
+            return 0
+
+    @property
+    def hub_name(self):
+        return os.path.basename(self.hub) if self.hub else None
+
+    @property
+    def controller_name(self):
+        return os.path.basename(self.controller) if self.controller else None
+
+    def to_dict(self):
+        return {"controller": self.controller_name, "hub": self.hub_name, "port": self.port,
+                "hub_speed": self.hub_speed, "speed": self.speed}
+
+
+class ScheduledJob:
+    """调度器中的一个任务；func(job)在独立线程中执行，执行期间调用job.update报告进度"""
+
+    def __init__(self, job_id, name, func, size, remaining, topology):
+        self.id = job_id
+        self.name = name
+        self.func = func
+        self.size = size
+        # 剩余字节数，决定排队时的优先级（续写的任务剩余更少，先启动）
+        self.remaining = remaining
+        self.topology = topology
+        # queued、running、succeeded、failed，未启动就被移除的为cancelled
+        self.status = "queued"
+        self.error = None
+        self.result = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._done = threading.Event()
+
+    def update(self, done):
+        """报告已完成的字节数"""
+        self.remaining = max(0, self.size - done)
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    @property
+    def finished(self):
+        return self._done.is_set()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "bytes": self.size,
+            "remaining": self.remaining,
+            "error": self.error,
+            "topology": self.topology.to_dict(),
+            "waited": round((self.started_at or time.time()) - self.submitted_at, 3),
+            "seconds": round((self.finished_at or time.time()) - self.started_at, 3) if self.started_at else None,
+        }
+
+
+class JobScheduler:
+    """按USB拓扑限制并发的任务调度器；在bus上发布job_queued、job_started、job_finished和queue_changed
+    （字段state为state()的返回值）事件"""
+
+    def __init__(self, max_jobs=None, usb2_hub_jobs=USB2_HUB_JOBS, usb3_hub_jobs=USB3_HUB_JOBS,
+                 controller_jobs=CONTROLLER_JOBS, bus=None):
+        # 总并发数，None时只受集线器和控制器的限制
+        self.max_jobs = max_jobs
+        self.usb2_hub_jobs = max(1, usb2_hub_jobs)
+        self.usb3_hub_jobs = max(1, usb3_hub_jobs)
+        self.controller_jobs = max(1, controller_jobs)
+        self.bus = bus or EventBus()
+        self._queued = []
+        self._running = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._closed = False
+
+    def hub_limit(self, topology):
+        """集线器上的并发上限：USB2集线器（480Mbps）的带宽只够少数几个设备同时写入"""
+        if topology.hub_speed >= SUPER_SPEED:
+            return self.usb3_hub_jobs
+        return self.usb2_hub_jobs
+
+    def submit(self, name, func, size, sys_path=None, remaining=None):
+        """提交任务；sys_path为设备的sysfs路径，用于确定所在集线器；返回ScheduledJob"""
+        topology = UsbTopology.from_sys_path(sys_path)
+        with self._lock:
+            if self._closed:
+                raise Exception("调度器已关闭")
+            job = ScheduledJob(next(self._ids), name, func, size, size if remaining is None else remaining,
+                               topology)
+            self._queued.append(job)
+        self.bus.publish("job_queued", job=job.to_dict())
+        self._dispatch()
+        return job
+
+    def _can_start(self, job, running):
+        if self.max_jobs is not None and len(running) >= self.max_jobs:
+            return False
+        topology = job.topology
+        if topology.hub is not None:
+            on_hub = sum(1 for other in running if other.topology.hub == topology.hub)
+            if on_hub >= self.hub_limit(topology):
+                return False
+        if topology.controller is not None:
+            on_controller = sum(1 for other in running if other.topology.controller == topology.controller)
+            if on_controller >= self.controller_jobs:
+                return False
+        return True
+
+    def _dispatch(self):
+        """启动所有能启动的任务：按剩余字节数从少到多，跳过所在集线器或控制器已满的任务"""
+        started = []
+        with self._lock:
+            for job in sorted(self._queued, key=lambda job: (job.remaining, job.id)):
+                if self._can_start(job, self._running):
+                    self._queued.remove(job)
+                    self._running.append(job)
+                    job.status = "running"
+                    job.started_at = time.time()
+                    started.append(job)
+        for job in started:
+            threading.Thread(target=self._run, args=(job,), name=f"job-{job.id}", daemon=True).start()
+            self.bus.publish("job_started", job=job.to_dict())
+        if started:
+            self.bus.publish("queue_changed", state=self.state())
+
+    def _run(self, job):
+        try:
+            job.result = job.func(job)
+            job.status = "succeeded"
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+        job.finished_at = time.time()
+        with self._lock:
+            self._running.remove(job)
+            self._idle.notify_all()
+        job._done.set()
+        self.bus.publish("job_finished", job=job.to_dict())
+        self.bus.publish("queue_changed", state=self.state())
+        self._dispatch()
+
+    def cancel_queued(self):
+        """移除所有尚未启动的任务，返回被移除的任务"""
+        with self._lock:
+            removed = list(self._queued)
+            self._queued.clear()
+            self._idle.notify_all()
+        for job in removed:
+            job.status = "cancelled"
+            job.finished_at = time.time()
+            job._done.set()
+        if removed:
+            self.bus.publish("queue_changed", state=self.state())
+        return removed
+
+    def shutdown(self, wait=True):
+        """不再接受新任务；wait为True时等待排队和进行中的任务全部结束"""
+        with self._lock:
+            self._closed = True
+            while wait and (self._queued or self._running):
+                self._idle.wait()
+
+    def state(self):
+        """队列状态：进行中和排队的任务，以及每个集线器和控制器的占用情况"""
+        with self._lock:
+            running = list(self._running)
+            queued = sorted(self._queued, key=lambda job: (job.remaining, job.id))
+        hubs = {}
+        controllers = {}
+        for job in running + queued:
+            topology = job.topology
+            if topology.hub is not None:
+                hub = hubs.setdefault(topology.hub_name, {"speed": topology.hub_speed,
+                                                          "limit": self.hub_limit(topology),
+                                                          "running": 0, "queued": 0})
+                hub["running" if job in running else "queued"] += 1
+            if topology.controller is not None:
+                controller = controllers.setdefault(topology.controller_name,
+                                                    {"limit": self.controller_jobs, "running": 0, "queued": 0})
+                controller["running" if job in running else "queued"] += 1
+        return {
+            "running": [job.to_dict() for job in running],
+            "queued": [job.to_dict() for job in queued],
+            "hubs": hubs,
+            "controllers": controllers,
+            "max_jobs": self.max_jobs,
+        }
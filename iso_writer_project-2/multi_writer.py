@@ -0,0 +1,322 @@
+"""
+多设备并行写入
+同一份ISO同时写入多个USB设备：ISO只读取一次，数据块在各设备的写线程之间共享，
+每个设备独立上报进度、独立校验，单个设备失败不影响其他设备
+"""
+
+import os
+import mmap
+import queue
+import threading
+
+from job_control import OperationCancelled
+from verify_utils import ImageVerifier
+from write_engine import (DEFAULT_BLOCK_SIZE, DEFAULT_QUEUE_DEPTH, BufferPool, DataBlock,
+                          ISOWriteEngine, StreamHasher)
+
+# 某设备队列已满而其他设备在等待数据，累计等待超过DETACH_TIMEOUT秒后让该设备脱离共享读取
+DETACH_TIMEOUT = 0.5
+STALL_POLL = 0.05
+DEFAULT_VERIFY_WORKERS = 2
+
+
+class DeviceJob:
+    """单个目标设备的写入任务"""
+
+    def __init__(self, device, engine, queue_depth):
+        self.device = device
+        self.engine = engine
+        self.queue = queue.Queue(maxsize=queue_depth)
+        # pending -> writing -> verifying -> done，任一阶段出错变为failed
+        self.status = "pending"
+        self.error = None
+        self.verified = None
+        # 读线程因该设备而让其他设备空等的累计时间
+        self.stall_time = 0.0
+        # 脱离共享读取时尚未收到的第一个块的偏移，之后由写线程直接从ISO映射读取
+        self.resume_offset = None
+        self.fd = None
+
+    @property
+    def failed(self):
+        return self.error is not None
+
+
+class MultiDeviceWriter:
+    """一份ISO并行写入多个设备"""
+
+    def __init__(self, block_size=DEFAULT_BLOCK_SIZE, queue_depth=DEFAULT_QUEUE_DEPTH,
+                 direct_io=False, sync_interval=None, hash_algorithm="sha256", verify=True,
+                 verify_workers=DEFAULT_VERIFY_WORKERS, progress_callback=None, status_callback=None,
+                 cancel_token=None):
+        self.block_size = block_size
+        self.queue_depth = max(1, queue_depth)
+        self.direct_io = direct_io
+        self.sync_interval = sync_interval
+        # 写入时只计算一次ISO摘要，所有设备的校验共用
+        self.hash_algorithm = hash_algorithm
+        self.verify = verify
+        self.verify_workers = verify_workers
+        # progress_callback(设备, 已完成字节数, 总字节数)，写入和校验阶段都会调用
+        self.progress_callback = progress_callback
+        # status_callback(设备, 状态)
+        self.status_callback = status_callback
+        # 所有设备共用一个取消令牌，暂停时整批暂停
+        self.cancel_token = cancel_token
+        self.digest = None
+
+    def write(self, iso_file, devices):
+        """把ISO写入所有设备，返回每个设备的DeviceJob（顺序与devices一致）"""
+        iso_size = os.path.getsize(iso_file)
+        self.digest = None
+
+        jobs = []
+        for device in devices:
+            engine = ISOWriteEngine(block_size=self.block_size, direct_io=self.direct_io,
+                                    sync_interval=self.sync_interval,
+                                    progress_callback=self._device_progress(device),
+                                    cancel_token=self.cancel_token)
+            job = DeviceJob(device, engine, self.queue_depth)
+            try:
+                job.fd = engine.open_target(device)
+            except Exception as e:
+                self._fail(job, e)
+            jobs.append(job)
+
+        active = [job for job in jobs if not job.failed]
+        if not active:
+            return jobs
+
+        # 扇区大小都是2的幂，按最大扇区对齐即可满足所有设备的O_DIRECT要求
+        block_size = self.block_size
+        sector_size = max(job.engine.sector_size for job in active)
+        block_size += -block_size % sector_size
+
+        src = open(iso_file, 'rb', buffering=0)
+        source_map = None
+        pool = None
+        try:
+            if iso_size:
+                try:
+                    source_map = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+                except (OSError, ValueError, OverflowError):
+                    source_map = None
+            if source_map is None:
+                # 所有设备共享同一组缓冲区，最慢的设备决定缓冲区何时归还
+                pool = BufferPool(self.queue_depth + 2, block_size)
+
+            hash_queue = None
+            hash_done = threading.Event()
+            threads = []
+            if self.hash_algorithm:
+                hash_queue = queue.Queue(maxsize=self.queue_depth)
+                threads.append(threading.Thread(target=self._hasher_loop,
+                                                args=(hash_queue, iso_size, hash_done),
+                                                name="multi-hasher", daemon=True))
+            else:
+                hash_done.set()
+            for job in active:
+                threads.append(threading.Thread(target=self._device_loop,
+                                                args=(job, iso_file, iso_size, source_map, hash_done),
+                                                name=f"multi-writer-{job.device}", daemon=True))
+            threads.append(threading.Thread(target=self._reader_loop,
+                                            args=(src, source_map, iso_size, block_size, pool,
+                                                  active, hash_queue),
+                                            name="multi-reader", daemon=True))
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            src.close()
+            if source_map is not None:
+                source_map.close()
+            if pool is not None:
+                pool.close()
+
+        return jobs
+
+    def _reader_loop(self, src, source_map, iso_size, block_size, pool, jobs, hash_queue):
+        """读线程：ISO每个块只读取一次，分发给所有仍在共享读取的设备和摘要线程"""
+        can_prefetch = source_map is not None and hasattr(source_map, 'madvise') \
+            and hasattr(mmap, 'MADV_WILLNEED')
+        try:
+            for offset in range(0, iso_size, block_size):
+                if all(job.failed for job in jobs):
+                    # 所有设备都已失败，不必再读取
+                    break
+                consumers = [job for job in jobs if not job.failed and job.resume_offset is None]
+                if not consumers and hash_queue is None:
+                    break
+                if self.cancel_token is not None:
+                    self.cancel_token.check()
+                length = min(block_size, iso_size - offset)
+                if source_map is not None:
+                    if can_prefetch:
+                        start = offset - offset % mmap.PAGESIZE
+                        source_map.madvise(mmap.MADV_WILLNEED, start, offset + length - start)
+                    view = memoryview(source_map)[offset:offset + length]
+                    on_release = None
+                else:
+                    buf = pool.acquire()
+                    src.seek(offset)
+                    filled = 0
+                    with memoryview(buf) as target:
+                        while filled < length:
+                            n = src.readinto(target[filled:length])
+                            if not n:
+                                break
+                            filled += n
+                    if filled < length:
+                        pool.release(buf)
+                        raise Exception(f"ISO文件在偏移 {offset + filled} 处提前结束")
+                    view = memoryview(buf)[:length]
+                    on_release = lambda b=buf: pool.release(b)
+
+                block = DataBlock(offset, length, view, on_release,
+                                  consumers=len(consumers) + (1 if hash_queue is not None else 0))
+                if hash_queue is not None:
+                    hash_queue.put(block)
+                for job in consumers:
+                    self._deliver(job, block, consumers, source_map is not None)
+        except Exception as e:
+            error = e if isinstance(e, OperationCancelled) else Exception(f"读取ISO失败: {e}")
+            for job in jobs:
+                if not job.failed:
+                    self._fail(job, error)
+        finally:
+            # 无论成功与否都发送结束标记，写线程和摘要线程据此退出
+            for job in jobs:
+                job.queue.put(None)
+            if hash_queue is not None:
+                hash_queue.put(None)
+
+    def _deliver(self, job, block, consumers, can_detach):
+        """把数据块交给一个设备；该设备明显慢于其他设备时让其脱离共享读取"""
+        while True:
+            if job.failed:
+                block.release()
+                return
+            try:
+                job.queue.put(block, timeout=STALL_POLL)
+                return
+            except queue.Full:
+                if not can_detach or not any(other.queue.empty() for other in consumers if other is not job):
+                    continue
+                # 其他设备已在等待数据：慢设备之后直接从ISO映射读取，不再拖慢整批写入
+                job.stall_time += STALL_POLL
+                if job.stall_time >= DETACH_TIMEOUT:
+                    job.resume_offset = block.offset
+                    block.release()
+                    return
+
+    def _device_loop(self, job, iso_file, iso_size, source_map, hash_done):
+        """设备写线程：写入、刷写，然后独立校验"""
+        engine = job.engine
+        self._set_status(job, "writing")
+        try:
+            while True:
+                block = job.queue.get()
+                if block is None:
+                    break
+                try:
+                    if not job.failed:
+                        engine.write_block(job.fd, block.offset, block.view)
+                        engine.advance(job.fd, block.offset + block.length, iso_size)
+                except OperationCancelled as e:
+                    self._fail(job, e)
+                except Exception as e:
+                    # 出错后继续排空队列，保证读线程不会阻塞
+                    self._fail(job, Exception(f"写入设备失败 (偏移 {block.offset}): {e}"))
+                finally:
+                    block.release()
+
+            if not job.failed and job.resume_offset is not None:
+                self._catch_up(job, source_map, iso_size)
+            if not job.failed:
+                os.fsync(job.fd)
+                engine.bytes_flushed = engine.bytes_written
+                if engine.bytes_written != iso_size:
+                    raise Exception(f"写入不完整: {engine.bytes_written}/{iso_size} 字节")
+                if engine.progress_callback:
+                    engine.progress_callback(engine.bytes_written, iso_size)
+        except Exception as e:
+            self._fail(job, e)
+        finally:
+            os.close(job.fd)
+
+        if job.failed or not self.verify:
+            if not job.failed:
+                self._set_status(job, "done")
+            return
+
+        # 等待摘要线程结束，各设备的回读校验互相并行
+        hash_done.wait()
+        self._set_status(job, "verifying")
+        verifier = ImageVerifier(algorithm=self.hash_algorithm or "sha256",
+                                 workers=self.verify_workers,
+                                 progress_callback=self._device_progress(job.device),
+                                 cancel_token=self.cancel_token)
+        try:
+            job.verified = verifier.verify(iso_file, job.device, self.digest)
+        except Exception as e:
+            self._fail(job, e)
+            return
+        if not job.verified:
+            self._fail(job, Exception("验证失败：设备上的数据与ISO不一致"))
+            return
+        self._set_status(job, "done")
+
+    def _catch_up(self, job, source_map, iso_size):
+        """脱离共享读取的设备从续写位置起直接写出ISO映射的切片"""
+        engine = job.engine
+        block_size = engine.block_size + (-engine.block_size % engine.sector_size)
+        offset = job.resume_offset
+        try:
+            while offset < iso_size:
+                if job.failed:
+                    return
+                length = min(block_size, iso_size - offset)
+                with memoryview(source_map)[offset:offset + length] as view:
+                    engine.write_block(job.fd, offset, view)
+                offset += length
+                engine.advance(job.fd, offset, iso_size)
+        except OperationCancelled as e:
+            self._fail(job, e)
+        except Exception as e:
+            self._fail(job, Exception(f"写入设备失败 (偏移 {offset}): {e}"))
+
+    def _hasher_loop(self, hash_queue, iso_size, hash_done):
+        """摘要线程：只在收到完整ISO数据时给出摘要"""
+        hasher = StreamHasher(self.hash_algorithm)
+        hashed = 0
+        try:
+            while True:
+                block = hash_queue.get()
+                if block is None:
+                    break
+                try:
+                    hasher.update(block.view)
+                    hashed += block.length
+                finally:
+                    block.release()
+            if hashed == iso_size:
+                self.digest = hasher.finish()[0]
+        finally:
+            hash_done.set()
+
+    def _device_progress(self, device):
+        if not self.progress_callback:
+            return None
+        return lambda done, total: self.progress_callback(device, done, total)
+
+    def _set_status(self, job, status):
+        job.status = status
+        if self.status_callback:
+            self.status_callback(job.device, status)
+
+    def _fail(self, job, error):
+        if job.failed:
+            return
+        job.error = error
+        self._set_status(job, "failed")
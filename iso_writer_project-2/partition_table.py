@@ -0,0 +1,203 @@
+"""
+分区表直接生成
+在内存中生成MBR或GPT分区表（含保护性MBR、启动标志和GPT备份），与FAT32文件系统一起直接写到磁盘，
+最后只通知内核重新读取一次分区表；不调用parted和mkfs，避免每条命令都重新探测设备、触发udev
+"""
+
+import os
+import uuid
+import zlib
+import struct
+
+from blockdev_utils import (datasync, get_device_size, get_logical_sector_size, is_block_device,
+                            reread_partitions)
+from fat32_builder import Fat32Builder
+from write_engine import write_all
+
+# 分区起点按1MiB对齐
+PARTITION_ALIGNMENT = 1024 * 1024
+GPT_ENTRY_COUNT = 128
+GPT_ENTRY_SIZE = 128
+GPT_HEADER_SIZE = 92
+GPT_REVISION = 0x00010000
+MBR_PARTITION_OFFSET = 446
+MBR_MAX_PARTITIONS = 4
+# MBR中LBA和扇区数为32位
+MBR_MAX_SECTORS = 0xFFFFFFFF
+
+# 分区类型：(MBR类型码, GPT类型GUID)
+PARTITION_TYPES = {
+    "fat32": (0x0C, "EBD0A0A2-B9E5-4433-87C0-68B6B72699C7"),
+    "esp": (0xEF, "C12A7328-F81F-11D2-BA4B-00A0C93EC93B"),
+}
+PROTECTIVE_MBR_TYPE = 0xEE
+
+
+def _chs(lba):
+    """LBA换算为MBR中的CHS（255磁头、63扇区），超出范围时使用最大值"""
+    if lba >= 1024 * 255 * 63:
+        return b"\xFE\xFF\xFF"
+    cylinder = lba // (255 * 63)
+    head = (lba // 63) % 255
+    sector = lba % 63 + 1
+    return bytes((head, sector | ((cylinder >> 2) & 0xC0), cylinder & 0xFF))
+
+
+def _mbr_entry(bootable, type_code, start_lba, sectors):
+    start_lba = min(start_lba, MBR_MAX_SECTORS)
+    sectors = min(sectors, MBR_MAX_SECTORS - start_lba)
+    return (bytes((0x80 if bootable else 0,)) + _chs(start_lba) + bytes((type_code,))
+            + _chs(start_lba + sectors - 1) + struct.pack("<II", start_lba, sectors))
+
+
+class Partition:
+    """分区表中的一个分区；label不为None时提交分区表时同时格式化为FAT32"""
+
+    def __init__(self, number, start, size, kind="fat32", bootable=False, name="", label=None):
+        self.number = number
+        # 起点和大小均为字节
+        self.start = start
+        self.size = size
+        self.kind = kind
+        self.bootable = bootable
+        # GPT分区名
+        self.name = name
+        self.label = label
+        self.guid = uuid.uuid4()
+
+    @property
+    def end(self):
+        return self.start + self.size
+
+
+class PartitionTable:
+    """MBR（msdos）或GPT分区表"""
+
+    def __init__(self, disk_size, scheme="mbr", sector_size=512):
+        if scheme not in ("mbr", "gpt"):
+            raise Exception(f"不支持的分区表类型: {scheme}")
+        self.scheme = scheme
+        self.sector_size = sector_size
+        self.disk_sectors = disk_size // sector_size
+        self.partitions = []
+        self.disk_guid = uuid.uuid4()
+        self.disk_signature = os.urandom(4)
+        # GPT分区项数组占用的扇区数
+        self.entry_sectors = -(-GPT_ENTRY_COUNT * GPT_ENTRY_SIZE // sector_size)
+        if scheme == "gpt":
+            self.first_usable = 2 + self.entry_sectors
+            self.last_usable = self.disk_sectors - 2 - self.entry_sectors
+        else:
+            self.first_usable = 1
+            self.last_usable = self.disk_sectors - 1
+        if self.last_usable * sector_size < 2 * PARTITION_ALIGNMENT:
+            raise Exception("设备太小，无法创建分区")
+
+    @classmethod
+    def for_device(cls, fd, scheme="mbr"):
+        return cls(get_device_size(fd), scheme, get_logical_sector_size(fd))
+
+    def add(self, size=None, kind="fat32", bootable=False, name="", label=None):
+        """在上一个分区之后添加分区，起点按1MiB对齐；size为None时占用剩余全部空间"""
+        if kind not in PARTITION_TYPES:
+            raise Exception(f"不支持的分区类型: {kind}")
+        if self.scheme == "mbr" and len(self.partitions) >= MBR_MAX_PARTITIONS:
+            raise Exception("MBR分区表最多只能有4个主分区")
+        previous_end = self.partitions[-1].end if self.partitions else self.first_usable * self.sector_size
+        start = -(-previous_end // PARTITION_ALIGNMENT) * PARTITION_ALIGNMENT
+        limit = (self.last_usable + 1) * self.sector_size
+        if size is None:
+            size = limit - start
+        size -= size % self.sector_size
+        if size <= 0 or start + size > limit:
+            raise Exception("设备空间不足，无法创建分区")
+        partition = Partition(len(self.partitions) + 1, start, size, kind, bootable, name, label)
+        self.partitions.append(partition)
+        return partition
+
+    # ------------------------------------------------------------------
+    # 生成
+
+    def _mbr(self):
+        sector = bytearray(self.sector_size)
+        sector[440:444] = self.disk_signature
+        if self.scheme == "gpt":
+            entries = [_mbr_entry(False, PROTECTIVE_MBR_TYPE, 1, self.disk_sectors - 1)]
+        else:
+            entries = [_mbr_entry(part.bootable, PARTITION_TYPES[part.kind][0], part.start // self.sector_size,
+                                  part.size // self.sector_size) for part in self.partitions]
+        for index, entry in enumerate(entries):
+            offset = MBR_PARTITION_OFFSET + index * 16
+            sector[offset:offset + 16] = entry
+        sector[510:512] = b"\x55\xAA"
+        return sector
+
+    def _gpt_entries(self):
+        entries = bytearray(self.entry_sectors * self.sector_size)
+        for index, part in enumerate(self.partitions):
+            # EFI系统分区和普通数据分区都不需要属性位；启动标志由类型GUID表示
+            type_guid = uuid.UUID(PARTITION_TYPES[part.kind][1])
+            name = part.name.encode("utf-16-le")[:72]
+            struct.pack_into("<16s16sQQQ72s", entries, index * GPT_ENTRY_SIZE, type_guid.bytes_le,
+                             part.guid.bytes_le, part.start // self.sector_size,
+                             part.end // self.sector_size - 1, 0, name)
+        return entries
+
+    def _gpt_header(self, current_lba, backup_lba, entries_lba, entries_crc):
+        header = bytearray(self.sector_size)
+        struct.pack_into("<8sIIIIQQQQ16sQIII", header, 0, b"EFI PART", GPT_REVISION, GPT_HEADER_SIZE, 0, 0,
+                         current_lba, backup_lba, self.first_usable, self.last_usable,
+                         self.disk_guid.bytes_le, entries_lba, GPT_ENTRY_COUNT, GPT_ENTRY_SIZE, entries_crc)
+        struct.pack_into("<I", header, 16, zlib.crc32(bytes(header[:GPT_HEADER_SIZE])))
+        return header
+
+    def head(self):
+        """磁盘开头到第一个分区之前的全部内容（MBR、GPT主表，其余清零以去掉旧的引导代码和签名）"""
+        length = self.partitions[0].start if self.partitions else PARTITION_ALIGNMENT
+        region = bytearray(length)
+        region[:self.sector_size] = self._mbr()
+        if self.scheme == "gpt":
+            entries = self._gpt_entries()
+            header = self._gpt_header(1, self.disk_sectors - 1, 2, zlib.crc32(entries))
+            region[self.sector_size:2 * self.sector_size] = header
+            region[2 * self.sector_size:2 * self.sector_size + len(entries)] = entries
+        return region
+
+    def tail(self):
+        """磁盘末尾的内容，返回(偏移, 数据)：GPT为备份分区项和备份表头；
+        MBR时清零同一区域，避免旧的GPT备份表头让工具误判"""
+        start_lba = self.disk_sectors - 1 - self.entry_sectors
+        region = bytearray((self.entry_sectors + 1) * self.sector_size)
+        if self.scheme == "gpt":
+            entries = self._gpt_entries()
+            region[:len(entries)] = entries
+            region[len(entries):] = self._gpt_header(self.disk_sectors - 1, 1, start_lba, zlib.crc32(entries))
+        return start_lba * self.sector_size, region
+
+    # ------------------------------------------------------------------
+    # 写入
+
+    def commit(self, fd, cancel_token=None):
+        """把分区表和需要格式化的FAT32分区写到整个磁盘的fd，刷写后通知内核重新读取分区表；
+        分区表最后写入，中途失败时磁盘上不会留下指向未格式化分区的新分区表。
+        返回内核是否已重新读取分区表（目标是普通文件时为False），分区仍被占用时抛出异常"""
+        if not self.partitions:
+            raise Exception("分区表中没有分区")
+        tail_offset, tail = self.tail()
+        write_all(fd, tail, tail_offset)
+        for part in self.partitions:
+            if part.label is None:
+                continue
+            # 通过整个磁盘的fd按偏移写入，不依赖分区设备节点是否已经出现
+            builder = Fat32Builder(part.size, label=part.label, hidden_sectors=part.start // self.sector_size,
+                                   sector_size=self.sector_size)
+            builder.write(fd, part.start, cancel_token=cancel_token)
+        if cancel_token is not None:
+            cancel_token.check()
+        write_all(fd, self.head(), 0)
+        datasync(fd)
+        if not is_block_device(fd):
+            return False
+        if not reread_partitions(fd):
+            raise Exception("内核重新读取分区表失败，设备上的分区可能仍被挂载或占用")
+        return True
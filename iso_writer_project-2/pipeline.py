@@ -0,0 +1,211 @@
+"""
+阶段流水线
+把制作过程拆成可组合的阶段，按依赖关系调度，互不依赖的阶段并发执行；
+阶段通过事件总线发布状态和进度，图形界面、命令行或批量任务按需订阅
+"""
+
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from job_control import OperationCancelled
+from progress_meter import DEFAULT_SAMPLE_INTERVAL, ProgressMeter
+
+
+class EventBus:
+    """线程安全的事件总线，回调形式为callback(事件名, **字段)"""
+
+    def __init__(self):
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback, *events):
+        """订阅事件，不指定事件名时接收所有事件，返回用于取消订阅的句柄"""
+        entry = (callback, frozenset(events))
+        with self._lock:
+            self._subscribers.append(entry)
+        return entry
+
+    def unsubscribe(self, handle):
+        with self._lock:
+            if handle in self._subscribers:
+                self._subscribers.remove(handle)
+
+    def publish(self, event, **fields):
+        """发布事件；回调在发布者线程中执行，回调抛出的异常不影响流水线"""
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback, events in subscribers:
+            if events and event not in events:
+                continue
+            try:
+                callback(event, **fields)
+            except Exception as e:
+                print(f"事件回调出错 ({event}): {e}")
+
+
+class Stage:
+    """流水线中的一个阶段"""
+
+    def __init__(self, name, func, requires=(), weight=1, title=None):
+        self.name = name
+        # func(context)，context为StageContext
+        self.func = func
+        # 依赖的阶段名；流水线中不存在的阶段视为已满足
+        self.requires = tuple(requires)
+        # 在总体进度中所占的权重
+        self.weight = weight
+        self.title = title or name
+
+
+class StageContext:
+    """阶段执行时可用的接口：共享状态、状态消息和阶段内进度"""
+
+    def __init__(self, pipeline, stage):
+        self.pipeline = pipeline
+        self.stage = stage
+        self.state = pipeline.state
+        self.cancel_token = pipeline.cancel_token
+
+    def check(self):
+        """阶段内部的取消/暂停检查点"""
+        if self.cancel_token is not None:
+            self.cancel_token.check()
+
+    def status(self, message, level="normal"):
+        self.pipeline.bus.publish("status", stage=self.stage.name, message=message, level=level)
+
+    def progress(self, fraction, done=None, total=None):
+        """上报阶段内进度（0到1），可同时给出字节数用于计算速度"""
+        self.pipeline.set_stage_progress(self.stage.name, fraction, done, total)
+
+    def bytes_progress(self, done, total):
+        """按字节上报进度，可直接作为写入引擎和校验器的progress_callback"""
+        self.pipeline.set_stage_progress(self.stage.name, done / total if total else 1.0, done, total)
+
+
+class Pipeline:
+    """按依赖关系调度阶段，可并发的阶段同时执行"""
+
+    def __init__(self, stages, bus=None, max_workers=None, progress_interval=DEFAULT_SAMPLE_INTERVAL,
+                 cancel_token=None):
+        self.stages = list(stages)
+        self.bus = bus or EventBus()
+        self.max_workers = max_workers or max(1, len(self.stages))
+        # 进度事件按固定间隔发布，与阶段上报进度的频率无关
+        self.progress_interval = progress_interval
+        # 取消后不再启动新阶段，正在执行的阶段自行在检查点退出
+        self.cancel_token = cancel_token
+        self.state = {}
+        self.errors = {}
+        self.skipped = []
+        self._fractions = {}
+        self._meters = {}
+        self._active_meter = None
+        self._last_published = None
+
+    def set_stage_progress(self, name, fraction, done=None, total=None):
+        """记录某阶段的进度；只做赋值，可在写线程中每个块调用"""
+        self._fractions[name] = min(max(fraction, 0.0), 1.0)
+        if done is not None:
+            meter = self._meters.get(name)
+            if meter is None:
+                meter = self._meters[name] = ProgressMeter(total or 0)
+            meter.update(done, total)
+            self._active_meter = name
+
+    def sample_progress(self):
+        """汇总各阶段进度，返回(总体百分比, 当前阶段, 采样结果或None)"""
+        fractions = self._fractions.copy()
+        total_weight = sum(stage.weight for stage in self.stages) or 1
+        done = sum(stage.weight * fractions.get(stage.name, 0.0) for stage in self.stages)
+        name = self._active_meter
+        sample = self._meters[name].sample() if name is not None else None
+        return done / total_weight * 100, name, sample
+
+    def _publish_progress(self):
+        percent, name, sample = self.sample_progress()
+        fields = {"percent": percent, "stage": name}
+        if sample is not None:
+            fields.update(done=sample.done, total=sample.total, rate=sample.rate, eta=sample.eta)
+        key = (round(percent, 1), name, sample.done if sample is not None else None)
+        if key == self._last_published:
+            return
+        self._last_published = key
+        self.bus.publish("progress", **fields)
+
+    def _progress_loop(self, stop_event):
+        """采样线程：按固定间隔发布进度"""
+        while not stop_event.wait(self.progress_interval):
+            self._publish_progress()
+
+    def run(self, **state):
+        """执行所有阶段，返回共享状态；有阶段失败时在其余阶段结束后抛出第一个异常"""
+        self.state.update(state)
+        names = {stage.name for stage in self.stages}
+        pending = list(self.stages)
+        finished = set()
+        running = {}
+
+        self.bus.publish("pipeline_started", stages=[stage.name for stage in self.stages])
+        stop_event = threading.Event()
+        sampler = threading.Thread(target=self._progress_loop, args=(stop_event,),
+                                   name="pipeline-progress", daemon=True)
+        sampler.start()
+        try:
+            self._schedule(pending, finished, running, names)
+        finally:
+            stop_event.set()
+            sampler.join()
+            self._publish_progress()
+
+        self.bus.publish("pipeline_finished", success=not self.errors,
+                         failed=list(self.errors), skipped=list(self.skipped))
+        if self.errors:
+            # 按阶段定义顺序抛出最早的失败
+            for stage in self.stages:
+                if stage.name in self.errors:
+                    raise self.errors[stage.name]
+        if self.cancel_token is not None and self.cancel_token.cancelled:
+            raise OperationCancelled(checkpoint=self.cancel_token.checkpoint)
+        return self.state
+
+    def _schedule(self, pending, finished, running, names):
+        """依赖满足的阶段提交到线程池，直到所有阶段结束"""
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for stage in list(pending):
+                    requires = [name for name in stage.requires if name in names]
+                    cancelled = self.cancel_token is not None and self.cancel_token.cancelled
+                    if cancelled or any(name in self.errors or name in self.skipped for name in requires):
+                        # 已取消或依赖失败，该阶段不再执行
+                        pending.remove(stage)
+                        self.skipped.append(stage.name)
+                        self.bus.publish("stage_skipped", stage=stage.name)
+                    elif all(name in finished for name in requires):
+                        pending.remove(stage)
+                        self.bus.publish("stage_started", stage=stage.name, title=stage.title)
+                        running[executor.submit(stage.func, StageContext(self, stage))] = stage
+                if not running:
+                    # 没有阶段在运行而仍有阶段的依赖无法满足（循环依赖），记为失败而不是当作成功
+                    for stage in pending:
+                        self.skipped.append(stage.name)
+                        self.errors[stage.name] = Exception(f"阶段 {stage.name} 的依赖无法满足: "
+                                                            f"{', '.join(stage.requires)}")
+                        self.bus.publish("stage_skipped", stage=stage.name)
+                    pending.clear()
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    error = future.exception()
+                    if isinstance(error, OperationCancelled):
+                        self.errors[stage.name] = error
+                        self.bus.publish("stage_cancelled", stage=stage.name, checkpoint=error.checkpoint)
+                    elif error is not None:
+                        self.errors[stage.name] = error
+                        self.bus.publish("stage_failed", stage=stage.name, error=str(error))
+                    else:
+                        finished.add(stage.name)
+                        self.set_stage_progress(stage.name, 1.0)
+                        self.bus.publish("stage_finished", stage=stage.name)
@@ -0,0 +1,87 @@
+"""
+进度计数与采样
+写线程每个块只做一次赋值，不加锁也不触发界面回调；
+界面按固定频率采样，计算平滑后的速度和剩余时间，界面开销与写入速度无关
+"""
+
+import time
+
+DEFAULT_SMOOTHING = 0.3
+DEFAULT_SAMPLE_INTERVAL = 0.2  # 秒
+
+
+class ProgressSample:
+    """一次采样的结果"""
+
+    __slots__ = ('done', 'total', 'rate', 'eta', 'elapsed')
+
+    def __init__(self, done, total, rate, eta, elapsed):
+        self.done = done
+        self.total = total
+        # 平滑后的速度（字节/秒）
+        self.rate = rate
+        # 预计剩余秒数，无法估计时为None
+        self.eta = eta
+        self.elapsed = elapsed
+
+    @property
+    def fraction(self):
+        return min(self.done / self.total, 1.0) if self.total else 0.0
+
+
+class ProgressMeter:
+    """字节进度计数器"""
+
+    def __init__(self, total=0, smoothing=DEFAULT_SMOOTHING):
+        self.total = total
+        self.done = 0
+        self.smoothing = smoothing
+        self.rate = None
+        self._start = time.monotonic()
+        self._last_time = self._start
+        self._last_done = 0
+
+    def update(self, done, total=None):
+        """由写线程调用：记录当前已完成的字节数"""
+        if total is not None:
+            self.total = total
+        self.done = done
+
+    def sample(self):
+        """由采样方按固定频率调用，返回ProgressSample"""
+        now = time.monotonic()
+        done = self.done
+        interval = now - self._last_time
+        if interval > 0:
+            instant = max(done - self._last_done, 0) / interval
+            if self.rate is None:
+                self.rate = instant
+            else:
+                # 指数平滑，避免速度显示随单次刷写大幅跳动
+                self.rate = self.smoothing * instant + (1 - self.smoothing) * self.rate
+        self._last_time = now
+        self._last_done = done
+
+        eta = None
+        if self.total and done >= self.total:
+            eta = 0.0
+        elif self.total and self.rate:
+            eta = (self.total - done) / self.rate
+        return ProgressSample(done, self.total, self.rate or 0.0, eta, now - self._start)
+
+
+def format_rate(rate):
+    """把字节/秒格式化为MB/s"""
+    return f"{rate / (1024 * 1024):.1f} MB/s"
+
+
+def format_eta(seconds):
+    """把剩余秒数格式化为 时:分:秒 或 分:秒"""
+    if seconds is None:
+        return "--:--"
+    seconds = int(seconds + 0.5)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes:02d}:{seconds:02d}"
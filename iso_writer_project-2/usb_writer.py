@@ -0,0 +1,559 @@
+"""
+USB制作流程
+格式化、写入ISO、验证、集成PE工具和安装引导的具体实现，不依赖任何界面库，
+图形界面和命令行共用
+"""
+
+import os
+import platform
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from blockdev_utils import partition_path, user_mount_options, wait_for_partitions
+from device_erase import DeviceEraser, unused_start
+from device_inventory import get_inventory
+from device_tuner import DeviceTuner, TuningCache, device_identity
+from hash_cache import BlockManifest, ManifestCache
+from iso_catalog import CatalogCache
+from job_control import CancelToken, OperationCancelled
+from multi_writer import MultiDeviceWriter
+from partition_table import PartitionTable
+from pipeline import EventBus, Pipeline, Stage
+from verify_utils import ImageVerifier
+from write_engine import ISOWriteEngine, open_device
+from write_journal import WriteJournal
+
+WRITE_BLOCK_SIZE = 4 * 1024 * 1024  # 4MB
+SYNC_INTERVAL = 64 * 1024 * 1024  # 64MB
+
+
+def get_raw_device_path(usb_device):
+    """返回可直接写入的设备路径"""
+    if platform.system() == "Windows":
+        return f"\\\\.\\{usb_device}:"
+    return usb_device
+
+
+def list_usb_devices():
+    """获取USB设备列表"""
+    devices = []
+    system = platform.system()
+
+    try:
+        if system == "Linux":
+            # Linux下直接读取sysfs中的设备表，监听热插拔时直接返回缓存
+            devices = [device.to_dict() for device in get_inventory().devices()]
+
+        elif system == "Windows":
+            # Windows下使用wmic命令
+            result = subprocess.run(['wmic', 'logicaldisk', 'where', 'drivetype=2',
+                                     'get', 'deviceid,size,freespace'],
+                                    capture_output=True, text=True)
+            if result.returncode == 0:
+                lines = result.stdout.strip().split('\n')[1:]  # 跳过标题行
+                for line in lines:
+                    if line.strip():
+                        parts = line.split()
+                        if len(parts) >= 3:
+                            size_gb = int(parts[2]) / (1024**3) if parts[2].isdigit() else 0
+                            devices.append({
+                                'path': parts[0].replace(':', ''),
+                                'size': f"{size_gb:.1f}GB",
+                                'name': f"可移动磁盘 {parts[0]} ({size_gb:.1f}GB)"
+                            })
+
+    except Exception as e:
+        print(f"扫描设备时出错: {e}")
+
+    return devices
+
+
+class USBWriter:
+    """可引导USB制作：由格式化、写入、验证、集成PE和安装引导等阶段组成的流水线"""
+
+    def __init__(self, pe_path=None, verify=True, format_device=True, bootable=True,
+                 direct_io=True, skip_zero=False, delta=False, resume=False, tune=False, erase=None,
+                 manifest_cache=None, tuning_cache=None,
+                 status_callback=None, progress_callback=None, bus=None, cancel_token=None):
+        self.pe_path = pe_path
+        self.verify = verify
+        self.format_device = format_device
+        self.bootable = bootable
+        self.direct_io = direct_io
+        self.skip_zero = skip_zero
+        self.delta = delta
+        # 存在同一ISO写入同一设备的断点日志时，从断点继续而不是从头写入
+        self.resume_from_journal = resume
+        # 设备没有缓存的调优结果时，先试写比较不同的块大小和在途写请求数
+        self.tune = tune
+        # 写入前擦除：all为整个设备，unused只擦除镜像之后的区间，None不擦除
+        self.erase = erase
+        self.manifest_cache = manifest_cache or ManifestCache()
+        self.tuning_cache = tuning_cache or TuningCache()
+        # 所有状态和进度都发布到事件总线，界面或命令行自行订阅
+        self.bus = bus or EventBus()
+        # status_callback(消息, 类型)，类型为normal/warning/error/success
+        if status_callback:
+            self.bus.subscribe(lambda event, message, level="normal", **fields: status_callback(message, level),
+                               "status")
+        # progress_callback(总体进度百分比)
+        if progress_callback:
+            self.bus.subscribe(lambda event, percent, **fields: progress_callback(percent), "progress")
+        # 取消和暂停：写入、校验、外部命令和流水线调度共用同一个令牌
+        self.cancel_token = cancel_token or CancelToken()
+        self.image_digest = None
+
+    @property
+    def pe_available(self):
+        return bool(self.pe_path) and os.path.exists(self.pe_path)
+
+    def report_status(self, message, status_type="normal"):
+        self.bus.publish("status", message=message, level=status_type)
+
+    def cancel(self):
+        """取消制作：停止写入和校验，终止正在运行的外部命令"""
+        self.cancel_token.cancel()
+        self.bus.publish("cancel_requested", checkpoint=self.cancel_token.checkpoint)
+
+    def pause(self):
+        """暂停写入，写线程在下一个块之前刷写并停下"""
+        self.cancel_token.pause()
+        self.bus.publish("paused", checkpoint=self.cancel_token.checkpoint)
+
+    def resume(self):
+        self.cancel_token.resume()
+        self.bus.publish("resumed", checkpoint=self.cancel_token.checkpoint)
+
+    def _run(self, cmd):
+        """运行外部命令，取消时终止"""
+        return self.cancel_token.run(cmd, capture_output=True, text=True)
+
+    def build_pipeline(self, iso_file, usb_device):
+        """单个设备的制作流水线：格式化与ISO摘要准备互不依赖，同时进行"""
+        journal = WriteJournal(iso_file, get_raw_device_path(usb_device))
+        resume_offset = journal.load() if self.resume_from_journal else 0
+        # 增量写入和续写依赖设备上已有的镜像内容，格式化和全盘擦除会使其失效
+        keep_contents = self.delta or bool(resume_offset)
+        erase_scope = self.erase
+        if erase_scope == "all" and keep_contents:
+            erase_scope = "unused"
+        # 全盘擦除后设备已经是空的，写入的镜像会替换分区表，不再单独格式化
+        format_needed = self.format_device and not keep_contents and erase_scope != "all"
+
+        def erase_stage(context):
+            scope_text = "整个设备" if erase_scope == "all" else "镜像之外的区间"
+            context.status(f"正在擦除{scope_text}...")
+            start = 0 if erase_scope == "all" else unused_start(os.path.getsize(iso_file))
+            eraser = DeviceEraser(progress_callback=context.bytes_progress, cancel_token=self.cancel_token)
+            result = eraser.erase(get_raw_device_path(usb_device), start)
+            # 全盘已清零时跳过的全零块无需再由设备清零
+            context.state["zeroed"] = erase_scope == "all" and result.zeroed
+            context.status(result.describe())
+
+        def format_stage(context):
+            context.status("正在准备USB设备...")
+            self.format_usb_device(usb_device)
+
+        def manifest_stage(context):
+            # 格式化期间顺便计算块摘要清单，写入时便无需再计算摘要，且ISO已在页缓存中
+            manifest = self.manifest_cache.get(iso_file)
+            if manifest is None and format_needed:
+                context.status("正在计算ISO摘要...")
+                try:
+                    manifest = self.manifest_cache.get_or_build(iso_file, cancel_token=self.cancel_token)
+                except OperationCancelled:
+                    raise
+                except Exception as e:
+                    context.status(f"计算ISO摘要失败，将在写入时计算: {e}", "warning")
+            context.state["manifest"] = manifest
+
+        def write_stage(context):
+            start_offset = 0
+            if resume_offset:
+                context.status("正在校验断点处的数据...")
+                if journal.verify_tail(resume_offset):
+                    start_offset = resume_offset
+                    context.status(f"从 {resume_offset / (1024 * 1024):.1f} MB 处继续写入ISO文件...")
+                else:
+                    context.status("断点处的数据与ISO不一致，将从头写入", "warning")
+            if not start_offset:
+                context.status("正在写入ISO文件...")
+            self.image_digest = None
+            self.write_iso_to_device(iso_file, usb_device, context.bytes_progress,
+                                     manifest=context.state.get("manifest"),
+                                     start_offset=start_offset, journal=journal,
+                                     zeroed=context.state.get("zeroed", False))
+
+        def verify_stage(context):
+            # 必须在集成PE和安装引导修改设备之前回读比较
+            context.status("正在验证写入结果...")
+            self.verify_usb_device(usb_device, iso_file, context.bytes_progress)
+
+        def pe_stage(context):
+            context.status("正在集成PE工具...")
+            self.integrate_pe_tools(usb_device)
+
+        def bootloader_stage(context):
+            context.status("正在安装引导程序...")
+            self.install_bootloader(usb_device)
+
+        stages = []
+        if erase_scope and platform.system() != "Windows":
+            stages.append(Stage("erase", erase_stage, weight=10, title="擦除设备"))
+        if format_needed:
+            stages.append(Stage("format", format_stage, requires=("erase",), weight=20, title="格式化"))
+        stages.append(Stage("manifest", manifest_stage, weight=0, title="准备ISO摘要"))
+        stages.append(Stage("write", write_stage, requires=("erase", "format", "manifest"), weight=40,
+                            title="写入ISO"))
+        if self.verify:
+            stages.append(Stage("verify", verify_stage, requires=("write",), weight=20, title="验证"))
+        if self.pe_available:
+            stages.append(Stage("pe", pe_stage, requires=("write", "verify"), weight=10, title="集成PE工具"))
+        if self.bootable:
+            # 与PE集成都要挂载同一分区，依次进行
+            stages.append(Stage("bootloader", bootloader_stage, requires=("write", "verify", "pe"),
+                                weight=10, title="安装引导"))
+        return Pipeline(stages, self.bus, cancel_token=self.cancel_token)
+
+    def run(self, iso_file, usb_device):
+        """制作单个设备，任一阶段失败时抛出异常"""
+        self.build_pipeline(iso_file, usb_device).run()
+
+    def run_multiple(self, iso_file, devices):
+        """同一份ISO并行写入多个设备，单个设备失败不影响其他设备，返回(成功的设备列表, {失败的设备: 错误信息})"""
+        failed = {}
+        targets = list(devices)
+
+        def erase_stage(context):
+            # 各设备的擦除互不影响，同时进行
+            context.status(f"正在擦除{len(targets)}个USB设备...")
+            start = 0 if self.erase == "all" else unused_start(os.path.getsize(iso_file))
+            erasing = list(targets)
+            with ThreadPoolExecutor(max_workers=len(erasing)) as executor:
+                results = list(executor.map(lambda device: self._try_erase(device, start), erasing))
+            for device, (result, error) in zip(erasing, results):
+                if error is not None:
+                    failed[device] = error
+                    targets.remove(device)
+                else:
+                    context.status(f"{device}: {result.describe()}")
+
+        def format_stage(context):
+            # 各设备的格式化互不影响，同时进行
+            formatting = list(targets)
+            context.status(f"正在准备{len(formatting)}个USB设备...")
+            with ThreadPoolExecutor(max_workers=max(1, len(formatting))) as executor:
+                results = list(executor.map(self._try_format, formatting))
+            for device, error in zip(formatting, results):
+                if error is not None:
+                    failed[device] = error
+                    targets.remove(device)
+
+        def write_stage(context):
+            # ISO只读取一次，各设备并行写入和验证
+            context.status(f"正在写入{len(targets)}个设备...")
+            raw_paths = {get_raw_device_path(device): device for device in targets}
+            progress = {}
+            jobs_status = {}
+            status_names = {"writing": "写入中", "verifying": "验证中", "done": "完成", "failed": "失败"}
+
+            def on_progress(raw_path, done, total):
+                # 写入和验证各算一遍ISO大小；每个设备只写自己的键，不加锁
+                phase = 1 if jobs_status.get(raw_path) == "verifying" else 0
+                progress[raw_path] = phase * total + done
+                overall_total = total * (2 if self.verify else 1) * len(raw_paths)
+                overall = sum(progress.copy().values())
+                context.progress(overall / overall_total if overall_total else 1.0, overall, overall_total)
+
+            def on_status(raw_path, status):
+                jobs_status[raw_path] = status
+                self.bus.publish("device_status", device=raw_paths[raw_path], status=status)
+                context.status("，".join(f"{raw_paths[path]}: {status_names.get(s, s)}"
+                                        for path, s in jobs_status.items()))
+
+            writer = MultiDeviceWriter(block_size=WRITE_BLOCK_SIZE, direct_io=self.direct_io,
+                                       sync_interval=SYNC_INTERVAL, hash_algorithm="sha256",
+                                       verify=self.verify, cancel_token=self.cancel_token,
+                                       progress_callback=on_progress, status_callback=on_status)
+            jobs = writer.write(iso_file, list(raw_paths)) if raw_paths else []
+            if writer.digest is not None:
+                self.image_digest = writer.digest
+            for device, job in zip(list(targets), jobs):
+                if job.failed:
+                    failed[device] = str(job.error)
+                    targets.remove(device)
+
+        def install_stage(context):
+            # 集成PE工具和安装引导，逐个设备进行
+            for device in list(targets):
+                try:
+                    if self.pe_available:
+                        context.status(f"正在为{device}集成PE工具...")
+                        self.integrate_pe_tools(device)
+                    if self.bootable:
+                        context.status(f"正在为{device}安装引导程序...")
+                        self.install_bootloader(device)
+                except Exception as e:
+                    failed[device] = str(e)
+                    targets.remove(device)
+
+        stages = []
+        if self.erase and platform.system() != "Windows":
+            stages.append(Stage("erase", erase_stage, weight=10, title="擦除设备"))
+        # 全盘擦除后设备已经是空的，不再单独格式化
+        if self.format_device and self.erase != "all":
+            stages.append(Stage("format", format_stage, requires=("erase",), weight=20, title="格式化"))
+        stages.append(Stage("write", write_stage, requires=("erase", "format"), weight=60, title="写入ISO"))
+        if self.pe_available or self.bootable:
+            stages.append(Stage("install", install_stage, requires=("write",), weight=20,
+                                title="集成PE工具和安装引导"))
+        Pipeline(stages, self.bus, cancel_token=self.cancel_token).run()
+        return targets, failed
+
+    def _try_erase(self, device, start):
+        """擦除设备，返回(EraseResult, None)，失败时返回(None, 错误信息)"""
+        try:
+            eraser = DeviceEraser(cancel_token=self.cancel_token)
+            return eraser.erase(get_raw_device_path(device), start), None
+        except OperationCancelled:
+            return None, "操作已取消"
+        except Exception as e:
+            return None, str(e)
+
+    def _try_format(self, device):
+        """格式化设备，返回错误信息，成功时返回None"""
+        try:
+            self.format_usb_device(device)
+            return None
+        except OperationCancelled:
+            return "操作已取消"
+        except Exception as e:
+            return str(e)
+
+    def format_usb_device(self, usb_device):
+        """格式化USB设备"""
+        system = platform.system()
+
+        if system == "Linux":
+            # 卸载可能的挂载
+            self._run(["sudo", "umount", f"{usb_device}*"])
+
+            # MBR分区表（1MiB起占满整个设备、带启动标志的FAT32主分区）和FAT32文件系统在内存中生成，
+            # 直接写到设备后只重新读取一次分区表，不再逐条调用parted和mkfs.fat
+            self.cancel_token.check()
+            fd, _ = open_device(usb_device)
+            try:
+                table = PartitionTable.for_device(fd, "mbr")
+                table.add(kind="fat32", bootable=True, label="ISO_WRITER")
+                reread = table.commit(fd, self.cancel_token)
+            finally:
+                os.close(fd)
+            if reread:
+                wait_for_partitions(usb_device, len(table.partitions))
+
+        elif system == "Windows":
+            # Windows下格式化
+            cmd = ["format", f"{usb_device}:", "/FS:FAT32", "/Q", "/Y"]
+            result = self._run(cmd)
+            if result.returncode != 0:
+                raise Exception(f"格式化失败: {result.stderr}")
+
+    def write_iso_to_device(self, iso_file, usb_device, progress_callback=None, manifest=None,
+                            start_offset=0, journal=None, zeroed=False):
+        """写入ISO到设备，progress_callback(已写入字节数, 总字节数)；
+        journal为断点日志，每次刷写后记录断点，写入完成后删除；zeroed表示设备已整体清零"""
+        if manifest is None:
+            manifest = self.manifest_cache.get(iso_file)
+
+        if platform.system() == "Windows":
+            # Windows下需要特殊处理
+            self.write_iso_windows(iso_file, get_raw_device_path(usb_device), progress_callback, manifest,
+                                   start_offset, journal)
+            return
+
+        # 直接打开块设备写入，读写线程并行
+        # 直接写入模式下进度反映真正落到设备上的字节，大ISO不会占满页缓存
+        # 跳过全零块时由设备对跳过的区间执行BLKZEROOUT，保证结果与逐块写入一致
+        # 已缓存块摘要清单时，增量写入无需读取未变化的ISO块；否则在写入时顺带生成清单
+        tuning, start_offset = self.get_write_parameters(iso_file, usb_device, progress_callback,
+                                                         start_offset, journal)
+        engine = ISOWriteEngine(block_size=tuning.block_size if tuning else WRITE_BLOCK_SIZE,
+                                write_depth=tuning.write_depth if tuning else 1,
+                                progress_callback=progress_callback,
+                                direct_io=self.direct_io,
+                                sync_interval=SYNC_INTERVAL,
+                                skip_zero=self.skip_zero,
+                                skip_fill="zeroout" if self.skip_zero and not zeroed else None,
+                                hash_algorithm=self.get_hash_algorithm() if manifest else "sha256",
+                                delta=self.delta,
+                                source_hashes=manifest if self.delta else None,
+                                block_hash_size=None if manifest else self.manifest_cache.block_size,
+                                cancel_token=self.cancel_token,
+                                checkpoint_callback=journal.record if journal else None)
+        engine.write(iso_file, usb_device, start_offset)
+        if journal:
+            journal.clear()
+        self.store_manifest(iso_file, engine)
+        self.image_digest = engine.digest or (manifest.digest if manifest else None)
+
+    def get_write_parameters(self, iso_file, usb_device, progress_callback=None, start_offset=0,
+                             journal=None):
+        """返回(调优结果或None, 正式写入的起始位置)；需要调优时试写的ISO数据已经落盘，从试写结束处继续"""
+        identity = device_identity(usb_device)
+        tuning = self.tuning_cache.get(identity)
+        if tuning is not None:
+            self.report_status(f"使用该设备已缓存的写入参数：{tuning.describe()}")
+            return tuning, start_offset
+        # 增量写入只写变化的块，试写测不出设备速度
+        if not self.tune or self.delta:
+            return None, start_offset
+
+        tuner = DeviceTuner(direct_io=self.direct_io, cancel_token=self.cancel_token,
+                            progress_callback=progress_callback,
+                            checkpoint_callback=journal.record if journal else None)
+        self.report_status("正在测试该设备的最佳写入参数...")
+        tuning = tuner.tune(iso_file, usb_device, start_offset)
+        if tuning is None:
+            self.report_status("ISO太小，跳过写入参数调优")
+            return None, start_offset
+        try:
+            self.tuning_cache.put(identity, tuning)
+        except OSError as e:
+            self.report_status(f"保存写入参数失败: {e}", "warning")
+        self.report_status(f"已选定写入参数：{tuning.describe()}，继续写入ISO文件...")
+        return tuning, tuning.end_offset
+
+    def write_iso_windows(self, iso_file, usb_device, progress_callback=None, manifest=None,
+                          start_offset=0, journal=None):
+        """Windows下写入ISO"""
+        try:
+            # 从ISO的内存映射切片直接写出，不再每块分配新的bytes对象
+            # 按间隔刷写，断点日志才能在写入过程中推进
+            engine = ISOWriteEngine(block_size=WRITE_BLOCK_SIZE,
+                                    progress_callback=progress_callback,
+                                    sync_interval=SYNC_INTERVAL if journal else None,
+                                    hash_algorithm=self.get_hash_algorithm() if manifest else "sha256",
+                                    block_hash_size=None if manifest else self.manifest_cache.block_size,
+                                    cancel_token=self.cancel_token,
+                                    checkpoint_callback=journal.record if journal else None)
+            engine.write(iso_file, usb_device, start_offset)
+            if journal:
+                journal.clear()
+            self.store_manifest(iso_file, engine)
+            self.image_digest = engine.digest or (manifest.digest if manifest else None)
+
+        except PermissionError:
+            raise Exception("需要管理员权限。请以管理员身份运行程序。")
+        except OperationCancelled:
+            raise
+        except Exception as e:
+            raise Exception(f"写入失败: {str(e)}")
+
+    def store_manifest(self, iso_file, engine):
+        """把写入时顺带计算的块摘要保存为清单，下次校验和增量写入直接使用"""
+        if engine.block_hashes is None or engine.digest is None:
+            return
+        manifest = BlockManifest.from_hash_list(os.path.getsize(iso_file), self.manifest_cache.block_size,
+                                                engine.digest, self.manifest_cache.algorithm,
+                                                engine.block_hashes)
+        try:
+            self.manifest_cache.put(iso_file, manifest)
+        except OSError as e:
+            self.report_status(f"保存块摘要清单失败: {e}", "warning")
+
+    def get_hash_algorithm(self):
+        """需要写后验证时，写入过程中同步计算ISO摘要"""
+        return "sha256" if self.verify else None
+
+    def extract_pe(self, pe_dir):
+        """把PE ISO的全部内容解压到pe_dir"""
+        self.report_status("正在解压PE文件...")
+        with CatalogCache().open(self.pe_path) as pe_image:
+            pe_image.extract("/", pe_dir, cancel_token=self.cancel_token)
+
+    def integrate_pe_tools(self, usb_device):
+        """集成PE工具"""
+        if not self.pe_available:
+            return
+
+        try:
+            system = platform.system()
+
+            if system == "Linux":
+                # 挂载USB分区
+                mount_point = tempfile.mkdtemp(prefix="usb_mount_")
+                partition = partition_path(usb_device, 1)
+
+                cmd = ["sudo", "mount", *user_mount_options(), partition, mount_point]
+                result = self._run(cmd)
+                if result.returncode != 0:
+                    raise Exception(f"挂载USB失败: {result.stderr}")
+
+                try:
+                    # 直接从PE ISO解压，不需要挂载
+                    self.extract_pe(os.path.join(mount_point, "PE"))
+
+                finally:
+                    subprocess.run(["sudo", "umount", mount_point],
+                                   capture_output=True, text=True)
+                    os.rmdir(mount_point)
+
+            elif system == "Windows":
+                # Windows下直接解压到盘符
+                usb_path = f"{usb_device}:\\"
+                self.extract_pe(os.path.join(usb_path, "PE"))
+
+        except OperationCancelled:
+            raise
+        except Exception as e:
+            self.report_status(f"集成PE工具失败: {e}", "warning")
+
+    def install_bootloader(self, usb_device):
+        """安装引导程序"""
+        system = platform.system()
+
+        try:
+            if system == "Linux":
+                # 安装syslinux
+                partition = partition_path(usb_device, 1)
+                cmd = ["sudo", "syslinux", "-i", partition]
+                self._run(cmd)
+
+                # 安装MBR
+                mbr_path = "/usr/lib/syslinux/mbr/mbr.bin"
+                if os.path.exists(mbr_path):
+                    cmd = ["sudo", "dd", f"if={mbr_path}", f"of={usb_device}", "bs=440", "count=1"]
+                    self._run(cmd)
+
+        except OperationCancelled:
+            raise
+        except Exception as e:
+            self.report_status(f"安装引导程序失败: {e}", "warning")
+
+    def verify_usb_device(self, usb_device, iso_file, progress_callback=None):
+        """验证USB设备：回读ISO大小的区域并与写入时计算的摘要比较，progress_callback(已校验字节数, 总字节数)"""
+        usb_device = get_raw_device_path(usb_device)
+
+        verifier = ImageVerifier(progress_callback=progress_callback, cancel_token=self.cancel_token)
+        if verifier.verify(iso_file, usb_device, self.image_digest):
+            return
+
+        # 摘要不一致：逐块比较定位坏块，只重写这些块而不是重新制作
+        self.report_status("验证未通过，正在定位不一致的数据块...", "warning")
+        bad_ranges = verifier.diff(iso_file, usb_device, source_hashes=self.manifest_cache.get(iso_file))
+        if not bad_ranges:
+            # 逐块比较一致而整体摘要不一致：写入时的摘要或块摘要清单不可信，按ISO重新计算摘要再校验一次
+            self.report_status("未找到不一致的数据块，正在按ISO重新计算摘要校验...", "warning")
+            if verifier.verify(iso_file, usb_device):
+                return
+            raise Exception("验证失败：设备上的数据与ISO摘要不一致，但无法定位不一致的数据块")
+
+        bad_bytes = sum(end - start for start, end in bad_ranges)
+        self.report_status(
+            f"发现{len(bad_ranges)}处不一致（首个位于偏移 {bad_ranges[0][0]}），正在修复 {bad_bytes / (1024 * 1024):.1f} MB...",
+            "warning")
+        remaining = verifier.repair(iso_file, usb_device, bad_ranges)
+        if remaining:
+            raise Exception(f"验证失败：设备上有{len(remaining)}处数据与ISO不一致，"
+                            f"首个位于偏移 {remaining[0][0]}，修复后仍无法写入，设备可能已损坏")
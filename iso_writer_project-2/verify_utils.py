@@ -0,0 +1,303 @@
+"""
+写入结果校验工具
+以大块并行读取回读设备内容并计算摘要，与写入时流式计算的ISO摘要比较
+"""
+
+import os
+import errno
+import hashlib
+import mmap
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from blockdev_utils import get_logical_sector_size
+from write_engine import ISOWriteEngine, block_digest
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024  # 8MB
+DEFAULT_READ_WORKERS = 4
+DEFAULT_DIFF_BLOCK_SIZE = 1024 * 1024  # 1MB
+# 每个读取任务负责的连续块数，任务内顺序读取，任务之间并行
+BLOCKS_PER_TASK = 32
+
+
+def open_for_read(path, direct_io=False):
+    """以只读方式打开设备或文件，返回(fd, 是否需要扇区对齐读取)"""
+    flags = os.O_RDONLY | getattr(os, 'O_BINARY', 0)
+    try:
+        if direct_io and hasattr(os, 'O_DIRECT'):
+            try:
+                return os.open(path, flags | os.O_DIRECT), True
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+        return os.open(path, flags), False
+    except PermissionError:
+        raise Exception("需要管理员权限。请以管理员(root)身份运行程序。")
+    except OSError as e:
+        raise Exception(f"无法打开 {path}: {e}")
+
+
+def read_at(fd, view, offset):
+    """从指定偏移读取数据填满缓冲区，返回实际读取的字节数（到达末尾时可能不足）"""
+    total = len(view)
+    done = 0
+    while done < total:
+        if hasattr(os, 'preadv'):
+            n = os.preadv(fd, [view[done:]], offset + done)
+        elif hasattr(os, 'pread'):
+            data = os.pread(fd, total - done, offset + done)
+            n = len(data)
+            view[done:done + n] = data
+        else:
+            # Windows没有pread，调用方需保证单线程访问该fd
+            os.lseek(fd, offset + done, os.SEEK_SET)
+            data = os.read(fd, total - done)
+            n = len(data)
+            view[done:done + n] = data
+        if n == 0:
+            break
+        done += n
+    return done
+
+
+def blocks_in_ranges(ranges, block_size, length):
+    """返回覆盖指定字节区间的所有块号"""
+    indices = set()
+    for start, end in ranges:
+        end = min(end, length)
+        indices.update(range(start // block_size, (end + block_size - 1) // block_size))
+    return sorted(indices)
+
+
+def merge_block_ranges(indices, block_size, length):
+    """把块号列表合并为连续的字节区间[(起始, 结束)]"""
+    ranges = []
+    for index in indices:
+        start = index * block_size
+        end = min(start + block_size, length)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+class ImageVerifier:
+    """镜像校验器"""
+
+    def __init__(self, algorithm="sha256", chunk_size=DEFAULT_CHUNK_SIZE,
+                 workers=DEFAULT_READ_WORKERS, direct_io=True, progress_callback=None,
+                 cancel_token=None):
+        self.algorithm = algorithm
+        self.chunk_size = chunk_size
+        self.workers = max(1, workers)
+        # 回读设备时绕过页缓存，确保读到的是设备上的真实数据而不是刚写入的缓存
+        self.direct_io = direct_io
+        # progress_callback(已校验字节数, 总字节数)
+        self.progress_callback = progress_callback
+        # 每个数据块之间检查取消和暂停
+        self.cancel_token = cancel_token
+
+    def hash_range(self, path, length, direct_io=None, progress_callback=None):
+        """读取path开头的length字节并返回摘要"""
+        if direct_io is None:
+            direct_io = self.direct_io
+        fd, aligned = open_for_read(path, direct_io)
+        try:
+            return self._hash_fd(fd, length, aligned, progress_callback)
+        finally:
+            os.close(fd)
+
+    def _hash_fd(self, fd, length, aligned, progress_callback):
+        """多线程并行预读，按顺序输入哈希对象"""
+        sector = get_logical_sector_size(fd) if aligned else 1
+        chunk_size = self.chunk_size
+        if chunk_size % sector:
+            chunk_size += sector - chunk_size % sector
+
+        # 没有pread时多个线程会争用同一个文件位置，只能串行读取
+        workers = self.workers if hasattr(os, 'pread') else 1
+        in_flight = workers * 2
+        # 匿名mmap页对齐，可直接用于O_DIRECT读取
+        buffers = [mmap.mmap(-1, chunk_size) for _ in range(min(in_flight, length // chunk_size + 1))]
+        hasher = hashlib.new(self.algorithm)
+        pending = deque()
+        offsets = iter(range(0, length, chunk_size))
+
+        def read_chunk(buf, offset, want):
+            if self.cancel_token is not None:
+                self.cancel_token.check()
+            # O_DIRECT下读取长度向上取整到扇区边界，只对需要的部分计算摘要
+            read_len = want + (-want % sector)
+            with memoryview(buf) as view:
+                got = read_at(fd, view[:read_len], offset)
+            if got < want:
+                raise Exception(f"在偏移 {offset + got} 处读取不足，设备容量可能小于ISO")
+            return want
+
+        def submit(executor, buf):
+            offset = next(offsets, None)
+            if offset is None:
+                return
+            want = min(chunk_size, length - offset)
+            pending.append((executor.submit(read_chunk, buf, offset, want), buf))
+
+        verified = 0
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for buf in buffers:
+                    submit(executor, buf)
+                while pending:
+                    future, buf = pending.popleft()
+                    want = future.result()
+                    with memoryview(buf) as view:
+                        hasher.update(view[:want])
+                    verified += want
+                    if progress_callback:
+                        progress_callback(verified, length)
+                    # 缓冲区已用完，立即用于下一次读取
+                    submit(executor, buf)
+        finally:
+            # 出错时等待仍在进行的读取结束后再释放缓冲区
+            for future, _ in pending:
+                future.cancel()
+            for buf in buffers:
+                buf.close()
+
+        return hasher.hexdigest()
+
+    def verify(self, iso_file, device, expected_digest=None):
+        """回读设备上ISO大小的区域并与ISO摘要比较，返回是否一致"""
+        iso_size = os.path.getsize(iso_file)
+        callback = self.progress_callback
+
+        if expected_digest is not None:
+            return self.hash_range(device, iso_size, progress_callback=callback) == expected_digest
+
+        # 没有写入时的摘要：源文件与设备在两个线程中同时计算
+        source_result = {}
+
+        def hash_source():
+            try:
+                source_result['digest'] = self.hash_range(iso_file, iso_size, direct_io=False)
+            except Exception as e:
+                source_result['error'] = e
+
+        source_thread = threading.Thread(target=hash_source, name="iso-source-hash", daemon=True)
+        source_thread.start()
+        try:
+            device_digest = self.hash_range(device, iso_size, progress_callback=callback)
+        finally:
+            source_thread.join()
+
+        if 'error' in source_result:
+            raise Exception(f"读取ISO失败: {source_result['error']}")
+        return device_digest == source_result['digest']
+
+    def hash_blocks(self, path, length, block_size=DEFAULT_DIFF_BLOCK_SIZE, indices=None,
+                    direct_io=None, progress_callback=None):
+        """并行计算每个块的摘要，返回{块号: 摘要}"""
+        if direct_io is None:
+            direct_io = self.direct_io
+        if indices is None:
+            indices = range((length + block_size - 1) // block_size)
+
+        # 连续块号分成一组，组内顺序读取，组之间并行
+        tasks = []
+        for index in indices:
+            if tasks and tasks[-1][-1] == index - 1 and len(tasks[-1]) < BLOCKS_PER_TASK:
+                tasks[-1].append(index)
+            else:
+                tasks.append([index])
+
+        fd, aligned = open_for_read(path, direct_io)
+        sector = get_logical_sector_size(fd) if aligned else 1
+        buf_size = block_size + (-block_size % sector)
+        local = threading.local()
+        all_buffers = []
+        buffers_lock = threading.Lock()
+        total = sum(len(task) for task in tasks)
+        done = [0]
+
+        def hash_task(task):
+            buf = getattr(local, 'buf', None)
+            if buf is None:
+                buf = local.buf = mmap.mmap(-1, buf_size)
+                with buffers_lock:
+                    all_buffers.append(buf)
+            result = []
+            with memoryview(buf) as view:
+                for index in task:
+                    if self.cancel_token is not None:
+                        self.cancel_token.check()
+                    offset = index * block_size
+                    want = min(block_size, length - offset)
+                    got = read_at(fd, view[:want + (-want % sector)], offset)
+                    if got < want:
+                        raise Exception(f"在偏移 {offset + got} 处读取不足，设备容量可能小于ISO")
+                    result.append((index, block_digest(view[:want])))
+            if progress_callback:
+                with buffers_lock:
+                    done[0] += len(task)
+                    progress_callback(min(done[0] * block_size, length), length)
+            return result
+
+        workers = self.workers if hasattr(os, 'pread') else 1
+        digests = {}
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for result in executor.map(hash_task, tasks):
+                    digests.update(result)
+        finally:
+            os.close(fd)
+            for buf in all_buffers:
+                buf.close()
+
+        if len(digests) != total:
+            raise Exception("块摘要计算不完整")
+        return digests
+
+    def diff(self, iso_file, device, block_size=DEFAULT_DIFF_BLOCK_SIZE, ranges=None,
+             source_hashes=None):
+        """逐块比较ISO与设备，返回不一致的字节区间列表[(起始, 结束)]"""
+        iso_size = os.path.getsize(iso_file)
+        if ranges is None:
+            indices = list(range((iso_size + block_size - 1) // block_size))
+        else:
+            indices = blocks_in_ranges(ranges, block_size, iso_size)
+
+        source_result = {}
+
+        def hash_source():
+            try:
+                source_result['hashes'] = self.hash_blocks(iso_file, iso_size, block_size,
+                                                           indices, direct_io=False)
+            except Exception as e:
+                source_result['error'] = e
+
+        # 源文件与设备的块摘要同时计算
+        source_thread = None
+        if source_hashes is None:
+            source_thread = threading.Thread(target=hash_source, name="iso-block-hash", daemon=True)
+            source_thread.start()
+        try:
+            device_hashes = self.hash_blocks(device, iso_size, block_size, indices,
+                                             progress_callback=self.progress_callback)
+        finally:
+            if source_thread is not None:
+                source_thread.join()
+
+        if source_thread is not None:
+            if 'error' in source_result:
+                raise Exception(f"读取ISO失败: {source_result['error']}")
+            source_hashes = source_result['hashes']
+
+        mismatched = [index for index in indices if device_hashes[index] != source_hashes[index]]
+        return merge_block_ranges(mismatched, block_size, iso_size)
+
+    def repair(self, iso_file, device, ranges, block_size=DEFAULT_DIFF_BLOCK_SIZE, direct_io=True):
+        """只重写不一致的区间并重新校验，返回修复后仍不一致的区间"""
+        engine = ISOWriteEngine(block_size=block_size, direct_io=direct_io, cancel_token=self.cancel_token)
+        engine.write_ranges(iso_file, device, ranges)
+        return self.diff(iso_file, device, block_size, ranges=ranges)
@@ -0,0 +1,852 @@
+"""
+原生块设备写入引擎
+读线程与写线程通过有界队列协作，ISO读取与设备写入互相重叠，替代dd子进程
+"""
+
+import os
+import errno
+import hashlib
+import mmap
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from blockdev_utils import (datasync, disable_page_cache, discard_range, fill_range,
+                            get_device_size, get_logical_sector_size)
+from job_control import OperationCancelled
+
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024  # 4MB
+DEFAULT_QUEUE_DEPTH = 4
+DEFAULT_DELTA_BLOCK_SIZE = 1024 * 1024  # 1MB
+BLOCK_DIGEST_SIZE = 16
+
+# 全零比较基准，bytes()由calloc分配，未访问的页不占用物理内存
+_ZERO_BLOCK = bytes(16 * 1024 * 1024)
+
+# 内核拷贝返回这些错误码时说明当前源/目标组合不受支持，应换用其他方式
+_KERNEL_COPY_UNSUPPORTED = {errno.EINVAL, errno.EXDEV, errno.ENOSYS,
+                            errno.EOPNOTSUPP, getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP)}
+
+
+class BufferPool:
+    """预分配的页对齐缓冲区池"""
+
+    def __init__(self, count, size):
+        self.size = size
+        # 匿名mmap总是按页对齐，可直接用于块设备I/O
+        self._buffers = [mmap.mmap(-1, size) for _ in range(count)]
+        self._free = queue.Queue()
+        for buf in self._buffers:
+            self._free.put(buf)
+
+    def acquire(self):
+        """取出一个空闲缓冲区（池空时阻塞）"""
+        return self._free.get()
+
+    def release(self, buf):
+        """归还缓冲区"""
+        self._free.put(buf)
+
+    def close(self):
+        """释放所有缓冲区"""
+        for buf in self._buffers:
+            buf.close()
+        self._buffers = []
+
+
+class DataBlock:
+    """读线程产出、由一个或多个消费线程共享的数据块"""
+
+    __slots__ = ('offset', 'length', 'view', '_on_release', '_refs', '_lock')
+
+    def __init__(self, offset, length, view=None, on_release=None, consumers=1):
+        self.offset = offset
+        self.length = length
+        # view为None表示该块是空洞或全零块
+        self.view = view
+        self._on_release = on_release
+        self._refs = consumers
+        self._lock = threading.Lock()
+
+    def release(self):
+        """消费者用完后调用，最后一个消费者负责归还缓冲区"""
+        with self._lock:
+            self._refs -= 1
+            if self._refs > 0:
+                return
+        if self.view is not None:
+            self.view.release()
+        if self._on_release is not None:
+            self._on_release()
+
+
+def block_digest(data):
+    """计算单个数据块的摘要（块级比较和块摘要清单共用）"""
+    return hashlib.sha256(data).digest()[:BLOCK_DIGEST_SIZE]
+
+
+class StreamHasher:
+    """顺序数据流摘要：同时计算整体摘要和按固定大小切分的块摘要"""
+
+    def __init__(self, algorithm=None, block_size=None):
+        self.whole = hashlib.new(algorithm) if algorithm else None
+        self.block_size = block_size
+        self.block_hashes = []
+        self._block = hashlib.sha256() if block_size else None
+        self._block_filled = 0
+
+    def update(self, view):
+        """输入一段数据"""
+        if self.whole is not None:
+            self.whole.update(view)
+        if self._block is None:
+            return
+        pos = 0
+        length = len(view)
+        while pos < length:
+            take = min(self.block_size - self._block_filled, length - pos)
+            self._block.update(view[pos:pos + take])
+            self._block_filled += take
+            pos += take
+            if self._block_filled == self.block_size:
+                self._finish_block()
+
+    def update_zeros(self, length):
+        """输入length个零字节"""
+        zero_view = memoryview(_ZERO_BLOCK)
+        while length > 0:
+            chunk = min(length, len(_ZERO_BLOCK))
+            self.update(zero_view[:chunk])
+            length -= chunk
+
+    def _finish_block(self):
+        self.block_hashes.append(self._block.digest()[:BLOCK_DIGEST_SIZE])
+        self._block = hashlib.sha256()
+        self._block_filled = 0
+
+    def finish(self):
+        """结束数据流，返回(整体摘要十六进制串或None, 块摘要列表)"""
+        if self._block is not None and self._block_filled:
+            self._finish_block()
+        digest = self.whole.hexdigest() if self.whole is not None else None
+        return digest, self.block_hashes
+
+
+def open_device(device, direct_io=False):
+    """以原始写模式打开目标设备，返回(fd, 是否需要扇区对齐写入)"""
+    flags = os.O_WRONLY | getattr(os, 'O_BINARY', 0)
+    try:
+        if direct_io and hasattr(os, 'O_DIRECT'):
+            try:
+                return os.open(device, flags | os.O_DIRECT), True
+            except OSError as e:
+                # 目标不支持O_DIRECT（如tmpfs上的文件），回退到普通写入
+                if e.errno != errno.EINVAL:
+                    raise
+        fd = os.open(device, flags)
+    except PermissionError:
+        raise Exception("需要管理员权限。请以管理员(root)身份运行程序。")
+    except OSError as e:
+        raise Exception(f"无法打开设备 {device}: {e}")
+
+    if direct_io:
+        # macOS没有O_DIRECT，使用F_NOCACHE达到同样效果且无对齐要求
+        disable_page_cache(fd)
+    return fd, False
+
+
+def is_zero_block(view):
+    """判断数据块是否全为零（在C层用memcmp比较，不产生拷贝）"""
+    length = len(view)
+    if length > len(_ZERO_BLOCK):
+        return all(is_zero_block(view[i:i + len(_ZERO_BLOCK)])
+                   for i in range(0, length, len(_ZERO_BLOCK)))
+    return _ZERO_BLOCK.startswith(view)
+
+
+def iter_data_ranges(fd, size):
+    """利用SEEK_DATA/SEEK_HOLE枚举稀疏文件中的数据区间(起始, 结束)"""
+    if not hasattr(os, 'SEEK_DATA'):
+        yield 0, size
+        return
+
+    pos = 0
+    while pos < size:
+        try:
+            start = os.lseek(fd, pos, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # 之后全部是空洞
+                return
+            # 文件系统不支持，整个文件视为数据
+            yield pos, size
+            return
+        if start >= size:
+            return
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        yield start, end
+        pos = end
+
+
+def write_all(fd, view, offset=None):
+    """将整个缓冲区写入fd（可指定偏移），处理部分写入"""
+    if offset is not None and not hasattr(os, 'pwrite'):
+        # Windows没有pwrite，先定位再顺序写
+        os.lseek(fd, offset, os.SEEK_SET)
+        offset = None
+
+    total = len(view)
+    done = 0
+    while done < total:
+        if offset is None:
+            written = os.write(fd, view[done:])
+        else:
+            written = os.pwrite(fd, view[done:], offset + done)
+        if written <= 0:
+            raise Exception("设备写入返回0字节，设备可能已断开")
+        done += written
+    return done
+
+
+class ISOWriteEngine:
+    """ISO原生写入引擎"""
+
+    def __init__(self, block_size=DEFAULT_BLOCK_SIZE, queue_depth=DEFAULT_QUEUE_DEPTH,
+                 progress_callback=None, direct_io=False, sync_interval=None, zero_copy=True,
+                 skip_zero=False, skip_fill=None, discard_device=False, hash_algorithm=None,
+                 delta=False, delta_block_size=DEFAULT_DELTA_BLOCK_SIZE, source_hashes=None,
+                 block_hash_size=None, cancel_token=None, checkpoint_callback=None, write_depth=1):
+        self.block_size = block_size
+        self.queue_depth = max(1, queue_depth)
+        # 同时在途的写请求数：多个写线程并发写入不同的块，支持命令队列的设备（UAS、NVMe硬盘盒）可以更快
+        self.write_depth = max(1, write_depth)
+        # progress_callback(已落盘字节数, 总字节数)
+        self.progress_callback = progress_callback
+        # 绕过页缓存直接写设备，避免大ISO占满内存后在最终刷写时卡住
+        self.direct_io = direct_io
+        # 每写入sync_interval字节执行一次fdatasync，None表示只在结束时刷写
+        self.sync_interval = sync_interval
+        # 优先使用copy_file_range/sendfile或mmap，避免每块分配和用户态拷贝
+        self.zero_copy = zero_copy
+        # 跳过源文件中的空洞和全零块，只写入非零区域
+        self.skip_zero = skip_zero
+        # 被跳过区间的处理方式：None保持原样，"discard"或"zeroout"由设备清空
+        self.skip_fill = skip_fill
+        # 写入前对整个设备执行BLKDISCARD
+        self.discard_device = discard_device
+        # 写入时同步计算整个镜像的摘要，供写后校验使用
+        self.hash_algorithm = hash_algorithm
+        # 增量写入：先读取设备现有内容，只写入与ISO不同的块
+        self.delta = delta
+        self.delta_block_size = delta_block_size
+        # ISO按delta_block_size计算的块摘要，提供时未变化的块无需读取ISO
+        self.source_hashes = source_hashes
+        self.bytes_changed = 0
+        # 写入时顺带按block_hash_size计算块摘要，用于生成块摘要清单
+        self.block_hash_size = block_hash_size
+        self.block_hashes = None
+        # 每个块写完后检查，支持取消和暂停；暂停或取消前先刷写并记录检查点
+        self.cancel_token = cancel_token
+        # checkpoint_callback(已落盘位置)，每次刷写后调用，用于保存断点日志
+        self.checkpoint_callback = checkpoint_callback
+        # 续写时的起始位置，之前的部分已在设备上
+        self.start_offset = 0
+        self.digest = None
+        self.skipped_ranges = []
+        self.bytes_skipped = 0
+        self._skips_filled = False
+        self.bytes_written = 0
+        self.bytes_flushed = 0
+        self.sector_size = 512
+        self.copy_method = None
+        self._aligned_io = False
+        self._device = None
+        self._src_fd = None
+        self._iso_file = None
+        # 多个写线程乱序完成的块，按起始偏移暂存，连续后再推进写入位置
+        self._completed = {}
+        self._complete_lock = threading.Lock()
+
+    def write(self, iso_file, device, start_offset=0, end_offset=None):
+        """将ISO写入设备，返回写入的字节数；start_offset大于0时从该位置续写，
+        指定end_offset时只写到该位置为止（用于分段测速）"""
+        iso_size = os.path.getsize(iso_file)
+        if end_offset is not None:
+            iso_size = min(end_offset, iso_size)
+        if start_offset < 0 or start_offset > iso_size:
+            raise Exception(f"续写位置 {start_offset} 超出ISO大小 {iso_size}")
+        self.copy_method = None
+        self.skipped_ranges = []
+        self.bytes_skipped = 0
+        self._skips_filled = False
+        self.bytes_changed = 0
+        self.block_hashes = None
+        self.digest = None
+
+        src = open(iso_file, 'rb', buffering=0)
+        try:
+            dst_fd = self.open_target(device)
+        except Exception:
+            src.close()
+            raise
+
+        # 续写位置需满足扇区对齐和增量写入的块对齐，向前取整后多写的部分内容相同
+        align = self.delta_block_size if self.delta else self.sector_size
+        self.start_offset = start_offset - start_offset % align
+        self.bytes_written = self.start_offset
+        self.bytes_flushed = self.start_offset
+        self._iso_file = iso_file
+
+        try:
+            # 续写时设备上已有前半部分数据，不能整体discard
+            if self.discard_device and not self.start_offset:
+                discard_range(dst_fd, 0, get_device_size(dst_fd))
+
+            if self.delta:
+                self._delta_copy(src, dst_fd, iso_size)
+            elif not self._kernel_copy(src.fileno(), dst_fd, iso_size):
+                self._pipeline_copy(src, dst_fd, iso_size)
+
+            if self.skip_fill and self.skipped_ranges:
+                self._fill_skipped_ranges()
+                self._skips_filled = True
+
+            # 确保所有数据真正落盘
+            os.fsync(dst_fd)
+            self.bytes_flushed = self.bytes_written
+            self._record_checkpoint()
+            self._report_progress(iso_size)
+
+        finally:
+            src.close()
+            os.close(dst_fd)
+
+        if self.bytes_written != iso_size:
+            raise Exception(f"写入不完整: {self.bytes_written}/{iso_size} 字节")
+
+        return self.bytes_written
+
+    def write_ranges(self, iso_file, device, ranges):
+        """只把ISO中指定的字节区间[(起始, 结束)]重写到设备，返回写入的字节数"""
+        iso_size = os.path.getsize(iso_file)
+
+        src = open(iso_file, 'rb', buffering=0)
+        try:
+            dst_fd = self.open_target(device)
+        except Exception:
+            src.close()
+            raise
+
+        written = 0
+        pool = None
+        try:
+            block_size = self.block_size + (-self.block_size % self.sector_size)
+            pool = BufferPool(1, block_size)
+            buf = pool.acquire()
+            for start, end in ranges:
+                offset = start
+                end = min(end, iso_size)
+                while offset < end:
+                    if self.cancel_token is not None:
+                        self.cancel_token.check()
+                    length = min(block_size, end - offset)
+                    src.seek(offset)
+                    if self._fill_buffer(src, buf, length) < length:
+                        raise Exception(f"ISO文件在偏移 {offset} 处提前结束")
+                    with memoryview(buf) as view:
+                        self.write_block(dst_fd, offset, view[:length])
+                    offset += length
+                    written += length
+            os.fsync(dst_fd)
+        finally:
+            src.close()
+            os.close(dst_fd)
+            if pool is not None:
+                pool.close()
+
+        return written
+
+    def open_target(self, device):
+        """打开目标设备并记录其扇区大小和对齐要求，返回写描述符"""
+        dst_fd, self._aligned_io = open_device(device, self.direct_io)
+        self._device = device
+        self.sector_size = get_logical_sector_size(dst_fd)
+        return dst_fd
+
+    def _kernel_copy(self, src_fd, dst_fd, iso_size):
+        """在内核内完成文件到设备的拷贝，当前组合不支持时返回False"""
+        # O_DIRECT有对齐要求、跳零和计算摘要需要访问数据，这些情况交给用户态流水线处理
+        if (not self.zero_copy or self.direct_io or self.skip_zero or self.hash_algorithm
+                or self.block_hash_size or iso_size == 0):
+            return False
+
+        methods = []
+        if hasattr(os, 'copy_file_range'):
+            methods.append(('copy_file_range',
+                            lambda count, offset: os.copy_file_range(src_fd, dst_fd, count, offset, offset)))
+        if hasattr(os, 'sendfile'):
+            # sendfile从指定偏移读源文件，目标按文件位置顺序写入
+            methods.append(('sendfile',
+                            lambda count, offset: os.sendfile(dst_fd, src_fd, offset, count)))
+
+        for name, method in methods:
+            offset = self.start_offset
+            # sendfile按目标文件位置写入
+            os.lseek(dst_fd, offset, os.SEEK_SET)
+            try:
+                while offset < iso_size:
+                    copied = method(min(self.block_size, iso_size - offset), offset)
+                    if copied == 0:
+                        raise Exception(f"ISO文件在偏移 {offset} 处提前结束")
+                    offset += copied
+                    self.advance(dst_fd, offset, iso_size)
+            except OSError as e:
+                # 只有在一个字节都没拷贝时才允许换用其他方式
+                if offset > self.start_offset or e.errno not in _KERNEL_COPY_UNSUPPORTED:
+                    raise Exception(f"写入设备失败 (偏移 {offset}): {e}")
+                continue
+            self.copy_method = name
+            return True
+
+        return False
+
+    def _pipeline_copy(self, src, dst_fd, iso_size):
+        """用户态读写流水线：读线程与写线程通过有界队列并行"""
+        block_size = self.block_size
+        if self._aligned_io and block_size % self.sector_size:
+            # O_DIRECT要求每次写入都是扇区大小的整数倍
+            block_size += self.sector_size - block_size % self.sector_size
+
+        source_map = self._map_source(src, iso_size)
+        if source_map is not None:
+            # 直接从ISO的内存映射切片写入，不经过中间缓冲区
+            pool = None
+            reader_target = self._mapped_reader_loop
+            reader_source = source_map
+            self.copy_method = 'mmap'
+        else:
+            # 读线程最多领先写线程queue_depth个块，另留缓冲区给正在读和正在写的块
+            # 缓冲区在整个写入过程中循环复用，内存占用与ISO大小无关
+            pool = BufferPool(self.queue_depth + self.write_depth + 1, block_size)
+            reader_target = self._reader_loop
+            reader_source = src
+            self.copy_method = 'readinto'
+
+        data_queue = queue.Queue(maxsize=self.queue_depth)
+        consumer_queues = [data_queue]
+        stop_event = threading.Event()
+        errors = []
+        self._src_fd = src.fileno()
+        self._completed = {}
+
+        threads = [threading.Thread(target=self._writer_loop,
+                                    args=(dst_fd, iso_size, data_queue, stop_event, errors),
+                                    name=f"iso-writer-{index}", daemon=True)
+                   for index in range(self.write_depth)]
+        hasher = None
+        if self.hash_algorithm or self.block_hash_size:
+            # 摘要在独立线程中计算，hashlib释放GIL，与设备写入并行
+            hasher = StreamHasher(self.hash_algorithm, self.block_hash_size)
+            hash_queue = queue.Queue(maxsize=self.queue_depth)
+            consumer_queues.append(hash_queue)
+            threads.append(threading.Thread(target=self._hasher_loop,
+                                            args=(hasher, hash_queue, stop_event, errors),
+                                            name="iso-hasher", daemon=True))
+        threads.append(threading.Thread(target=reader_target,
+                                        args=(reader_source, iso_size, block_size, pool,
+                                              consumer_queues, stop_event, errors),
+                                        name="iso-reader", daemon=True))
+
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            if source_map is not None:
+                source_map.close()
+            if pool is not None:
+                pool.close()
+
+        if errors:
+            raise errors[0]
+        if hasher is not None:
+            self.digest, block_hashes = hasher.finish()
+            if self.block_hash_size:
+                self.block_hashes = block_hashes
+
+    def _delta_copy(self, src, dst_fd, iso_size):
+        """增量写入：并行预读设备现有内容，逐块比较后只写入变化的部分"""
+        sub_size = self.delta_block_size
+        block_size = max(self.block_size - self.block_size % sub_size, sub_size)
+        if self.source_hashes is not None and \
+                len(self.source_hashes) < (iso_size + sub_size - 1) // sub_size:
+            raise Exception("块摘要清单与ISO大小不符")
+
+        read_fd = os.open(self._device, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        source_map = self._map_source(src, iso_size)
+        # 无法映射ISO时读入对齐缓冲区，保证O_DIRECT写入的对齐要求
+        pool = BufferPool(1, block_size) if source_map is None else None
+        source_buf = pool.acquire() if pool is not None else None
+        self.copy_method = 'delta'
+        # 有块摘要清单时，未变化的块根本不需要读取ISO，此时不计算整体摘要
+        hasher = None
+        if (self.hash_algorithm or self.block_hash_size) and self.source_hashes is None:
+            hasher = StreamHasher(self.hash_algorithm, self.block_hash_size)
+            self._hash_prefix(hasher)
+
+        def read_device(offset, length):
+            if hasattr(os, 'pread'):
+                return os.pread(read_fd, length, offset)
+            os.lseek(read_fd, offset, os.SEEK_SET)
+            return os.read(read_fd, length)
+
+        def source_view(offset, length):
+            if source_map is not None:
+                return memoryview(source_map)[offset:offset + length]
+            src.seek(offset)
+            if self._fill_buffer(src, source_buf, length) < length:
+                raise Exception(f"ISO文件在偏移 {offset} 处提前结束")
+            return memoryview(source_buf)[:length]
+
+        # 没有pread时共享文件位置，只能串行预读
+        workers = self.queue_depth if hasattr(os, 'pread') else 1
+        offsets = iter(range(self.start_offset, iso_size, block_size))
+        pending = deque()
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                def submit():
+                    offset = next(offsets, None)
+                    if offset is not None:
+                        length = min(block_size, iso_size - offset)
+                        pending.append((offset, length, executor.submit(read_device, offset, length)))
+
+                for _ in range(workers * 2):
+                    submit()
+                while pending:
+                    offset, length, future = pending.popleft()
+                    current = future.result()
+                    submit()
+                    self._delta_block(dst_fd, offset, length, current, source_view, hasher)
+                    self.advance(dst_fd, offset + length, iso_size)
+        finally:
+            os.close(read_fd)
+            if source_map is not None:
+                source_map.close()
+            if pool is not None:
+                pool.close()
+
+        if hasher is not None:
+            self.digest, block_hashes = hasher.finish()
+            if self.block_hash_size:
+                self.block_hashes = block_hashes
+
+    def _delta_block(self, dst_fd, offset, length, current, source_view, hasher):
+        """比较一个块内的各个子块，写入与设备现有内容不同的子块"""
+        sub_size = self.delta_block_size
+        view = None if self.source_hashes is not None else source_view(offset, length)
+        try:
+            if hasher is not None:
+                hasher.update(view)
+            for sub_offset in range(0, length, sub_size):
+                sub_length = min(sub_size, length - sub_offset)
+                existing = current[sub_offset:sub_offset + sub_length]
+                if view is not None:
+                    # bytes.startswith在C层直接比较，不复制ISO数据
+                    changed = len(existing) < sub_length or \
+                        not current.startswith(view[sub_offset:sub_offset + sub_length], sub_offset)
+                else:
+                    index = (offset + sub_offset) // sub_size
+                    changed = len(existing) < sub_length or \
+                        block_digest(existing) != self.source_hashes[index]
+                if not changed:
+                    continue
+                if view is not None:
+                    self.write_block(dst_fd, offset + sub_offset,
+                                      view[sub_offset:sub_offset + sub_length])
+                else:
+                    with source_view(offset + sub_offset, sub_length) as sub_view:
+                        self.write_block(dst_fd, offset + sub_offset, sub_view)
+                self.bytes_changed += sub_length
+        finally:
+            if view is not None:
+                view.release()
+
+    def _map_source(self, src, iso_size):
+        """尝试以只读方式映射ISO，不可用时返回None"""
+        if not self.zero_copy or iso_size == 0:
+            return None
+        try:
+            source_map = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError, OverflowError):
+            return None
+        if hasattr(source_map, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            source_map.madvise(mmap.MADV_SEQUENTIAL)
+        return source_map
+
+    def _iter_source_blocks(self, src_fd, iso_size, block_size):
+        """按块生成(偏移, 长度, 是否为空洞)，跳零模式下空洞区间不再读取"""
+        ranges = iter_data_ranges(src_fd, iso_size) if self.skip_zero else [(0, iso_size)]
+        pos = self.start_offset
+        for start, end in ranges:
+            if end <= pos:
+                continue
+            start = max(start, pos)
+            if start > pos:
+                yield pos, start - pos, True
+            offset = start
+            while offset < end:
+                length = min(block_size, end - offset)
+                yield offset, length, False
+                offset += length
+            pos = end
+        if pos < iso_size:
+            yield pos, iso_size - pos, True
+
+    def _reader_loop(self, src, iso_size, block_size, pool, consumer_queues, stop_event, errors):
+        """读线程：把ISO按块readinto到预分配缓冲区并分发给消费线程"""
+        try:
+            for offset, length, is_hole in self._iter_source_blocks(src.fileno(), iso_size, block_size):
+                if stop_event.is_set():
+                    break
+                if self.cancel_token is not None:
+                    self.cancel_token.check()
+                if is_hole:
+                    self._dispatch(DataBlock(offset, length, consumers=len(consumer_queues)),
+                                   consumer_queues)
+                    continue
+                buf = pool.acquire()
+                src.seek(offset)
+                filled = self._fill_buffer(src, buf, length)
+                if filled < length:
+                    pool.release(buf)
+                    raise Exception(f"ISO文件在偏移 {offset + filled} 处提前结束")
+                view = memoryview(buf)[:length]
+                if self.skip_zero and is_zero_block(view):
+                    view.release()
+                    pool.release(buf)
+                    view = None
+                    buf = None
+                block = DataBlock(offset, length, view,
+                                  on_release=(lambda b=buf: pool.release(b)) if buf is not None else None,
+                                  consumers=len(consumer_queues))
+                self._dispatch(block, consumer_queues)
+        except OperationCancelled as e:
+            errors.append(e)
+            stop_event.set()
+        except Exception as e:
+            errors.append(Exception(f"读取ISO失败: {e}"))
+            stop_event.set()
+        finally:
+            # 无论成功与否都发送结束标记，消费线程据此退出
+            for consumer_queue in consumer_queues:
+                consumer_queue.put(None)
+
+    def _mapped_reader_loop(self, source_map, iso_size, block_size, pool, consumer_queues, stop_event, errors):
+        """读线程：对ISO映射切片并提前预读，写线程直接从映射写出"""
+        can_prefetch = hasattr(source_map, 'madvise') and hasattr(mmap, 'MADV_WILLNEED')
+        try:
+            for offset, length, is_hole in self._iter_source_blocks(self._src_fd, iso_size, block_size):
+                if stop_event.is_set():
+                    break
+                if self.cancel_token is not None:
+                    self.cancel_token.check()
+                view = None
+                if not is_hole:
+                    if can_prefetch:
+                        # 异步预读该块，写线程取到时数据已在页缓存中
+                        start = offset - offset % mmap.PAGESIZE
+                        source_map.madvise(mmap.MADV_WILLNEED, start, offset + length - start)
+                    view = memoryview(source_map)[offset:offset + length]
+                    if self.skip_zero and is_zero_block(view):
+                        view.release()
+                        view = None
+                self._dispatch(DataBlock(offset, length, view, consumers=len(consumer_queues)),
+                               consumer_queues)
+        except OperationCancelled as e:
+            errors.append(e)
+            stop_event.set()
+        except Exception as e:
+            errors.append(Exception(f"读取ISO失败: {e}"))
+            stop_event.set()
+        finally:
+            for consumer_queue in consumer_queues:
+                consumer_queue.put(None)
+
+    def _dispatch(self, block, consumer_queues):
+        """把数据块交给所有消费线程"""
+        for consumer_queue in consumer_queues:
+            consumer_queue.put(block)
+
+    def _fill_buffer(self, src, buf, length):
+        """从当前位置读取length字节到缓冲区，返回实际读取的字节数"""
+        view = memoryview(buf)
+        filled = 0
+        try:
+            while filled < length:
+                n = src.readinto(view[filled:length])
+                if not n:
+                    break
+                filled += n
+        finally:
+            view.release()
+        return filled
+
+    def _writer_loop(self, dst_fd, iso_size, data_queue, stop_event, errors):
+        """写线程：从队列取出数据块写入设备，可有多个写线程共享同一队列"""
+        while True:
+            block = data_queue.get()
+            if block is None:
+                # 把结束标记留给其他写线程
+                data_queue.put(None)
+                break
+
+            try:
+                if stop_event.is_set():
+                    continue
+                # 空洞或全零块不写入，完成时只记录区间
+                if block.view is not None:
+                    self.write_block(dst_fd, block.offset, block.view)
+                self._complete_block(dst_fd, block.offset, block.length, block.view is None, iso_size)
+            except OperationCancelled as e:
+                errors.append(e)
+                stop_event.set()
+            except Exception as e:
+                errors.append(Exception(f"写入设备失败 (偏移 {block.offset}): {e}"))
+                # 出错后继续排空队列，保证读线程不会阻塞
+                stop_event.set()
+            finally:
+                block.release()
+
+    def _complete_block(self, dst_fd, offset, length, skipped, iso_size):
+        """记录一个块已完成；多个写线程乱序完成时，只有连续完成的部分才推进写入位置和检查点"""
+        with self._complete_lock:
+            self._completed[offset] = (length, skipped)
+            position = self.bytes_written
+            while position in self._completed:
+                length, skipped = self._completed.pop(position)
+                if skipped:
+                    self._record_skip(position, length)
+                position += length
+            if position > self.bytes_written:
+                self.advance(dst_fd, position, iso_size)
+                return
+        if self.cancel_token is not None:
+            self.cancel_token.check()
+
+    def _hasher_loop(self, hasher, hash_queue, stop_event, errors):
+        """摘要线程：按顺序把数据块输入哈希对象"""
+        try:
+            self._hash_prefix(hasher)
+        except Exception as e:
+            errors.append(e if isinstance(e, OperationCancelled) else Exception(f"读取ISO失败: {e}"))
+            stop_event.set()
+        while True:
+            block = hash_queue.get()
+            if block is None:
+                break
+            try:
+                if stop_event.is_set():
+                    continue
+                if block.view is None:
+                    hasher.update_zeros(block.length)
+                else:
+                    hasher.update(block.view)
+            finally:
+                block.release()
+
+    def _hash_prefix(self, hasher):
+        """续写时补算断点之前部分的摘要，使整体摘要和块摘要仍覆盖整个ISO"""
+        if not self.start_offset:
+            return
+        chunk = min(self.block_size, self.start_offset)
+        buf = bytearray(chunk)
+        with open(self._iso_file, 'rb', buffering=0) as src, memoryview(buf) as view:
+            offset = 0
+            while offset < self.start_offset:
+                if self.cancel_token is not None:
+                    self.cancel_token.check()
+                length = min(chunk, self.start_offset - offset)
+                if self._fill_buffer(src, buf, length) < length:
+                    raise Exception(f"ISO文件在偏移 {offset} 处提前结束")
+                hasher.update(view[:length])
+                offset += length
+
+    def _record_skip(self, offset, length):
+        """记录被跳过的区间，相邻区间合并"""
+        self.bytes_skipped += length
+        if self.skipped_ranges and self.skipped_ranges[-1][1] == offset:
+            self.skipped_ranges[-1] = (self.skipped_ranges[-1][0], offset + length)
+        else:
+            self.skipped_ranges.append((offset, offset + length))
+
+    def _fill_skipped_ranges(self):
+        """对被跳过的区间发出discard/zeroout，不支持时写零"""
+        # 使用普通描述符，写零回退路径不受O_DIRECT对齐限制
+        fd = os.open(self._device, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            for start, end in self.skipped_ranges:
+                fill_range(fd, start, end - start, self.skip_fill)
+            datasync(fd)
+        finally:
+            os.close(fd)
+
+    def write_block(self, dst_fd, offset, view):
+        """写入一个数据块，O_DIRECT模式下未对齐的尾部单独写入"""
+        length = len(view)
+        if not self._aligned_io or length % self.sector_size == 0:
+            write_all(dst_fd, view, offset)
+            return
+
+        aligned = length - length % self.sector_size
+        if aligned:
+            write_all(dst_fd, view[:aligned], offset)
+        self._write_tail(offset + aligned, view[aligned:])
+
+    def _write_tail(self, offset, view):
+        """通过普通文件描述符写入不足一个扇区的ISO尾部"""
+        fd = os.open(self._device, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            write_all(fd, view, offset)
+            datasync(fd)
+        finally:
+            os.close(fd)
+
+    def advance(self, dst_fd, position, iso_size):
+        """记录写入位置，按间隔刷写并上报进度，然后检查取消和暂停"""
+        self.bytes_written = position
+        token = self.cancel_token
+        if (self.sync_interval and self.bytes_written - self.bytes_flushed >= self.sync_interval) \
+                or (token is not None and (token.paused or token.cancelled)):
+            # 暂停或取消前同样先刷写，检查点总是真正落盘的位置
+            datasync(dst_fd)
+            self.bytes_flushed = self.bytes_written
+            self._record_checkpoint()
+        self._report_progress(iso_size)
+        if token is not None:
+            token.check()
+
+    def checkpoint_offset(self):
+        """已确认落盘且之前没有待填充空洞的位置，从这里继续写入是安全的"""
+        offset = self.bytes_flushed
+        if self.skip_fill and self.skipped_ranges and not self._skips_filled:
+            # 被跳过的区间要到最后才清零，检查点不能越过第一个未处理的区间
+            offset = min(offset, self.skipped_ranges[0][0])
+        return offset
+
+    def _record_checkpoint(self):
+        offset = self.checkpoint_offset()
+        if self.cancel_token is not None:
+            self.cancel_token.record_checkpoint(offset)
+        if self.checkpoint_callback:
+            self.checkpoint_callback(offset)
+
+    def _report_progress(self, iso_size):
+        """上报进度：缓存写入且设置了刷写间隔时只统计已刷写的字节"""
+        if not self.progress_callback:
+            return
+        if self.sync_interval and not self.direct_io:
+            self.progress_callback(self.bytes_flushed, iso_size)
+        else:
+            self.progress_callback(self.bytes_written, iso_size)
@@ -0,0 +1,104 @@
+"""
+写入断点日志
+记录ISO身份、目标设备和最近一次确认落盘的位置，每批数据刷写后更新；
+写入因USB断开等原因中断后，可校验断点处的尾块并从断点继续，不必从第0字节重写
+"""
+
+import os
+import json
+import time
+
+from blockdev_utils import get_device_size, is_block_device
+from hash_cache import atomic_write, get_cache_dir, identity_key, iso_identity
+from verify_utils import open_for_read, read_at
+
+JOURNAL_VERSION = 1
+# 续写前回读比较的断点前数据量
+RESUME_VERIFY_SIZE = 4 * 1024 * 1024  # 4MB
+
+
+def device_size(device):
+    """块设备的容量，普通文件（测试用目标）返回None"""
+    try:
+        fd = os.open(device, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    except OSError:
+        return None
+    try:
+        return get_device_size(fd) if is_block_device(fd) else None
+    finally:
+        os.close(fd)
+
+
+class WriteJournal:
+    """单个ISO写入单个设备的断点日志"""
+
+    def __init__(self, iso_file, device, journal_dir=None):
+        self.iso_file = iso_file
+        self.device = device
+        self.journal_dir = journal_dir or get_cache_dir("journals")
+        self.identity = iso_identity(iso_file)
+        self.device_path = os.path.realpath(device)
+        key = identity_key({"iso": self.identity, "device": self.device_path})
+        self.path = os.path.join(self.journal_dir, f"{key}.json")
+        self._device_size = device_size(device)
+
+    def load(self):
+        """返回日志中记录的断点，没有日志或日志与当前ISO、设备不符时返回0"""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        if record.get("version") != JOURNAL_VERSION or record.get("iso") != self.identity \
+                or record.get("device") != self.device_path \
+                or record.get("device_size") != self._device_size:
+            # ISO被修改或设备已更换，旧断点不再可信
+            self.clear()
+            return 0
+        offset = record.get("offset", 0)
+        if not isinstance(offset, int) or offset < 0 or offset > self.identity["size"]:
+            return 0
+        return offset
+
+    def record(self, offset):
+        """记录已落盘的位置，由写入引擎在每次刷写后调用"""
+        data = json.dumps({
+            "version": JOURNAL_VERSION,
+            "iso": self.identity,
+            "device": self.device_path,
+            "device_size": self._device_size,
+            "offset": offset,
+            "updated": time.time(),
+        }).encode("utf-8")
+        try:
+            atomic_write(self.path, data)
+        except OSError as e:
+            # 日志只影响能否续写，保存失败不应中断写入
+            print(f"保存写入断点失败: {e}")
+
+    def clear(self):
+        """写入完成后删除日志"""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def verify_tail(self, offset, length=RESUME_VERIFY_SIZE):
+        """回读断点前的最后一块与ISO比较；U盘掉电可能丢失最后一批刷写，此时断点不可信"""
+        if offset <= 0:
+            return True
+        start = max(0, offset - length)
+        with open(self.iso_file, "rb") as f:
+            f.seek(start)
+            expected = f.read(offset - start)
+
+        fd, _ = open_for_read(self.device)
+        try:
+            if hasattr(os, 'posix_fadvise'):
+                # 丢弃页缓存中的旧内容，确保读到的是设备上实际保存的数据
+                os.posix_fadvise(fd, start, offset - start, os.POSIX_FADV_DONTNEED)
+            current = bytearray(offset - start)
+            got = read_at(fd, memoryview(current), start)
+        finally:
+            os.close(fd)
+        return got == len(expected) and current == expected